@@ -0,0 +1,381 @@
+"""
+Non-interactive build of many pipelines from a manifest.
+
+    python -m ai.batch_build manifest.yaml --workers 4 --memory-budget 8G --summary summary.json
+
+Manifest (JSON, or YAML with PyYAML installed):
+
+    {
+        "defaults": {"strategies": ["cycle"], "params": {"storage_dtype": "int8"}},
+        "jobs": [
+            {"data": "shop.json", "models": ["paraphrase-multilingual-MiniLM-L12-v2"],
+             "strategies": ["cycle", "most_similar"], "name": "shop_{strategy}"},
+            {"data": ["faq_en.jsonl", "faq_de.jsonl"], "model": "distiluse-base-multilingual-cased-v2"}
+        ]
+    }
+
+Every entry is expanded into data files x models x strategies. ``name`` may use
+{data}, {model} and {strategy} (default: the data file name, plus the model and
+strategy when an entry has several). ``params`` are passed to
+``Education.train_on_file``; ``memory_bytes`` overrides the memory estimate of
+a job and ``model_bytes`` the memory estimate of its model.
+"""
+import argparse
+import gc
+import json
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional
+
+from ai.education import Education
+
+# Reserved for a model whose weights are not in the local hub (a multilingual MiniLM is ~0.5G)
+DEFAULT_MODEL_BYTES = 1024 ** 3
+WEIGHT_FILES = ('*.safetensors', '*.bin', '*.pt')
+
+
+def parse_size(value) -> Optional[int]:
+    """Parses a byte size such as 8589934592, '8G' or '512M'."""
+    if value is None or isinstance(value, int):
+        return value
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*', str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    power = ' KMGT'.index(match.group(2).upper() or ' ')
+    return int(float(match.group(1)) * 1024 ** power)
+
+
+def load_manifest(path: str) -> dict:
+    """Reads a JSON or YAML manifest."""
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("YAML manifests require PyYAML: pip install pyyaml")
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def _as_list(value) -> list:
+    return value if isinstance(value, list) else [value]
+
+
+def plan_jobs(manifest: dict, data_dir: str = 'data', stream_batch_size: int = 10000) -> list:
+    """
+    Expands the manifest into build jobs and groups them into chains.
+
+    Jobs built from the same data file with the same model form a chain: they
+    run one after another and share one embedding cache, so the questions are
+    encoded only once. Chains are ordered by model, so a model can be unloaded
+    as soon as its chains are done.
+
+    :return: List of chains, each a list of job dicts: {
+        'name', 'data_file', 'model', 'answer_strategy', 'params',
+        'cache_name', 'estimated_bytes', 'model_bytes'
+    }
+    """
+    defaults = manifest.get('defaults', {})
+    jobs = []
+    for entry in manifest.get('jobs', []):
+        entry = {**defaults, **entry, 'params': {**defaults.get('params', {}), **entry.get('params', {})}}
+        data_files = _as_list(entry.get('data', entry.get('data_files')))
+        models = _as_list(entry.get('model', entry.get('models', 'paraphrase-multilingual-MiniLM-L12-v2')))
+        strategies = _as_list(entry.get('strategy', entry.get('strategies', 'cycle')))
+        if not data_files or None in data_files:
+            raise ValueError(f"Manifest entry without data: {entry}")
+
+        template = entry.get('name') or '_'.join(
+            ['{data}'] + (['{model}'] if len(models) > 1 else []) + (['{strategy}'] if len(strategies) > 1 else [])
+        )
+        for data_file in data_files:
+            for model in models:
+                for strategy in strategies:
+                    name = template.format(data=Path(data_file).stem, model=Path(model).name, strategy=strategy)
+                    jobs.append({
+                        'name': name,
+                        'data_file': data_file,
+                        'model': model,
+                        'answer_strategy': strategy,
+                        'params': dict(entry['params']),
+                        'estimated_bytes': parse_size(entry.get('memory_bytes')),
+                        'model_bytes': parse_size(entry.get('model_bytes'))
+                    })
+
+    names = [job['name'] for job in jobs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Several jobs would build the same pipeline: {', '.join(duplicates)}")
+
+    chains: Dict[tuple, list] = {}
+    for job in jobs:
+        if job['estimated_bytes'] is None:
+            job['estimated_bytes'] = estimate_job_bytes(job, data_dir, stream_batch_size)
+        if job['model_bytes'] is None:
+            job['model_bytes'] = estimate_model_bytes(job['model'])
+        chain = chains.setdefault((job['model'], job['data_file']), [])
+        job['cache_name'] = chain[0]['name'] if chain else job['name']
+        chain.append(job)
+    return [chains[key] for key in sorted(chains)]
+
+
+def estimate_job_bytes(job: dict, data_dir: str, stream_batch_size: int = 10000) -> int:
+    """
+    Rough peak memory of a build (without the model): the question and answer
+    texts kept for the output files, plus one window of float32 embeddings.
+    """
+    data_file = job['data_file']
+    if not data_file.endswith(('.json', '.jsonl')):
+        data_file += '.json'
+    path = Path(data_dir) / data_file
+    file_size = path.stat().st_size if path.exists() else 0
+    window = job['params'].get('stream_batch_size', stream_batch_size)
+    return int(4 * file_size + window * 1024 * 4 * 2)
+
+
+def estimate_model_bytes(name: str, hub_dir: str = 'hub') -> int:
+    """
+    Memory of a model before it is loaded: the size of its weight files in the
+    local hub, or ``DEFAULT_MODEL_BYTES`` for a model that is downloaded.
+    """
+    for path in (Path(hub_dir) / name, Path(name)):
+        if path.is_dir():
+            size = sum(f.stat().st_size for pattern in WEIGHT_FILES for f in path.rglob(pattern))
+            if size:
+                return size
+    return DEFAULT_MODEL_BYTES
+
+
+def model_bytes(model) -> int:
+    """Memory of a loaded model's parameters (0 if unknown)."""
+    try:
+        return int(sum(p.numel() * p.element_size() for p in model.parameters()))
+    except Exception:
+        return 0
+
+
+class MemoryBudget:
+    """
+    Admits jobs and model loads while their estimated memory fits into the
+    budget. A job or model larger than the whole budget still runs, but only
+    when nothing else is held.
+    """
+
+    def __init__(self, budget_bytes: Optional[int] = None):
+        self.budget_bytes = budget_bytes
+        self.jobs_bytes = 0
+        self.models_bytes = 0
+        self._running = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, n: int):
+        with self._condition:
+            while (self.budget_bytes is not None and self._running
+                   and self.jobs_bytes + self.models_bytes + n > self.budget_bytes):
+                self._condition.wait()
+            self.jobs_bytes += n
+            self._running += 1
+
+    def release(self, n: int):
+        with self._condition:
+            self.jobs_bytes -= n
+            self._running -= 1
+            self._condition.notify_all()
+
+    def acquire_model(self, n: int):
+        """Reserves the memory of a model before it is loaded."""
+        with self._condition:
+            while (self.budget_bytes is not None and (self._running or self.models_bytes)
+                   and self.jobs_bytes + self.models_bytes + n > self.budget_bytes):
+                self._condition.wait()
+            self.models_bytes += n
+
+    def resize_model(self, reserved: int, n: int):
+        """Replaces the reservation of a loaded model with its actual size."""
+        with self._condition:
+            self.models_bytes += n - reserved
+            self._condition.notify_all()
+
+    def remove_model(self, n: int):
+        with self._condition:
+            self.models_bytes -= n
+            self._condition.notify_all()
+
+
+class SharedModels:
+    """
+    Loads each base model once and unloads it when no remaining job needs it.
+    The memory of a model is reserved in the budget before it is loaded.
+    """
+
+    def __init__(self, chains: list, budget: MemoryBudget):
+        self.budget = budget
+        self._remaining: Dict[str, int] = {}
+        self._estimates: Dict[str, int] = {}
+        for chain in chains:
+            for job in chain:
+                self._remaining[job['model']] = self._remaining.get(job['model'], 0) + 1
+                self._estimates[job['model']] = max(self._estimates.get(job['model'], 0), job['model_bytes'])
+        self._models: Dict[str, dict] = {}
+        self._locks = {name: threading.Lock() for name in self._remaining}
+        # Held while a build uses the model: chains of one model run on several workers
+        self.model_locks = {name: threading.Lock() for name in self._remaining}
+        self._lock = threading.Lock()
+        self.stats: Dict[str, dict] = {}
+
+    def get(self, name: str):
+        """Returns the loaded model, loading it on first use."""
+        with self._locks[name]:
+            if name not in self._models:
+                reserved = self._estimates[name]
+                self.budget.acquire_model(reserved)
+                start = time.perf_counter()
+                try:
+                    model = Education(name).model
+                except BaseException:
+                    self.budget.remove_model(reserved)
+                    raise
+                size = model_bytes(model) or reserved
+                self.budget.resize_model(reserved, size)
+                self._models[name] = {'model': model, 'bytes': size}
+                self.stats[name] = {'load_seconds': time.perf_counter() - start, 'bytes': size,
+                                    'estimated_bytes': reserved}
+            return self._models[name]['model']
+
+    def done(self, name: str):
+        """Marks a job of the model as finished."""
+        with self._lock:
+            self._remaining[name] -= 1
+            unload = self._remaining[name] == 0
+        if unload:
+            with self._locks[name]:
+                entry = self._models.pop(name, None)
+            if entry is not None:
+                del entry['model']
+                gc.collect()
+                self.budget.remove_model(entry['bytes'])
+
+
+class BatchBuilder:
+    """Builds the pipelines of a manifest concurrently."""
+
+    def __init__(self, manifest: dict, max_workers: int = 2, memory_budget_bytes: Optional[int] = None,
+                 show_progress: bool = False):
+        """
+        :param manifest: Manifest dict (see ``load_manifest``)
+        :param max_workers: Number of jobs built at the same time
+        :param memory_budget_bytes: Memory for loaded models and running jobs
+            (None - only limited by max_workers)
+        :param show_progress: Show progress bars of the builds
+        """
+        self.max_workers = max_workers
+        self.budget = MemoryBudget(memory_budget_bytes)
+        self.show_progress = show_progress
+        self.chains = plan_jobs(manifest)
+        self.models = SharedModels(self.chains, self.budget)
+
+    def _run_job(self, job: dict) -> dict:
+        result = {
+            'name': job['name'],
+            'data_file': job['data_file'],
+            'model': job['model'],
+            'answer_strategy': job['answer_strategy'],
+            'estimated_bytes': job['estimated_bytes']
+        }
+        queued = time.perf_counter()
+        try:
+            model = self.models.get(job['model'])
+            self.budget.acquire(job['estimated_bytes'])
+            started = time.perf_counter()
+            result['queued_seconds'] = started - queued
+            try:
+                edu = Education(job['model'], model=model, model_lock=self.models.model_locks[job['model']])
+                params = {'show_progress': self.show_progress, 'cache_name': job['cache_name'], **job['params']}
+                output = edu.train_on_file(job['data_file'], job['name'],
+                                           answer_strategy=job['answer_strategy'], **params)
+            finally:
+                self.budget.release(job['estimated_bytes'])
+            result.update({
+                'status': 'success',
+                'seconds': time.perf_counter() - started,
+                'model_dir': output['model_dir'],
+                'questions': output['questions_processed'],
+                'encoded_texts': output['encoded_texts'],
+                'reused_embeddings': output['reused_embeddings'],
+                'sentences_per_second': output['sentences_per_second']
+            })
+        except Exception as e:
+            result.update({'status': 'failed', 'seconds': time.perf_counter() - queued, 'error': str(e)})
+            print(f"Build of {job['name']} failed: {str(e)}")
+        finally:
+            self.models.done(job['model'])
+        return result
+
+    def _run_chain(self, chain: list) -> list:
+        return [self._run_job(job) for job in chain]
+
+    def run(self) -> dict:
+        """
+        Builds all pipelines.
+
+        :return: {
+            'status': 'success'|'failed',
+            'started_at': str,
+            'seconds': float,
+            'jobs': [{'name', 'status', 'seconds', 'queued_seconds', ...}],
+            'models': {model: {'load_seconds', 'bytes', 'estimated_bytes'}},
+            'failed': int
+        }
+        """
+        started_at = datetime.now().isoformat()
+        start = time.perf_counter()
+        total = sum(len(chain) for chain in self.chains)
+        print(f"Building {total} pipelines with {self.max_workers} workers...")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = [job for chain in executor.map(self._run_chain, self.chains) for job in chain]
+
+        failed = sum(job['status'] != 'success' for job in results)
+        return {
+            'status': 'failed' if failed else 'success',
+            'started_at': started_at,
+            'seconds': time.perf_counter() - start,
+            'jobs': results,
+            'models': self.models.stats,
+            'failed': failed
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ai.batch_build',
+                                     description='Build the pipelines of a manifest')
+    parser.add_argument('manifest', help='JSON or YAML manifest')
+    parser.add_argument('--workers', type=int, default=2, help='Jobs built at the same time')
+    parser.add_argument('--memory-budget', default=None,
+                        help='Memory for models and running jobs, e.g. 8G (default: unlimited)')
+    parser.add_argument('--summary', default=None, help='JSON file for the summary (default: stdout)')
+    parser.add_argument('--progress', action='store_true', help='Show progress bars')
+    args = parser.parse_args(argv)
+
+    builder = BatchBuilder(load_manifest(args.manifest), max_workers=args.workers,
+                           memory_budget_bytes=parse_size(args.memory_budget),
+                           show_progress=args.progress)
+    summary = builder.run()
+
+    text = json.dumps(summary, indent=2, ensure_ascii=False)
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            f.write(text)
+        print(f"Summary saved to {args.summary}")
+    else:
+        sys.stdout.write(text + '\n')
+    sys.exit(1 if summary['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import contextlib
 import json
 import random
 import shutil
@@ -6,26 +7,55 @@ from datetime import datetime
 import time
 import numpy as np
 import torch
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import SentenceTransformer
 from typing import Literal, Optional, Dict, List
 from pathlib import Path
 from tqdm import tqdm
+from ai.pipeline import IVFIndex, BM25Index, EmbeddingMatrix, STORAGE_DTYPES, SEARCH_BACKENDS, \
+    encode_length_bucketed, write_pack, PACK_FILE, BUILDS_DIR, CURRENT_FILE, current_build_dir
+from ai.embedding_store import EmbeddingStore
+from ai.encoding_pool import EncodingPool
+
+STAGING_DIR = '.staging'
+# The pipeline package imports the modules of the build named in 'current'
+PACKAGE_INIT = """# Auto-generated pipeline package
+import os as _os
+
+_folder = _os.path.dirname(__file__)
+with open(_os.path.join(_folder, 'current'), 'r', encoding='utf-8') as _f:
+    __path__ = [_os.path.join(_folder, 'builds', _f.read().strip())]
+"""
 
 class Education:
-    def __init__(self, model_name='paraphrase-multilingual-MiniLM-L12-v2'):
+    def __init__(self, model_name='paraphrase-multilingual-MiniLM-L12-v2', model=None, model_lock=None):
         """
         Initialization of model training
         :param model_name: model name (with or without the prefix)
-        :param hub_dir: folder with saved models (optional)
+        :param model: already loaded SentenceTransformer of this model
+            (e.g. shared between several builds) instead of loading it again
+        :param model_lock: lock held while the model is used, for a model
+            shared between threads (its tokenizer is not thread-safe)
         """
         self.model_name = model_name
         self.hub_dir = 'hub'
         self.data_dir = 'data'
         self.pipeline_dir = 'build'
+        self.cache_dir = 'cache'
         self._answer_embeddings_cache = {}
         self._current_answers_hash = None
+        self._encoded_count = 0
+        self._reused_count = 0
+        self._encode_seconds = 0.0
+        self._encode_stats = {}
+        self._pool = None
+        self._model_lock = model_lock or contextlib.nullcontext()
         self._ensure_dirs_exist()
-        self.model = self._init_model()
+        if model is not None:
+            local_path = os.path.join(self.hub_dir, self.model_name)
+            self.model_source = local_path if os.path.exists(local_path) else self.model_name
+            self.model = model
+        else:
+            self.model = self._init_model()
     
     def _init_model(self):
         """Initializes the model, first trying the local hub, then creating directly"""
@@ -35,6 +65,7 @@ class Education:
             if os.path.exists(local_path):
                 try:
                     _a = SentenceTransformer(local_path)
+                    self.model_source = local_path
                     print("Model loaded from hub")
                     return _a
                 except Exception as e:
@@ -43,6 +74,7 @@ class Education:
         # If not found in the hub, load directly
         full_model_name = self.model_name
         _a = SentenceTransformer(full_model_name)
+        self.model_source = full_model_name
         print("Model loaded directly")
         return _a
 
@@ -62,20 +94,24 @@ class Education:
         """Creates necessary directories if they do not exist"""
         Path(self.data_dir).mkdir(parents=True, exist_ok=True)
         Path(self.pipeline_dir).mkdir(parents=True, exist_ok=True)
+        Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
         if self.hub_dir:
             Path(self.hub_dir).mkdir(parents=True, exist_ok=True)
 
-    def _copy_pipeline_files(self, model_dir: str):
-        """Copies the necessary files for the pipeline to work"""
-        dest_path = Path(model_dir)
+    def _copy_pipeline_files(self, build_dir: str):
+        """Copies the necessary files for the pipeline to work into a build folder"""
+        dest_path = Path(build_dir)
         
-        # Copying the self-contained pipeline.py
+        # Copying the self-contained pipeline.py and the HTTP server
         current_dir = Path(__file__).parent
         shutil.copy(current_dir / 'pipeline.py', dest_path)
-        
-        # Creating the __init__.py file
-        with open(dest_path / '__init__.py', 'w') as f:
+        shutil.copy(current_dir / 'server.py', dest_path)
+
+        # Creating the __main__.py file (python -m <pipeline> serve)
+        with open(dest_path / '__main__.py', 'w') as f:
             f.write('# Auto-generated pipeline package\n')
+            f.write('from .server import main\n\n')
+            f.write('main()\n')
         
         # Creating requirements.txt
         possible_req_paths = [
@@ -98,7 +134,7 @@ class Education:
             self._current_answers_hash = current_hash
             
         if current_hash not in self._answer_embeddings_cache:
-            with torch.no_grad():
+            with torch.no_grad(), self._model_lock:
                 self._answer_embeddings_cache[current_hash] = {
                     'embeddings': self.model.encode(answers, convert_to_tensor=True),
                     'timestamp': time.time()
@@ -127,101 +163,255 @@ class Education:
 
     def train_on_file(self, data_file: str, model_name: str, 
                  answer_strategy: Literal['last', 'cycle', 'random', 'most_similar'] = 'last',
-                 show_progress: bool = True, chunk_size: int = 100):
+                 show_progress: bool = True, chunk_size: int = 100,
+                 ann_index: bool = False, ann_params: Optional[Dict] = None,
+                 export_onnx: bool = False,
+                 onnx_quantization: Optional[Literal['arm64', 'avx2', 'avx512', 'avx512_vnni']] = None,
+                 incremental: bool = True, stream_batch_size: int = 10000,
+                 num_workers: int = 1, threads_per_worker: Optional[int] = None,
+                 storage_dtype: Literal['float32', 'float16', 'int8', 'binary'] = 'float32',
+                 pack: bool = False, lexical_index: bool = False,
+                 search_backend: Optional[str] = None, search_params: Optional[Dict] = None,
+                 cache_name: Optional[str] = None):
         """
         Train the model on the specified data file
-        :param data_file: name of the data file (e.g. 'faq.json')
+        :param data_file: name of the data file: a JSON array (e.g. 'faq.json')
+            or JSON Lines with one FAQ item per line (e.g. 'faq.jsonl')
         :param model_name: name for saving the model
         :param answer_strategy: answer selection strategy 
             ('last' - last, 'cycle' - cyclic, 'random' - random, 'most_similar' - most similar)
         :param show_progress: whether to show progress bars
         :param chunk_size: batch size for question encoding
+        :param ann_index: whether to build an approximate nearest-neighbour (IVF) index
+        :param ann_params: index parameters: 'n_lists' (clusters, default ~4*sqrt(n)),
+            'n_probe' (clusters scanned per query, default 8; higher is slower but more accurate),
+            'n_iter' (k-means iterations, default 10)
+        :param export_onnx: whether to export the encoder to ONNX (requires optimum[onnxruntime])
+        :param onnx_quantization: dynamic int8 quantization config for the ONNX export
+            ('arm64', 'avx2', 'avx512', 'avx512_vnni'; None - no quantization)
+        :param incremental: reuse embeddings of unchanged texts from the previous build
+            of this pipeline (stored in the cache folder) and encode only new or changed ones
+        :param stream_batch_size: number of questions read and encoded before they are
+            written to disk (bounds peak memory)
+        :param num_workers: number of CPU worker processes encoding chunks in parallel,
+            each with its own copy of the model (1 - encode in this process)
+        :param threads_per_worker: torch threads per worker process
+            (default is the CPU count divided by num_workers)
+        :param storage_dtype: format of the saved embeddings: 'float32', 'float16' (2x smaller),
+            'int8' (scalar-quantized with per-row scales, 4x smaller) or 'binary'
+            (1 bit per dimension with Hamming pre-filtering and rescoring, ~30x smaller)
+        :param pack: write embeddings, answers, questions and the ANN index into a single
+            memory-mappable 'pipeline.pack' file instead of separate files (faster cold start)
+        :param lexical_index: whether to build a BM25 inverted index over the questions,
+            so queries with rare tokens (product codes, error IDs) are matched lexically too
+        :param search_backend: embedding search backend recorded for the built pipeline:
+            'blocked' (exact, bounded memory), 'numpy' (exact, one matrix multiplication),
+            'torch' (exact), 'ivf' (implies ann_index), 'faiss' or 'hnswlib'
+            (their index is built here; require the faiss / hnswlib packages);
+            default is 'ivf' with ann_index, otherwise 'blocked'
+        :param search_params: backend parameters stored in meta.json (e.g. {'index': 'HNSW32'}
+            for 'faiss', {'M': 32, 'ef_construction': 200, 'ef': 64} for 'hnswlib')
+        :param cache_name: name of the embedding cache used by incremental builds
+            (default is the pipeline name); builds of the same data can share one
+            as long as they do not run at the same time
         :return: dictionary with training results
         """
         # Data validation
-        if not data_file.endswith('.json'):
+        if not data_file.endswith(('.json', '.jsonl')):
             data_file += '.json'
         
         data_path = os.path.join(self.data_dir, data_file)
         if not os.path.exists(data_path):
             raise FileNotFoundError(f"Data file {data_path} not found")
 
-        # Load data
-        with open(data_path, 'r', encoding='utf-8') as f:
-            try:
-                faq = json.load(f)
-            except json.JSONDecodeError as e:
-                raise ValueError(f"JSON format error: {str(e)}")
+        if answer_strategy not in ('last', 'cycle', 'random', 'most_similar'):
+            raise ValueError(f"Invalid strategy: {answer_strategy}")
 
-        # Validate data structure
-        if not isinstance(faq, list):
-            raise ValueError("Data should be an array of objects")
+        if storage_dtype not in STORAGE_DTYPES:
+            raise ValueError(f"Invalid storage dtype: {storage_dtype}")
 
-        # Prepare data with progress bars
-        all_questions = []
-        all_answers = []
-        
-        # Main progress bar for FAQ items
-        faq_iter = tqdm(faq, desc="Processing FAQ items", disable=not show_progress)
-        for item in faq_iter:
-            if not all(k in item for k in ['questions', 'answers']):
-                raise ValueError("Each item must contain 'questions' and 'answers'")
-            
-            answers = item['answers']
-            questions = item['questions']
-            
-            if not answers:
-                raise ValueError("Answer list cannot be empty")
-            
-            # Nested progress bar for questions
-            questions_iter = tqdm(questions, desc="   Processing questions", 
-                                leave=False, disable=not show_progress)
-            for i, question in enumerate(questions_iter):
-                all_questions.append(question)
-                
-                # Select answer by strategy
-                if answer_strategy == 'last':
-                    answer = answers[i] if i < len(answers) else answers[-1]
-                elif answer_strategy == 'cycle':
-                    answer = answers[i % len(answers)]
-                elif answer_strategy == 'random':
-                    answer = random.choice(answers)
-                elif answer_strategy == 'most_similar':
-                    answer_embeddings = self._get_embeddings(answers)
-                    question_embedding = self.model.encode(question, convert_to_tensor=True)
-                    similarities = util.cos_sim(question_embedding, answer_embeddings)[0]
-                    answer = answers[similarities.argmax().item()]
-                else:
-                    raise ValueError(f"Invalid strategy: {answer_strategy}")
-                
-                all_answers.append(answer)
+        if search_backend is None:
+            search_backend = 'ivf' if ann_index else 'blocked'
+        if search_backend not in SEARCH_BACKENDS:
+            raise ValueError(f"Invalid search backend: {search_backend}")
+        # Fail before encoding, not when the index is built at the end
+        SEARCH_BACKENDS[search_backend].check_available()
+        if search_backend == 'ivf':
+            ann_index = True
 
-        if not all_questions:
+        # First pass: validate the data and count questions without keeping it in memory
+        total_questions = 0
+        for item in self._iter_faq_items(data_path):
+            total_questions += len(item['questions'])
+
+        if not total_questions:
             raise ValueError("No questions found for training")
 
-        # Encode questions with chunked progress bar
-        question_embeddings = []
-        chunks = [all_questions[i:i + chunk_size] for i in range(0, len(all_questions), chunk_size)]
-        
-        encoding_iter = tqdm(chunks, desc="Encoding questions", disable=not show_progress)
-        for chunk in encoding_iter:
-            question_embeddings.extend(self.model.encode(chunk))
-        
-        question_embeddings = np.array(question_embeddings)
+        # Embedding store of the previous build
+        store = None
+        self._encoded_count = 0
+        self._reused_count = 0
+        self._encode_seconds = 0.0
+        self._encode_stats = {}
+        if incremental:
+            store = EmbeddingStore(
+                os.path.join(self.cache_dir, cache_name or model_name),
+                EmbeddingStore.model_key(
+                    model=self.model_name,
+                    max_seq_length=self.model.max_seq_length,
+                    embedding_dim=self.model.get_sentence_embedding_dimension(),
+                    normalized=True
+                )
+            )
 
-        # Create model folder
+        # Create model folder; the build is written to a staging folder inside it
+        # and published at the end, so a running pipeline never reloads a mix of builds
         model_dir = os.path.join(self.pipeline_dir, model_name)
-        Path(model_dir).mkdir(parents=True, exist_ok=True)
-        
+        staging_dir = os.path.join(model_dir, STAGING_DIR)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        Path(staging_dir).mkdir(parents=True)
+        embeddings_path = os.path.join(staging_dir, 'question_embeddings.npy')
+
+        # Second pass: encode the data in bounded windows written straight to disk
+        if num_workers > 1:
+            print(f"Starting {num_workers} encoding workers...")
+            self._pool = EncodingPool(self.model_source, num_workers, threads_per_worker)
+        try:
+            all_questions = []
+            all_answers = []
+            answer_embeddings = {}
+            question_embeddings = None
+            row = 0
+            window = []
+            window_size = 0
+
+            encoding_iter = tqdm(total=total_questions, desc="Encoding questions", disable=not show_progress)
+            items = self._iter_faq_items(data_path)
+            while True:
+                item = next(items, None)
+                if item is not None:
+                    window.append(item)
+                    window_size += len(item['questions'])
+                    if window_size < stream_batch_size:
+                        continue
+                if not window:
+                    break
+
+                questions, answers, embeddings = self._process_window(
+                    window, answer_strategy, chunk_size, store, answer_embeddings
+                )
+                if questions:
+                    if question_embeddings is None:
+                        question_embeddings = np.lib.format.open_memmap(
+                            embeddings_path, mode='w+', dtype=np.float32,
+                            shape=(total_questions, embeddings.shape[1])
+                        )
+                    question_embeddings[row:row + len(embeddings)] = embeddings
+                    row += len(embeddings)
+                all_questions.extend(questions)
+                all_answers.extend(answers)
+                encoding_iter.update(len(questions))
+                window = []
+                window_size = 0
+            encoding_iter.close()
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+
+        sentences_per_second = (self._encoded_count / self._encode_seconds
+                                if self._encode_seconds > 0 else 0.0)
+        tokens_per_second = (self._encode_stats.get('tokens', 0) / self._encode_seconds
+                             if self._encode_seconds > 0 else 0.0)
+        padding_efficiency = (self._encode_stats['tokens'] / self._encode_stats['padded_tokens']
+                              if self._encode_stats.get('padded_tokens') else 1.0)
+        unsorted_padding_efficiency = (self._encode_stats['tokens'] / self._encode_stats['unsorted_padded_tokens']
+                                       if self._encode_stats.get('unsorted_padded_tokens') else 1.0)
+        print(f"Encoding throughput: {sentences_per_second:.1f} sentences/s, {tokens_per_second:.1f} tokens/s")
+        print(f"Padding efficiency: {padding_efficiency:.1%} (file order would be {unsorted_padding_efficiency:.1%})")
+
         # Save results
         print(f"Saving pipeline...")
-        np.save(os.path.join(model_dir, 'question_embeddings.npy'), question_embeddings)
-        with open(os.path.join(model_dir, 'answers.json'), 'w', encoding='utf-8') as f:
-            json.dump(all_answers, f, ensure_ascii=False, indent=2)
+        question_embeddings.flush()
+        del question_embeddings
+        question_embeddings = np.load(embeddings_path, mmap_mode='r')
+
+        # Answers are stored once each; every row points into the table
+        answer_table = {}
+        answer_ids = np.array([answer_table.setdefault(a, len(answer_table)) for a in all_answers],
+                              dtype=np.int32)
+        np.save(os.path.join(staging_dir, 'answer_ids.npy'), answer_ids)
+        with open(os.path.join(staging_dir, 'answers.json'), 'w', encoding='utf-8') as f:
+            json.dump(list(answer_table), f, ensure_ascii=False, indent=2)
+        with open(os.path.join(staging_dir, 'questions.json'), 'w', encoding='utf-8') as f:
+            json.dump(all_questions, f, ensure_ascii=False)
+
+        if store is not None:
+            store.write(
+                ([EmbeddingStore.text_key(q) for q in all_questions], question_embeddings),
+                ([EmbeddingStore.text_key(a) for a in answer_embeddings],
+                 np.asarray(list(answer_embeddings.values()), dtype=np.float32))
+            )
+            print(f"Encoded {self._encoded_count} texts, reused {self._reused_count} from the previous build")
+
+        # Build the approximate nearest-neighbour index
+        ann_meta = None
+        if ann_index:
+            ann_params = ann_params or {}
+            print("Building ANN index...")
+            index = IVFIndex.build(
+                question_embeddings,
+                n_lists=ann_params.get('n_lists'),
+                n_probe=ann_params.get('n_probe', 8),
+                n_iter=ann_params.get('n_iter', 10)
+            )
+            index.save(os.path.join(staging_dir, 'ann_index.npz'))
+            recall = index.recall_at_1(question_embeddings)
+            print(f"ANN index recall@1 vs exact search: {recall:.4f}")
+            ann_meta = {
+                'type': 'ivf',
+                'file': 'ann_index.npz',
+                'n_lists': index.n_lists,
+                'n_probe': index.n_probe,
+                'recall_at_1': recall
+            }
+
+        # Build the index of the search backend
+        backend_params = dict(search_params or {})
+        if SEARCH_BACKENDS[search_backend].files:
+            print(f"Building {search_backend} index...")
+            backend_params = SEARCH_BACKENDS[search_backend].build(question_embeddings, staging_dir,
+                                                                   **backend_params)
+        backend_meta = {'name': search_backend, 'params': backend_params}
+
+        # Build the lexical (BM25) index
+        lexical_meta = None
+        if lexical_index:
+            print("Building lexical index...")
+            index = BM25Index.build(all_questions)
+            index.save(os.path.join(staging_dir, 'lexical_index.npz'))
+            lexical_meta = {
+                'type': 'bm25',
+                'file': 'lexical_index.npz',
+                'terms': len(index.terms),
+                'postings': len(index.doc_ids)
+            }
         
         # Save the model
-        model_files_path = os.path.join(model_dir, 'model_files')
-        self.model.save(model_files_path)
+        model_files_path = os.path.join(staging_dir, 'model_files')
+        with self._model_lock:
+            self.model.save(model_files_path)
+
+        # Export the encoder to ONNX
+        onnx_meta = None
+        if export_onnx or onnx_quantization:
+            onnx_meta = self._export_onnx(model_files_path, onnx_quantization,
+                                          all_questions, question_embeddings)
+
+        # Convert the embeddings to the storage format
+        embedding_shape = question_embeddings.shape
+        del question_embeddings
+        storage_bytes = self._convert_storage(staging_dir, storage_dtype)
         
         # Get model name safely
         try:
@@ -232,37 +422,458 @@ class Education:
             base_model_name = "unknown_model"
 
         # Model metadata
+        build_version = datetime.now().strftime('%Y%m%d-%H%M%S-') + os.urandom(3).hex()
         meta = {
+            'build_version': build_version,
             'source_data': data_file,
             'questions_count': len(all_questions),
             'answers_count': len(all_answers),
+            'unique_answers_count': len(answer_table),
+            'answers_format': 'table',
             'model_info': {
                 'name': base_model_name,
                 'source': 'local_hub',
-                'embedding_dim': question_embeddings.shape[1],
+                'embedding_dim': embedding_shape[1],
                 'max_seq_length': self.model.max_seq_length,
-                'model_files_path': 'model_files'
+                'normalized': True,
+                'storage_dtype': storage_dtype,
+                'storage_bytes': storage_bytes,
+                'model_files_path': 'model_files',
+                'onnx': onnx_meta
             },
             'training_params': {
                 'answer_strategy': answer_strategy,
                 'created_at': datetime.now().isoformat(),
-                'chunk_size': chunk_size
+                'chunk_size': chunk_size,
+                'num_workers': num_workers,
+                'sentences_per_second': sentences_per_second,
+                'tokens_per_second': tokens_per_second,
+                'padding_efficiency': padding_efficiency
             }
         }
+        if ann_meta:
+            meta['ann_index'] = ann_meta
+        if lexical_meta:
+            meta['lexical_index'] = lexical_meta
+        meta['search_backend'] = backend_meta
+
+        if pack:
+            meta['packed'] = self._pack_corpus(staging_dir)
         
-        with open(os.path.join(model_dir, 'meta.json'), 'w', encoding='utf-8') as f:
-            json.dump(meta, f, indent=2, ensure_ascii=False)
-        
-        self._copy_pipeline_files(model_dir)
+        self._copy_pipeline_files(staging_dir)
+        self._publish_build(staging_dir, model_dir, meta)
+        build_dir = os.path.join(model_dir, BUILDS_DIR, build_version)
 
         return {
             'status': 'success',
             'model_name': model_name,
             'model_dir': model_dir,
-            'model_files_path': model_files_path,
+            'build_dir': build_dir,
+            'model_files_path': os.path.join(build_dir, 'model_files'),
+            'build_version': build_version,
             'questions_processed': len(all_questions),
             'answers_processed': len(all_answers),
-            'embedding_shape': question_embeddings.shape
+            'embedding_shape': embedding_shape,
+            'storage_dtype': storage_dtype,
+            'storage_bytes': storage_bytes,
+            'ann_index': ann_meta,
+            'lexical_index': lexical_meta,
+            'search_backend': search_backend,
+            'onnx': onnx_meta,
+            'encoded_texts': self._encoded_count,
+            'reused_embeddings': self._reused_count,
+            'sentences_per_second': sentences_per_second,
+            'tokens_per_second': tokens_per_second,
+            'padding_efficiency': padding_efficiency,
+            'packed': pack
+        }
+
+    @staticmethod
+    def _publish_build(staging_dir: str, model_dir: str, meta: dict):
+        """
+        Publishes a staged build. The staging folder becomes the build folder
+        ``builds/<build_version>`` and the ``current`` file is replaced to name
+        it, so running pipelines and new imports of the pipeline package switch
+        to the complete new build in one step. The previous build is kept for
+        pipelines that are still loading it; older builds are removed.
+        """
+        with open(os.path.join(staging_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=2, ensure_ascii=False)
+        builds_dir = os.path.join(model_dir, BUILDS_DIR)
+        Path(builds_dir).mkdir(exist_ok=True)
+        os.rename(staging_dir, os.path.join(builds_dir, meta['build_version']))
+
+        previous = current_build_dir(model_dir)
+        current_tmp_path = os.path.join(model_dir, CURRENT_FILE + '.tmp')
+        with open(current_tmp_path, 'w', encoding='utf-8') as f:
+            f.write(meta['build_version'])
+        os.replace(current_tmp_path, os.path.join(model_dir, CURRENT_FILE))
+
+        init_path = os.path.join(model_dir, '__init__.py')
+        if not os.path.exists(init_path) or Path(init_path).read_text(encoding='utf-8') != PACKAGE_INIT:
+            with open(init_path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(PACKAGE_INIT)
+            os.replace(init_path + '.tmp', init_path)
+
+        # Builds made before builds were versioned are kept in the pipeline folder itself
+        legacy_files = ['meta.json', 'pipeline.py', 'server.py', '__main__.py', 'requirements.txt',
+                        'question_embeddings.npy', 'embedding_scales.npy', 'answer_ids.npy', 'answers.json',
+                        'questions.json', 'ann_index.npz', 'lexical_index.npz', PACK_FILE]
+        legacy_files += [file for backend in SEARCH_BACKENDS.values() for file in backend.files]
+        for file in legacy_files:
+            Path(model_dir, file).unlink(missing_ok=True)
+        shutil.rmtree(os.path.join(model_dir, 'model_files'), ignore_errors=True)
+
+        for name in os.listdir(builds_dir):
+            if name not in (meta['build_version'], previous.name):
+                # A build that is still mapped may not be removable (e.g. on Windows)
+                shutil.rmtree(os.path.join(builds_dir, name), ignore_errors=True)
+
+    @staticmethod
+    def _save_array(path: str, array: np.ndarray):
+        """Saves an array through a temporary file, so pipelines memory-mapping the old file keep working."""
+        tmp_path = path[:-len('.npy')] + '.tmp.npy'
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _pack_corpus(model_dir: str) -> str:
+        """
+        Moves the corpus files of a built pipeline into a single packed file.
+
+        :return: name of the packed file
+        """
+        print("Packing pipeline files...")
+        files = {
+            'question_embeddings': 'question_embeddings.npy',
+            'embedding_scales': 'embedding_scales.npy',
+            'answer_ids': 'answer_ids.npy'
+        }
+        arrays = {}
+        for name, file in files.items():
+            path = os.path.join(model_dir, file)
+            if os.path.exists(path):
+                arrays[name] = np.load(path, mmap_mode='r')
+
+        ann_path = os.path.join(model_dir, 'ann_index.npz')
+        if os.path.exists(ann_path):
+            with np.load(ann_path) as data:
+                arrays['ann_centroids'] = data['centroids']
+                arrays['ann_list_offsets'] = data['list_offsets']
+                arrays['ann_list_ids'] = data['list_ids']
+
+        lexical_path = os.path.join(model_dir, 'lexical_index.npz')
+        if os.path.exists(lexical_path):
+            with np.load(lexical_path) as data:
+                for name in data.files:
+                    arrays['lexical_' + name] = data[name]
+
+        header = {}
+        for name in ('answers', 'questions'):
+            with open(os.path.join(model_dir, f'{name}.json'), 'r', encoding='utf-8') as f:
+                header[name] = json.load(f)
+
+        tmp_path = os.path.join(model_dir, PACK_FILE + '.tmp')
+        write_pack(tmp_path, header, arrays)
+        # Release the memory maps before removing the files
+        arrays.clear()
+        os.replace(tmp_path, os.path.join(model_dir, PACK_FILE))
+
+        for file in list(files.values()) + ['ann_index.npz', 'lexical_index.npz', 'answers.json', 'questions.json']:
+            Path(model_dir, file).unlink(missing_ok=True)
+        return PACK_FILE
+
+    @staticmethod
+    def _convert_storage(model_dir: str, storage_dtype: str, block_size: int = 65536) -> int:
+        """
+        Rewrites the float32 embeddings file in the storage format, block by block.
+
+        :return: size of the stored embeddings (and scales) in bytes
+        """
+        embeddings_path = os.path.join(model_dir, 'question_embeddings.npy')
+        scales_path = os.path.join(model_dir, 'embedding_scales.npy')
+        question_embeddings = np.load(embeddings_path, mmap_mode='r')
+
+        if storage_dtype == 'float32':
+            Path(scales_path).unlink(missing_ok=True)
+            return int(question_embeddings.nbytes)
+
+        print(f"Converting embeddings to {storage_dtype}...")
+        n = len(question_embeddings)
+        data_out = scales_out = None
+        tmp_path = os.path.join(model_dir, 'question_embeddings.tmp.npy')
+        for start in range(0, n, block_size):
+            data, scales = EmbeddingMatrix.quantize(question_embeddings[start:start + block_size], storage_dtype)
+            if data_out is None:
+                data_out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=data.dtype,
+                                                     shape=(n, data.shape[1]))
+                if scales is not None:
+                    scales_out = np.empty(n, dtype=np.float32)
+            data_out[start:start + len(data)] = data
+            if scales is not None:
+                scales_out[start:start + len(data)] = scales
+
+        storage_bytes = int(data_out.nbytes)
+        data_out.flush()
+        # Release both memory maps before replacing the file
+        del data_out, question_embeddings
+        os.replace(tmp_path, embeddings_path)
+        if scales_out is not None:
+            Education._save_array(scales_path, scales_out)
+            storage_bytes += int(scales_out.nbytes)
+        else:
+            Path(scales_path).unlink(missing_ok=True)
+        return storage_bytes
+
+    @staticmethod
+    def _iter_json_array(f, block_size: int = 1 << 20):
+        """Yields the elements of a JSON array one by one without loading the whole file."""
+        decoder = json.JSONDecoder()
+        buffer = f.read(block_size)
+        pos = 0
+        eof = not buffer
+
+        def peek() -> str:
+            """Skips whitespace and returns the next character ('' at the end of the file)."""
+            nonlocal buffer, pos, eof
+            while True:
+                while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    return buffer[pos] if pos < len(buffer) else ''
+                buffer, pos = f.read(block_size), 0
+                eof = not buffer
+
+        if peek() != '[':
+            raise ValueError("Data should be an array of objects")
+        pos += 1
+        if peek() == ']':
+            pos += 1
+        else:
+            while True:
+                if peek() in (']', ''):
+                    raise ValueError("JSON format error: expecting value")
+                try:
+                    element, end = decoder.raw_decode(buffer, pos)
+                    # A number that runs to the end of the block may continue in the next one
+                    complete = eof or not isinstance(element, (int, float)) or \
+                        any(char not in '0123456789+-.eE' for char in buffer[end:])
+                except json.JSONDecodeError as e:
+                    if eof:
+                        raise ValueError(f"JSON format error: {str(e)}")
+                    complete = False
+                if not complete:
+                    # The element continues in the next block
+                    more = f.read(block_size)
+                    eof = not more
+                    buffer, pos = buffer[pos:] + more, 0
+                    continue
+                yield element
+                pos = end
+
+                # Elements are separated by exactly one comma
+                char = peek()
+                pos += 1
+                if char == ']':
+                    break
+                if char != ',':
+                    raise ValueError("JSON format error: expecting ',' delimiter" if char
+                                     else "JSON format error: unterminated array")
+
+        if peek():
+            raise ValueError("JSON format error: extra data after the array")
+
+    def _iter_faq_items(self, data_path: str):
+        """
+        Yields validated FAQ items from a JSON array or JSONL file, reading it incrementally.
+        """
+        with open(data_path, 'r', encoding='utf-8') as f:
+            if data_path.endswith('.jsonl'):
+                items = (json.loads(line) for line in f if line.strip())
+            else:
+                items = self._iter_json_array(f)
+
+            try:
+                for item in items:
+                    if not isinstance(item, dict):
+                        raise ValueError("Data should be an array of objects")
+                    if not all(k in item for k in ['questions', 'answers']):
+                        raise ValueError("Each item must contain 'questions' and 'answers'")
+                    if not item['answers']:
+                        raise ValueError("Answer list cannot be empty")
+                    yield item
+            except json.JSONDecodeError as e:
+                raise ValueError(f"JSON format error: {str(e)}")
+
+    def _process_window(self, window: list, answer_strategy: str, chunk_size: int,
+                        store: Optional[EmbeddingStore], answer_embeddings: Dict[str, np.ndarray]):
+        """
+        Assigns answers to the questions of a window of FAQ items and encodes them.
+
+        :param window: FAQ items
+        :param answer_strategy: answer selection strategy
+        :param chunk_size: batch size for encoding
+        :param store: embedding store of the previous build
+        :param answer_embeddings: answer embeddings encoded so far ('most_similar' only)
+        :return: (questions, answers, normalized question embeddings)
+        """
+        questions = []
+        answers = []
+        for item in window:
+            item_answers = item['answers']
+            for i, question in enumerate(item['questions']):
+                questions.append(question)
+
+                # Select answer by strategy ('most_similar' is assigned after encoding)
+                if answer_strategy == 'last':
+                    answer = item_answers[i] if i < len(item_answers) else item_answers[-1]
+                elif answer_strategy == 'cycle':
+                    answer = item_answers[i % len(item_answers)]
+                elif answer_strategy == 'random':
+                    answer = random.choice(item_answers)
+                else:
+                    answer = None
+
+                answers.append(answer)
+
+        embeddings = self._encode(questions, chunk_size, store)
+
+        if answer_strategy == 'most_similar':
+            self._assign_most_similar(window, answers, embeddings, chunk_size,
+                                      store, answer_embeddings)
+
+        return questions, answers, embeddings
+
+    def _encode(self, texts: List[str], chunk_size: int,
+                store: Optional[EmbeddingStore] = None) -> np.ndarray:
+        """
+        Encodes texts in chunks. With a store, only texts missing from it are
+        encoded and the rest are taken from the store.
+
+        :return: normalized float32 embeddings of shape (len(texts), dim)
+        """
+        if store is None:
+            self._encoded_count += len(texts)
+            return self._encode_texts(texts, chunk_size)
+
+        keys = [EmbeddingStore.text_key(t) for t in texts]
+        missing = {}
+        for i, key in enumerate(keys):
+            if key not in store:
+                missing.setdefault(key, []).append(i)
+        if not missing:
+            self._reused_count += len(texts)
+            return store.get_many(keys)
+
+        encoded = self._encode_texts([texts[rows[0]] for rows in missing.values()], chunk_size)
+        embeddings = np.empty((len(texts), encoded.shape[1]), dtype=np.float32)
+        for vector, rows in zip(encoded, missing.values()):
+            embeddings[rows] = vector
+        found = [i for i, key in enumerate(keys) if key not in missing]
+        if found:
+            embeddings[found] = store.get_many([keys[i] for i in found])
+
+        self._encoded_count += len(missing)
+        self._reused_count += len(found)
+        return embeddings
+
+    def _encode_texts(self, texts: List[str], chunk_size: int) -> np.ndarray:
+        """
+        Encodes texts with the model in chunks.
+
+        :return: normalized float32 embeddings of shape (len(texts), dim)
+        """
+        start = time.perf_counter()
+        # Batches are formed from texts of similar token length to reduce padding
+        encode = (lambda sorted_texts: self._pool.encode(sorted_texts, chunk_size)) if self._pool else None
+        with self._model_lock:
+            embeddings, stats = encode_length_bucketed(self.model, texts, chunk_size, encode=encode)
+        self._encode_seconds += time.perf_counter() - start
+        for key, value in stats.items():
+            self._encode_stats[key] = self._encode_stats.get(key, 0) + value
+
+        # Stored as unit-length float32, so the runtime scores with a plain dot product
+        return np.asarray(embeddings, dtype=np.float32)
+
+    def _assign_most_similar(self, items: list, answers: list, question_embeddings: np.ndarray,
+                             chunk_size: int, store: Optional[EmbeddingStore],
+                             answer_embeddings: Dict[str, np.ndarray]):
+        """
+        Assigns each question the most similar answer of its FAQ item.
+
+        Every distinct answer is encoded once; each item is resolved with one
+        similarity matrix between its questions and its answers.
+
+        :param items: FAQ items
+        :param answers: answer list to fill, one entry per question of the items
+        :param question_embeddings: normalized question embeddings of the items
+        :param store: embedding store of the previous build
+        :param answer_embeddings: answer embeddings encoded so far, updated in place
+        """
+        new_answers = list(dict.fromkeys(
+            a for item in items for a in item['answers'] if a not in answer_embeddings
+        ))
+        if new_answers:
+            encoded = self._encode(new_answers, chunk_size, store)
+            answer_embeddings.update(zip(new_answers, encoded))
+
+        start = 0
+        for item in items:
+            end = start + len(item['questions'])
+            if start == end:
+                continue
+            item_answers = np.stack([answer_embeddings[a] for a in item['answers']])
+            best = np.argmax(question_embeddings[start:end] @ item_answers.T, axis=1)
+            answers[start:end] = [item['answers'][j] for j in best]
+            start = end
+
+    def _export_onnx(self, model_files_path: str, quantization: Optional[str],
+                     questions: List[str], question_embeddings: np.ndarray,
+                     parity_sample: int = 1000) -> Dict:
+        """
+        Exports the saved model to ONNX (optionally int8-quantized) and checks
+        that its embeddings match the torch model on the training questions.
+
+        :param model_files_path: folder with the saved model
+        :param quantization: dynamic quantization config or None
+        :param questions: training questions
+        :param question_embeddings: normalized torch embeddings of the questions
+        :param parity_sample: maximum number of questions used for the parity check
+        :return: ONNX metadata for meta.json
+        """
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+
+        print("Exporting the encoder to ONNX...")
+        onnx_model = SentenceTransformer(model_files_path, backend='onnx')
+        onnx_model.save(model_files_path)
+        file_name = 'onnx/model.onnx'
+
+        if quantization:
+            print(f"Quantizing the ONNX encoder ({quantization})...")
+            export_dynamic_quantized_onnx_model(onnx_model, quantization, model_files_path)
+            file_name = f'onnx/model_qint8_{quantization}.onnx'
+            onnx_model = SentenceTransformer(model_files_path, backend='onnx',
+                                             model_kwargs={'file_name': file_name})
+
+        if not Path(model_files_path, file_name).exists():
+            raise FileNotFoundError(f"ONNX export did not produce {file_name}")
+
+        # Parity check against the torch embeddings
+        step = max(1, len(questions) // parity_sample)
+        sample = list(range(0, len(questions), step))[:parity_sample]
+        onnx_embeddings = onnx_model.encode([questions[i] for i in sample], normalize_embeddings=True)
+        cosine = np.sum(np.asarray(onnx_embeddings, dtype=np.float32) * question_embeddings[sample], axis=1)
+        drift = 1.0 - cosine
+        print(f"ONNX cosine drift vs torch: mean {drift.mean():.6f}, max {drift.max():.6f}")
+
+        return {
+            'file_name': file_name,
+            'quantization': quantization,
+            'parity': {
+                'sample_size': len(sample),
+                'mean_cosine_drift': float(drift.mean()),
+                'max_cosine_drift': float(drift.max())
+            }
         }
 
     def update_answers(self, new_answers: List[str]):
@@ -275,7 +886,7 @@ class Education:
         models = []
         for model_dir in Path(self.pipeline_dir).iterdir():
             if model_dir.is_dir():
-                meta_path = model_dir / 'meta.json'
+                meta_path = current_build_dir(model_dir) / 'meta.json'
                 if meta_path.exists():
                     with open(meta_path, 'r', encoding='utf-8') as f:
                         try:
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+
+class EmbeddingStore:
+    """
+    Content-addressed store of text embeddings persisted on disk.
+
+    Vectors are keyed by the SHA-256 of the text and are only valid for the
+    model identity the store was created with; a store opened with another
+    model identity starts empty.
+    """
+
+    def __init__(self, store_dir: str, model_key: str):
+        """
+        :param store_dir: Folder of the store
+        :param model_key: Model identity (see ``model_key``)
+        """
+        self.store_dir = Path(store_dir)
+        self.model_key = model_key
+        self._rows: Dict[bytes, int] = {}
+        self._vectors = None
+        self._load()
+
+    @staticmethod
+    def model_key(**model_info) -> str:
+        """Returns a short hash identifying the model and encoding settings."""
+        data = json.dumps(model_info, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def text_key(text: str) -> bytes:
+        """Returns the content key of a text."""
+        return hashlib.sha256(text.encode('utf-8')).digest()
+
+    def _load(self):
+        """Loads the store if it exists, is complete and belongs to the same model."""
+        meta_path = self.store_dir / 'store_meta.json'
+        if not meta_path.exists():
+            return
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('model_key') != self.model_key:
+                return
+            keys = np.load(self.store_dir / 'keys.npy')
+            vectors = np.load(self.store_dir / 'vectors.npy', mmap_mode='r')
+            # Keys are raw 32-byte digests; stores written with 'S32' keys lost trailing NUL bytes
+            if keys.dtype != np.uint8 or keys.ndim != 2 or keys.shape[1] != 32:
+                raise ValueError("outdated key format")
+            if not len(keys) == len(vectors) == meta.get('size'):
+                raise ValueError("keys, vectors and metadata do not match")
+        except (OSError, ValueError, json.JSONDecodeError) as e:
+            print(f"Embedding store {self.store_dir} is unreadable and will be rebuilt: {str(e)}")
+            return
+        self._vectors = vectors
+        self._rows = {key.tobytes(): i for i, key in enumerate(keys)}
+
+    def __contains__(self, key: bytes) -> bool:
+        return key in self._rows
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def get_many(self, keys: List[bytes]) -> np.ndarray:
+        """
+        Returns the vectors of the given keys as a float32 matrix.
+
+        :raises KeyError: if a key is not in the store
+        """
+        if not keys:
+            dim = self._vectors.shape[1] if self._vectors is not None else 0
+            return np.empty((0, dim), dtype=np.float32)
+        rows = np.fromiter((self._rows[key] for key in keys), dtype=np.int64, count=len(keys))
+        return np.asarray(self._vectors[rows], dtype=np.float32)
+
+    def write(self, *parts: Tuple[List[bytes], np.ndarray], block_size: int = 65536):
+        """
+        Replaces the store contents with the given texts' vectors, so vectors
+        of deleted texts are dropped. Duplicate keys are written once.
+
+        :param parts: (keys, vectors) pairs; vectors may be memory-mapped
+        :param block_size: rows copied per block (bounds peak memory)
+        """
+        seen = set()
+        selected = []
+        for keys, vectors in parts:
+            rows = []
+            for i, key in enumerate(keys):
+                if key not in seen:
+                    seen.add(key)
+                    rows.append(i)
+            selected.append((keys, vectors, np.array(rows, dtype=np.int64)))
+
+        dim = next((v.shape[1] for _, v, rows in selected if len(rows)), 0)
+        total = sum(len(rows) for _, _, rows in selected)
+
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        keys_out = np.empty((total, 32), dtype=np.uint8)
+        vectors_tmp_path = self.store_dir / 'vectors.tmp.npy'
+        vectors_out = np.lib.format.open_memmap(vectors_tmp_path, mode='w+',
+                                                dtype=np.float32, shape=(total, dim))
+        offset = 0
+        for keys, vectors, rows in selected:
+            for start in range(0, len(rows), block_size):
+                block = rows[start:start + block_size]
+                vectors_out[offset:offset + len(block)] = vectors[block]
+                keys_out[offset:offset + len(block)] = np.frombuffer(
+                    b''.join(keys[i] for i in block), dtype=np.uint8).reshape(-1, 32)
+                offset += len(block)
+        vectors_out.flush()
+        del vectors_out
+
+        keys_tmp_path = self.store_dir / 'keys.tmp.npy'
+        np.save(keys_tmp_path, keys_out)
+        meta_tmp_path = self.store_dir / 'store_meta.json.tmp'
+        with open(meta_tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'model_key': self.model_key, 'size': total}, f, indent=2)
+
+        # The metadata is removed first and written last: a store interrupted
+        # between the replacements has no metadata and is rebuilt from scratch
+        self._vectors = None
+        meta_path = self.store_dir / 'store_meta.json'
+        meta_path.unlink(missing_ok=True)
+        os.replace(vectors_tmp_path, self.store_dir / 'vectors.npy')
+        os.replace(keys_tmp_path, self.store_dir / 'keys.npy')
+        os.replace(meta_tmp_path, meta_path)
+
+        self._rows = {key.tobytes(): i for i, key in enumerate(keys_out)}
+        self._vectors = np.load(self.store_dir / 'vectors.npy', mmap_mode='r')
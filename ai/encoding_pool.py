@@ -0,0 +1,70 @@
+import multiprocessing
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+# Model of the current worker process
+_worker_model = None
+
+
+def _init_worker(model_source: str, threads: int):
+    """Loads the model once per worker process and limits its torch threads."""
+    global _worker_model
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(threads)
+    _worker_model = SentenceTransformer(model_source, device='cpu')
+
+
+def _encode_chunk(texts: List[str]) -> np.ndarray:
+    return np.asarray(_worker_model.encode(texts, normalize_embeddings=True), dtype=np.float32)
+
+
+class EncodingPool:
+    """
+    Pool of CPU worker processes, each with its own copy of the model,
+    that encodes chunks in parallel and returns them in order.
+
+    Workers are spawned rather than forked: a forked child inherits torch's
+    thread pools (and any lock held by another thread) from a parent that has
+    already loaded the model, and can deadlock.
+    """
+
+    def __init__(self, model_source: str, num_workers: int,
+                 threads_per_worker: Optional[int] = None):
+        """
+        :param model_source: Model name or local path the workers load the model from
+        :param num_workers: Number of worker processes
+        :param threads_per_worker: torch intra-op threads per worker
+            (default is the CPU count divided by the number of workers)
+        """
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // num_workers)
+        self._executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(model_source, self.threads_per_worker)
+        )
+
+    def encode(self, texts: List[str], chunk_size: int) -> np.ndarray:
+        """
+        Encodes texts in chunks spread across the workers.
+
+        :return: normalized float32 embeddings in the order of ``texts``
+        """
+        chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        results = list(self._executor.map(_encode_chunk, chunks))
+        return np.concatenate(results) if results else np.empty((0, 0), dtype=np.float32)
+
+    def close(self):
+        """Stops the worker processes."""
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,354 @@
+"""
+Offline evaluation of built pipelines on a labelled query file.
+
+    python -m ai.evaluation queries.jsonl faq_cycle faq_most_similar --min-precision 0.9 --output report.json
+
+Each labelled query has the expected answer text; queries without one are
+out of scope and should not be answered:
+
+    {"question": "Forgot password", "answer": "Use the \\"Forgot password\\" link on the login page."}
+    {"question": "Where is my parcel?", "answers": ["Track it in your account.", "Call us."]}
+    {"question": "What is the weather today?", "answer": null}
+
+JSON arrays, JSON Lines and CSV files (columns ``question`` and ``answer``) are read.
+"""
+import argparse
+import csv
+import json
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from ai.pipeline import encode_length_bucketed, encoder_key
+from ai.pipeline_tester import PipelineTester
+
+DEFAULT_THRESHOLDS = np.round(np.arange(0.0, 1.0001, 0.01), 2)
+
+
+def load_labelled_queries(path) -> list:
+    """
+    Reads a labelled query file.
+
+    :return: [{'question': str, 'answers': [str, ...]}, ...] (empty answers - out of scope)
+    """
+    path = Path(path)
+    if not path.exists():
+        raise FileNotFoundError(f"Query file {path} not found")
+
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if path.suffix.lower() == '.csv':
+            records = list(csv.DictReader(f))
+        elif path.suffix.lower() == '.jsonl':
+            records = [json.loads(line) for line in f if line.strip()]
+        else:
+            records = json.load(f)
+
+    queries = []
+    for i, record in enumerate(records):
+        question = record.get('question')
+        if not isinstance(question, str) or not question.strip():
+            raise ValueError(f"Query {i} has no question")
+        answers = record.get('answers', record.get('answer'))
+        if answers is None or answers == '':
+            answers = []
+        elif isinstance(answers, str):
+            answers = [answers]
+        queries.append({'question': question, 'answers': [a.strip() for a in answers]})
+    return queries
+
+
+def sweep_thresholds(scores: np.ndarray, correct: np.ndarray, in_scope: np.ndarray,
+                     thresholds=DEFAULT_THRESHOLDS) -> dict:
+    """
+    Quality of the best answers at every threshold (a query is answered when its score is above it).
+
+    All thresholds are evaluated at once from the sorted scores, so the cost
+    does not grow with the number of queries times thresholds.
+
+    :param scores: Best similarity of each query
+    :param correct: Whether the best answer of each query is an expected one
+    :param in_scope: Whether each query has an expected answer
+    :param thresholds: Thresholds to evaluate
+    :return: {
+        'threshold': [...],
+        'precision': [...] (correct answers among the given ones, None when nothing is answered),
+        'recall': [...] (in-scope queries answered correctly),
+        'coverage': [...] (queries answered),
+        'false_accept_rate': [...] (out-of-scope queries answered),
+        'f1': [...]
+    }
+    """
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    order = np.argsort(scores, kind='stable')
+    n = len(scores)
+
+    # Queries answered at a threshold are a suffix of the sorted scores
+    positions = np.searchsorted(scores[order], thresholds, side='right')
+    suffix = lambda flags: np.concatenate([np.cumsum(flags[order][::-1])[::-1], [0]])[positions]
+    answered = n - positions
+    answered_correct = suffix(correct.astype(np.int64))
+    answered_out_of_scope = suffix((~in_scope).astype(np.int64))
+
+    n_in_scope = int(in_scope.sum())
+    n_out_of_scope = n - n_in_scope
+    with np.errstate(invalid='ignore', divide='ignore'):
+        precision = np.where(answered > 0, answered_correct / np.maximum(answered, 1), np.nan)
+        recall = answered_correct / n_in_scope if n_in_scope else np.full(len(thresholds), np.nan)
+        f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+    coverage = answered / n if n else np.zeros(len(thresholds))
+    false_accept_rate = (answered_out_of_scope / n_out_of_scope if n_out_of_scope
+                         else np.full(len(thresholds), np.nan))
+
+    as_list = lambda values: [None if np.isnan(v) else round(float(v), 6) for v in values]
+    return {
+        'threshold': [float(t) for t in thresholds],
+        'precision': as_list(precision),
+        'recall': as_list(recall),
+        'coverage': as_list(coverage),
+        'false_accept_rate': as_list(false_accept_rate),
+        'f1': as_list(f1)
+    }
+
+
+def curve_row(curve: dict, index: int) -> dict:
+    """One threshold of a curve as {'threshold', 'precision', ...}."""
+    return {name: values[index] for name, values in curve.items()}
+
+
+def recommend_threshold(curve: dict, min_precision: Optional[float] = None) -> dict:
+    """
+    Picks a threshold from a curve of ``sweep_thresholds``.
+
+    :param min_precision: Take the lowest threshold (highest recall) whose precision
+        reaches this value; by default (or if no threshold reaches it) the threshold
+        with the best F1 is taken
+    :return: The curve row of the threshold plus 'criterion'
+    """
+    if min_precision is not None:
+        candidates = [i for i, p in enumerate(curve['precision']) if p is not None and p >= min_precision]
+        if candidates:
+            return {**curve_row(curve, min(candidates)), 'criterion': f'precision>={min_precision}'}
+    f1 = [v or 0.0 for v in curve['f1']]
+    # The highest of equally good thresholds answers fewer out-of-scope queries
+    best = max(range(len(f1)), key=lambda i: (f1[i], curve['threshold'][i]))
+    return {**curve_row(curve, best), 'criterion': 'f1'}
+
+
+def encode_queries(tester: PipelineTester, questions: list, batch_size: int = 64):
+    """
+    Encodes the queries in length-bucketed batches.
+
+    :return: (normalized float32 embeddings, seconds)
+    """
+    start = time.perf_counter()
+    embeddings, _ = encode_length_bucketed(tester.model, questions, batch_size)
+    return embeddings, time.perf_counter() - start
+
+
+def evaluate(tester: PipelineTester, queries: list, thresholds=DEFAULT_THRESHOLDS,
+             batch_size: int = 64, search_batch_size: int = 1024, min_precision: Optional[float] = None,
+             latency_sample: int = 100, embeddings: Optional[np.ndarray] = None,
+             encode_seconds: Optional[float] = None) -> dict:
+    """
+    Evaluates a pipeline on labelled queries.
+
+    The queries are encoded in batches and searched once, as the tester
+    searches (see ``PipelineTester.retrieve``); every threshold is then
+    evaluated on the best scores without querying again.
+
+    :param tester: PipelineTester of the pipeline
+    :param queries: Labelled queries (see ``load_labelled_queries``)
+    :param thresholds: Thresholds of the curve
+    :param batch_size: Encoding batch size
+    :param search_batch_size: Number of queries searched at once
+    :param min_precision: Precision target of the recommended threshold (see ``recommend_threshold``)
+    :param latency_sample: Number of queries timed one by one, as a served pipeline answers them
+    :param embeddings: Query embeddings computed with the same model (skips encoding)
+    :param encode_seconds: Time it took to compute ``embeddings``
+    :return: {
+        'pipeline': str,
+        'retrieval': 'dense'|'rrf'|'weighted' (see ``PipelineTester.retrieval``),
+        'queries': int, 'in_scope': int, 'out_of_scope': int,
+        'unknown_answers': int (in-scope queries none of whose answers is in the pipeline),
+        'accuracy_at_1': float|None (in-scope queries whose best answer is expected, any score),
+        'curve': see ``sweep_thresholds``,
+        'recommended': see ``recommend_threshold``,
+        'current': curve row at the tester threshold,
+        'latency': {...}
+    }
+    """
+    questions = [q['question'] for q in queries]
+    answer_index = {answer.strip(): i for i, answer in enumerate(tester.answers)}
+    expected = [{answer_index[a] for a in q['answers'] if a in answer_index} for q in queries]
+    unknown = sum(bool(q['answers']) and not answers for q, answers in zip(queries, expected))
+
+    if embeddings is None:
+        embeddings, encode_seconds = encode_queries(tester, questions, batch_size)
+
+    start = time.perf_counter()
+    best_ids = np.empty(len(questions), dtype=np.int64)
+    scores = np.empty(len(questions), dtype=np.float32)
+    for i in range(0, len(questions), search_batch_size):
+        ids, batch_scores = tester.retrieve(questions[i:i + search_batch_size], embeddings[i:i + search_batch_size])
+        best_ids[i:i + search_batch_size] = ids[:, 0]
+        scores[i:i + search_batch_size] = batch_scores[:, 0]
+    search_seconds = time.perf_counter() - start
+
+    # Queries without any result (id -1) are never answered
+    predicted = np.where(best_ids >= 0, np.asarray(tester.answer_ids)[np.maximum(best_ids, 0)], -1)
+    correct = np.fromiter((int(p) in answers for p, answers in zip(predicted, expected)),
+                          dtype=bool, count=len(questions))
+    in_scope = np.fromiter((bool(q['answers']) for q in queries), dtype=bool, count=len(queries))
+
+    curve = sweep_thresholds(scores, correct, in_scope, thresholds)
+    current = sweep_thresholds(scores, correct, in_scope, [tester.stats['threshold']])
+    n = len(questions)
+    n_in_scope = int(in_scope.sum())
+
+    latency = {
+        'encode_ms_per_query': encode_seconds * 1000 / n if encode_seconds is not None and n else None,
+        'search_ms_per_query': search_seconds * 1000 / n if n else None
+    }
+    if encode_seconds is not None and n:
+        latency['batch_queries_per_second'] = n / (encode_seconds + search_seconds)
+    if latency_sample:
+        latency['single'] = single_query_latency(tester, questions[:latency_sample])
+
+    return {
+        'pipeline': tester.model_path.name,
+        'retrieval': tester.retrieval,
+        'queries': n,
+        'in_scope': n_in_scope,
+        'out_of_scope': n - n_in_scope,
+        'unknown_answers': unknown,
+        'accuracy_at_1': float(correct.sum() / n_in_scope) if n_in_scope else None,
+        'curve': curve,
+        'recommended': recommend_threshold(curve, min_precision),
+        'current': curve_row(current, 0),
+        'latency': latency
+    }
+
+
+def single_query_latency(tester: PipelineTester, questions: list) -> dict:
+    """Encodes and searches the questions one by one (milliseconds per query)."""
+    samples = []
+    for question in questions:
+        start = time.perf_counter()
+        embedding = tester.model.encode([question], normalize_embeddings=True, convert_to_numpy=True)
+        tester.retrieve([question], np.asarray(embedding, dtype=np.float32))
+        samples.append(time.perf_counter() - start)
+    if not samples:
+        return {'calls': 0}
+    ms = np.asarray(samples) * 1000
+    return {
+        'calls': len(samples),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95))
+    }
+
+
+def compare_pipelines(names: list, queries: list, models_path: str = 'build', mmap_mode: str = None,
+                      batch_size: int = 64, fusion: str = None, **params) -> dict:
+    """
+    Evaluates several pipelines on the same queries. Pipelines built on the
+    same model reuse the query embeddings of the first one.
+
+    :param names: Pipeline names
+    :param queries: Labelled queries (see ``load_labelled_queries``)
+    :param models_path: Folder of the built pipelines
+    :param mmap_mode: Memory-map the embeddings (e.g. 'r')
+    :param batch_size: Encoding batch size
+    :param fusion: Dense and BM25 fusion of lexical builds, as served (see ``PipelineTester``)
+    :param params: Options of ``evaluate``
+    :return: {
+        'pipelines': {name: report},
+        'ranking': [{'pipeline', 'threshold', 'f1', 'precision', 'recall', 'coverage'}, ...]
+            (best recommended F1 first)
+    }
+    """
+    questions = [q['question'] for q in queries]
+    reports = {}
+    embeddings_by_model = {}
+    for name in names:
+        tester = PipelineTester(name, models_path, mmap_mode=mmap_mode, metrics=False, fusion=fusion)
+        model_key = encoder_key(tester.meta)
+        if model_key not in embeddings_by_model:
+            embeddings_by_model[model_key] = encode_queries(tester, questions, batch_size)
+        embeddings, encode_seconds = embeddings_by_model[model_key]
+        reports[name] = evaluate(tester, queries, batch_size=batch_size, embeddings=embeddings,
+                                 encode_seconds=encode_seconds, **params)
+        del tester
+
+    ranking = sorted(
+        ({'pipeline': name, **{key: report['recommended'][key]
+                               for key in ('threshold', 'f1', 'precision', 'recall', 'coverage')}}
+         for name, report in reports.items()),
+        key=lambda row: row['f1'] or 0.0, reverse=True
+    )
+    return {'pipelines': reports, 'ranking': ranking}
+
+
+def print_report(report: dict):
+    """Prints a short summary of one pipeline."""
+    recommended = report['recommended']
+    current = report['current']
+    latency = report['latency']
+    fmt = lambda v: '-' if v is None else f'{v:.3f}'
+    print(f"\n{report['pipeline']}: {report['queries']} queries "
+          f"({report['in_scope']} in scope, {report['out_of_scope']} out of scope), {report['retrieval']} retrieval")
+    if report['unknown_answers']:
+        print(f"  {report['unknown_answers']} queries expect answers that are not in the pipeline")
+    print(f"  Accuracy@1: {fmt(report['accuracy_at_1'])}")
+    for label, row in (('Current', current), ('Recommended', recommended)):
+        print(f"  {label} threshold {row['threshold']:.2f}: precision {fmt(row['precision'])}, "
+              f"recall {fmt(row['recall'])}, coverage {fmt(row['coverage'])}, F1 {fmt(row['f1'])}")
+    if latency.get('encode_ms_per_query') is not None:
+        print(f"  Batched: {latency['encode_ms_per_query']:.3f} ms encode + "
+              f"{latency['search_ms_per_query']:.3f} ms search per query")
+    if latency.get('single', {}).get('calls'):
+        single = latency['single']
+        print(f"  One by one: p50 {single['p50_ms']:.2f} ms, p95 {single['p95_ms']:.2f} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ai.evaluation',
+                                     description='Evaluate built pipelines on labelled queries')
+    parser.add_argument('queries', help='Labelled query file (JSON, JSONL or CSV)')
+    parser.add_argument('pipelines', nargs='+', help='Names of the built pipelines')
+    parser.add_argument('--models-path', default='build', help='Folder of the built pipelines')
+    parser.add_argument('--min-precision', type=float, default=None,
+                        help='Recommend the lowest threshold reaching this precision (default: best F1)')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--latency-sample', type=int, default=100,
+                        help='Queries timed one by one (0 to skip)')
+    parser.add_argument('--fusion', choices=['rrf', 'weighted', 'auto'], default=None,
+                        help='Fuse dense and BM25 results of lexical builds as the served pipeline does '
+                             '(default: dense only)')
+    parser.add_argument('--mmap', action='store_const', const='r', default=None,
+                        help='Memory-map the embeddings')
+    parser.add_argument('--output', default=None, help='JSON file for the full report')
+    args = parser.parse_args(argv)
+
+    queries = load_labelled_queries(args.queries)
+    result = compare_pipelines(args.pipelines, queries, args.models_path, args.mmap,
+                               batch_size=args.batch_size, fusion=args.fusion, min_precision=args.min_precision,
+                               latency_sample=args.latency_sample)
+    for report in result['pipelines'].values():
+        print_report(report)
+
+    if len(result['ranking']) > 1:
+        print("\nRanking:")
+        for i, row in enumerate(result['ranking']):
+            print(f"  [{i + 1}] {row['pipeline']} (threshold {row['threshold']:.2f}, F1 {row['f1']:.3f})")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"\nReport saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
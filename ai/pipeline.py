@@ -1,61 +1,2139 @@
 # pipeline.py
+import importlib
 import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
 import numpy as np
 from pathlib import Path
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+
+
+def l2_normalize(embeddings: np.ndarray) -> np.ndarray:
+    """
+    Returns float32 copy of the embeddings scaled to unit length (row-wise).
+
+    :param embeddings: Matrix of shape (n, dim) or a single vector
+    :return: Normalized float32 embeddings
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+
+def current_rss() -> int:
+    """
+    Returns the resident set size of the current process in bytes
+    (peak RSS where the current value is not available, None if unknown).
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        return None
+
+
+def token_lengths(model, texts: list) -> np.ndarray:
+    """
+    Returns the token count of each text (including special tokens, truncated
+    to the model's max_seq_length). Falls back to character counts when the
+    model has no tokenizer.
+    """
+    tokenizer = getattr(model, 'tokenizer', None)
+    if tokenizer is None:
+        return np.array([len(t) for t in texts], dtype=np.int64)
+    encoded = tokenizer(list(texts), add_special_tokens=True, truncation=True,
+                        max_length=model.max_seq_length)
+    return np.array([len(ids) for ids in encoded['input_ids']], dtype=np.int64)
+
+
+def encode_length_bucketed(model, texts: list, batch_size: int, encode=None):
+    """
+    Encodes texts in batches of similar token length, so short texts are not
+    padded up to the longest text of the batch, and returns the embeddings in
+    the original order.
+
+    :param model: SentenceTransformer model
+    :param texts: Texts to encode
+    :param batch_size: Number of texts per batch
+    :param encode: Optional function that encodes a list of length-sorted texts
+        in consecutive batches of ``batch_size`` (e.g. a process pool);
+        by default each batch goes through ``model.encode``
+    :return: (normalized float32 embeddings, stats) where stats is {
+        'sequences': int,
+        'tokens': int,
+        'padded_tokens': int,
+        'unsorted_padded_tokens': int,
+        'tokenize_seconds': float (the length pass),
+        'encode_seconds': float
+    }
+    """
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32), {
+            'sequences': 0, 'tokens': 0, 'padded_tokens': 0, 'unsorted_padded_tokens': 0,
+            'tokenize_seconds': 0.0, 'encode_seconds': 0.0
+        }
+
+    start = time.perf_counter()
+    lengths = token_lengths(model, texts)
+    order = np.argsort(-lengths, kind='stable')
+    sorted_texts = [texts[i] for i in order]
+    tokenized = time.perf_counter()
+
+    if encode is not None:
+        sorted_embeddings = np.asarray(encode(sorted_texts), dtype=np.float32)
+    else:
+        sorted_embeddings = np.concatenate([
+            np.asarray(model.encode(sorted_texts[i:i + batch_size], batch_size=batch_size,
+                                    normalize_embeddings=True, convert_to_numpy=True),
+                       dtype=np.float32)
+            for i in range(0, len(sorted_texts), batch_size)
+        ])
+
+    embeddings = np.empty_like(sorted_embeddings)
+    embeddings[order] = sorted_embeddings
+    encoded = time.perf_counter()
+
+    def padded(batch_lengths):
+        return int(sum(batch_lengths[i:i + batch_size].max() * len(batch_lengths[i:i + batch_size])
+                       for i in range(0, len(batch_lengths), batch_size)))
+
+    stats = {
+        'sequences': len(texts),
+        'tokens': int(lengths.sum()),
+        'padded_tokens': padded(lengths[order]),
+        'unsorted_padded_tokens': padded(lengths),
+        'tokenize_seconds': tokenized - start,
+        'encode_seconds': encoded - tokenized
+    }
+    return embeddings, stats
+
+
+def normalize_question(text: str) -> str:
+    """
+    Normalizes question text for cache and exact-match lookups:
+    case-folded, whitespace collapsed, trailing punctuation removed.
+    """
+    return re.sub(r'\s+', ' ', text.casefold()).strip().rstrip('?!.').rstrip()
+
+
+def load_answers(base_path: Path, meta: dict, mmap_mode: str = None):
+    """
+    Loads the answers of a built pipeline.
+
+    :param base_path: Pipeline folder
+    :param meta: Pipeline metadata
+    :param mmap_mode: Memory-map the row-to-answer array (e.g. 'r')
+    :return: (answers, answer_ids) - the table of unique answers and the int32
+        index of each row's answer in it
+    """
+    with open(base_path / 'answers.json', 'r', encoding='utf-8') as f:
+        answers = json.load(f)
+
+    if meta.get('answers_format') == 'table':
+        return answers, np.load(base_path / 'answer_ids.npy', mmap_mode=mmap_mode)
+
+    # Pipelines built before the answer table store one answer per row
+    table = {}
+    answer_ids = np.array([table.setdefault(a, len(table)) for a in answers], dtype=np.int32)
+    return list(table), answer_ids
+
+
+class QueryCache:
+    """
+    Bounded LRU cache of query results with optional time-to-live.
+    Thread-safe; keys are normalized question texts.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = None):
+        """
+        :param max_size: Maximum number of cached questions (0 disables the cache)
+        :param ttl: Seconds an entry stays valid (None - no expiry)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        """Returns the cached entry or None."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and self.ttl is not None and time.monotonic() - item[0] > self.ttl:
+                del self._data[key]
+                self.evictions += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: str, value):
+        """Stores an entry, evicting the least recently used one when full."""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Removes all entries (counters are kept)."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Latency buckets from 10 microseconds to ~20 seconds, score buckets of 0.05
+LATENCY_BUCKETS = tuple(1e-5 * 2 ** i for i in range(22))
+SCORE_BUCKETS = tuple(round(-1 + 0.05 * i, 2) for i in range(1, 41))
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram; recording a value is a binary search and an
+    increment. Quantiles are interpolated within a bucket.
+    """
+
+    def __init__(self, bounds: tuple, lower: float = 0.0):
+        """
+        :param bounds: Sorted upper bounds of the buckets (values above the last one are counted separately)
+        :param lower: Lower bound of the first bucket
+        """
+        self.bounds = bounds
+        self.lower = lower
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float):
+        """Returns the estimated q-quantile (None when empty)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                low = self.bounds[i - 1] if i > 0 else self.lower
+                return low + (self.bounds[i] - low) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+    def snapshot(self) -> dict:
+        """Returns count, sum, mean, p50/p95/p99 and cumulative bucket counts."""
+        cumulative = np.cumsum(self.counts).tolist()
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': [[bound, c] for bound, c in zip(self.bounds, cumulative)] + [['+Inf', cumulative[-1]]]
+        }
+
+
+class Metrics:
+    """
+    Hot-path metrics: latency histograms per stage, counters and the
+    distribution of best-match scores.
+
+    Snapshots are passed to sinks (callables taking the snapshot dict, e.g.
+    ``JsonFileSink`` or your own callback) every ``flush_every`` queries
+    and on ``flush()``; ``prometheus_text`` formats a snapshot for scraping.
+    """
+
+    STAGES = ('lookup', 'tokenize', 'encode', 'lexical', 'search', 'answer', 'query')
+    COUNTERS = ('queries', 'matches', 'exact_hits', 'cache_hits', 'encoded')
+
+    def __init__(self, sinks: list = None, flush_every: int = 0):
+        """
+        :param sinks: Callables receiving each snapshot
+        :param flush_every: Push a snapshot to the sinks every N queries (0 - only on flush())
+        """
+        self.sinks = list(sinks or [])
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clears all histograms and counters."""
+        with self._lock:
+            self.stages = {stage: Histogram(LATENCY_BUCKETS) for stage in self.STAGES}
+            self.scores = Histogram(SCORE_BUCKETS, lower=-1.0)
+            self.counters = dict.fromkeys(self.COUNTERS, 0)
+            self.started_at = time.time()
+            self._unflushed = 0
+
+    def observe(self, stage: str, seconds: float):
+        """Records the duration of a stage."""
+        with self._lock:
+            self.stages[stage].observe(seconds)
+
+    def increment(self, counter: str, value: int = 1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def record_results(self, scores: list, matches: int):
+        """Records the best scores and the number of matches of answered queries."""
+        with self._lock:
+            for score in scores:
+                if math.isfinite(score):
+                    self.scores.observe(score)
+            self.counters['queries'] += len(scores)
+            self.counters['matches'] += matches
+            self._unflushed += len(scores)
+            flush = self.flush_every and self._unflushed >= self.flush_every
+        if flush:
+            self.flush()
+
+    def snapshot(self) -> dict:
+        """
+        :return: {
+            'uptime_seconds': float,
+            'counters': {'queries', 'matches', 'exact_hits', 'cache_hits', 'encoded'},
+            'match_rate': float,
+            'cache_hit_rate': float (exact-match and cache hits per query),
+            'latency_seconds': {stage: histogram snapshot},
+            'scores': histogram snapshot
+        }
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            queries = counters['queries']
+            return {
+                'uptime_seconds': time.time() - self.started_at,
+                'counters': counters,
+                'match_rate': counters['matches'] / queries if queries else 0,
+                'cache_hit_rate': (counters['exact_hits'] + counters['cache_hits']) / queries if queries else 0,
+                'latency_seconds': {stage: h.snapshot() for stage, h in self.stages.items()},
+                'scores': self.scores.snapshot()
+            }
+
+    def flush(self):
+        """Pushes a snapshot to every sink."""
+        with self._lock:
+            self._unflushed = 0
+        if self.sinks:
+            snapshot = self.snapshot()
+            for sink in self.sinks:
+                sink(snapshot)
+
+
+class JsonFileSink:
+    """Metrics sink that (atomically) rewrites a JSON file with the latest snapshot."""
+
+    def __init__(self, path):
+        self.path = str(path)
+
+    def __call__(self, snapshot: dict):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def prometheus_text(snapshot: dict, prefix: str = 'replycore', labels: dict = None) -> str:
+    """
+    Formats a metrics snapshot in the Prometheus text exposition format.
+
+    :param snapshot: ``Metrics.snapshot()``
+    :param prefix: Metric name prefix
+    :param labels: Labels added to every sample (e.g. {'pipeline': 'faq'})
+    """
+    def fmt(extra=None):
+        items = {**(labels or {}), **(extra or {})}
+        if not items:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in items.items()) + '}'
+
+    def histogram(name, hist, extra=None):
+        rows = [f"{name}_bucket{fmt({**(extra or {}), 'le': str(bound)})} {count}"
+                for bound, count in hist['buckets']]
+        rows.append(f"{name}_sum{fmt(extra)} {hist['sum']}")
+        rows.append(f"{name}_count{fmt(extra)} {hist['count']}")
+        return rows
+
+    lines = []
+    for counter, value in snapshot['counters'].items():
+        lines += [f"# TYPE {prefix}_{counter}_total counter", f"{prefix}_{counter}_total{fmt()} {value}"]
+    for gauge in ('match_rate', 'cache_hit_rate', 'uptime_seconds'):
+        lines += [f"# TYPE {prefix}_{gauge} gauge", f"{prefix}_{gauge}{fmt()} {snapshot[gauge]}"]
+
+    lines.append(f"# TYPE {prefix}_stage_seconds histogram")
+    for stage, hist in snapshot['latency_seconds'].items():
+        lines += histogram(f"{prefix}_stage_seconds", hist, {'stage': stage})
+    lines.append(f"# TYPE {prefix}_stage_seconds_quantile gauge")
+    for stage, hist in snapshot['latency_seconds'].items():
+        for q in ('p50', 'p95', 'p99'):
+            if hist[q] is not None:
+                quantile = {'p50': '0.5', 'p95': '0.95', 'p99': '0.99'}[q]
+                lines.append(f"{prefix}_stage_seconds_quantile{fmt({'stage': stage, 'quantile': quantile})} {hist[q]}")
+
+    lines.append(f"# TYPE {prefix}_score histogram")
+    lines += histogram(f"{prefix}_score", snapshot['scores'])
+    return '\n'.join(lines) + '\n'
+
+
+STORAGE_DTYPES = ('float32', 'float16', 'int8', 'binary')
+
+# Number of set bits of every byte value (Hamming distance of packed codes)
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint16)
+
+
+def top_k(scores: np.ndarray, k: int):
+    """
+    Returns the k best columns of each row, best first.
+
+    :param scores: Score matrix of shape (m, n)
+    :return: (ids, scores) arrays of shape (m, min(k, n))
+    """
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        ids = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        ids = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    best = np.take_along_axis(scores, ids, axis=1)
+    order = np.argsort(-best, axis=1, kind='stable')
+    return np.take_along_axis(ids, order, axis=1), np.take_along_axis(best, order, axis=1)
+
+
+class EmbeddingMatrix:
+    """
+    Stored question embeddings in one of the storage formats, scored natively:
+
+    - 'float32', 'float16': normalized vectors
+    - 'int8': vectors scaled per row to [-127, 127]; ``scales`` holds the row scale
+    - 'binary': sign bits packed 8 per byte; ``scales`` holds the inverse L1 norm of
+      each row, so the float query times the sign vector approximates cosine
+      similarity. Search pre-filters rows by Hamming distance and rescores the
+      candidates with the float query.
+    """
+
+    def __init__(self, data: np.ndarray, storage_dtype: str = 'float32',
+                 scales: np.ndarray = None, dim: int = None, rescore_candidates: int = 100,
+                 block_size: int = 65536):
+        """
+        :param data: Stored array
+        :param storage_dtype: Storage format (see STORAGE_DTYPES)
+        :param scales: Per-row scales ('int8' and 'binary' formats)
+        :param dim: Embedding dimension (required for 'binary')
+        :param rescore_candidates: Rows rescored after the Hamming pre-filter ('binary')
+        :param block_size: Rows scored per block (bounds temporary memory)
+        """
+        if storage_dtype not in STORAGE_DTYPES:
+            raise ValueError(f"Unknown storage dtype: {storage_dtype}")
+        self.data = data
+        self.storage_dtype = storage_dtype
+        self.scales = scales
+        self.dim = dim or data.shape[1]
+        self.rescore_candidates = rescore_candidates
+        self.block_size = block_size
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.data.nbytes + (self.scales.nbytes if self.scales is not None else 0))
+
+    @staticmethod
+    def quantize(embeddings: np.ndarray, storage_dtype: str):
+        """
+        Converts normalized float embeddings to a storage format.
+
+        :return: (data, scales) where scales is None for float formats
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if storage_dtype == 'float32':
+            return embeddings, None
+        if storage_dtype == 'float16':
+            return embeddings.astype(np.float16), None
+        if storage_dtype == 'int8':
+            scales = np.abs(embeddings).max(axis=1) / 127
+            scales[scales == 0] = 1.0
+            data = np.round(embeddings / scales[:, None]).astype(np.int8)
+            return data, scales.astype(np.float32)
+        if storage_dtype == 'binary':
+            l1 = np.abs(embeddings).sum(axis=1)
+            l1[l1 == 0] = 1.0
+            return np.packbits(embeddings > 0, axis=1), (1 / l1).astype(np.float32)
+        raise ValueError(f"Unknown storage dtype: {storage_dtype}")
+
+    @classmethod
+    def load(cls, base_path: Path, meta: dict, mmap_mode: str = None) -> 'EmbeddingMatrix':
+        """
+        Loads the embeddings of a built pipeline.
+
+        :param base_path: Pipeline folder
+        :param meta: Pipeline metadata
+        :param mmap_mode: Memory-map the stored arrays (e.g. 'r')
+        """
+        model_info = meta['model_info']
+        storage_dtype = model_info.get('storage_dtype', 'float32')
+        data = np.load(base_path / 'question_embeddings.npy', mmap_mode=mmap_mode)
+        scales = None
+        if storage_dtype in ('int8', 'binary'):
+            scales = np.load(base_path / 'embedding_scales.npy', mmap_mode=mmap_mode)
+        elif not model_info.get('normalized', False):
+            # Pipelines built before normalization was stored are normalized
+            # once here, so scoring is a plain dot product
+            data = l2_normalize(data)
+        return cls(data, storage_dtype, scales, dim=model_info.get('embedding_dim'))
+
+    def _decode(self, data: np.ndarray, scales: np.ndarray) -> np.ndarray:
+        """Returns float32 vectors of stored rows (scaled for 'int8'/'binary')."""
+        if self.storage_dtype == 'binary':
+            vectors = np.unpackbits(data, axis=1, count=self.dim).astype(np.float32) * 2 - 1
+        else:
+            vectors = data.astype(np.float32, copy=False)
+        if scales is not None:
+            vectors *= scales[:, None]
+        return vectors
+
+    def decode(self) -> np.ndarray:
+        """Returns all rows as float32 vectors (decoded block by block)."""
+        if self.storage_dtype == 'float32':
+            return self.data
+        vectors = np.empty((len(self.data), self.dim), dtype=np.float32)
+        for start in range(0, len(self.data), self.block_size):
+            end = start + self.block_size
+            scales = self.scales[start:end] if self.scales is not None else None
+            vectors[start:end] = self._decode(self.data[start:end], scales)
+        return vectors
+
+    def score_rows(self, rows: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        """
+        Scores selected rows.
+
+        :param rows: Row ids
+        :param queries: Normalized query embeddings of shape (m, dim) or a single vector
+        :return: Scores of shape (m, len(rows)) (or (len(rows),) for a single vector)
+        """
+        scales = self.scales[rows] if self.scales is not None else None
+        return queries @ self._decode(self.data[rows], scales).T
+
+    def search(self, queries: np.ndarray, k: int = 1):
+        """
+        Exact search (Hamming pre-filter plus rescoring for 'binary').
+
+        :param queries: Normalized query embeddings of shape (m, dim)
+        :param k: Number of results per query
+        :return: (ids, scores) arrays of shape (m, min(k, n)), best first
+        """
+        if self.storage_dtype == 'binary':
+            return self._search_binary(queries, k)
+
+        best_ids = best_scores = None
+        for start in range(0, len(self.data), self.block_size):
+            end = start + self.block_size
+            scales = self.scales[start:end] if self.scales is not None else None
+            scores = queries @ self._decode(self.data[start:end], scales).T
+            ids, scores = top_k(scores, k)
+            ids = ids + start
+            if best_ids is not None:
+                ids = np.concatenate([best_ids, ids], axis=1)
+                scores = np.concatenate([best_scores, scores], axis=1)
+                order, scores = top_k(scores, k)
+                ids = np.take_along_axis(ids, order, axis=1)
+            best_ids, best_scores = ids, scores
+        return best_ids, best_scores
+
+    def _search_binary(self, queries: np.ndarray, k: int):
+        n_candidates = min(len(self.data), max(k, self.rescore_candidates))
+        query_bits = np.packbits(queries > 0, axis=1)
+        result_ids, result_scores = [], []
+        for query, bits in zip(queries, query_bits):
+            distances = np.concatenate([
+                _POPCOUNT[np.bitwise_xor(self.data[start:start + self.block_size], bits)].sum(axis=1)
+                for start in range(0, len(self.data), self.block_size)
+            ])
+            if n_candidates < len(distances):
+                candidates = np.argpartition(distances, n_candidates - 1)[:n_candidates]
+            else:
+                candidates = np.arange(len(distances))
+            ids, scores = top_k(self.score_rows(candidates, query[None]), k)
+            result_ids.append(candidates[ids[0]])
+            result_scores.append(scores[0])
+        return np.array(result_ids), np.array(result_scores, dtype=np.float32)
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate nearest-neighbour search over
+    normalized embeddings (pure NumPy).
+
+    Embeddings are clustered with spherical k-means; a query is compared only
+    against the rows of the ``n_probe`` closest clusters.
+    """
+
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray,
+                 list_ids: np.ndarray, n_probe: int = 8):
+        """
+        :param centroids: Cluster centroids of shape (n_lists, dim)
+        :param list_offsets: Start offset of each cluster in ``list_ids`` (n_lists + 1)
+        :param list_ids: Row ids grouped by cluster
+        :param n_probe: Number of clusters scanned per query
+        """
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.n_probe = n_probe
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, n_lists: int = None, n_probe: int = 8,
+              n_iter: int = 10, sample_size: int = 64, max_train_size: int = 200000,
+              block_size: int = 65536, seed: int = 0) -> 'IVFIndex':
+        """
+        Builds the index with spherical k-means.
+
+        :param embeddings: Normalized embeddings of shape (n, dim)
+        :param n_lists: Number of clusters (default is about 4 * sqrt(n))
+        :param n_probe: Default number of clusters scanned per query
+        :param n_iter: Number of k-means iterations
+        :param sample_size: Training points per cluster used for k-means
+        :param max_train_size: Maximum number of training points
+        :param block_size: Maximum rows assigned per block (bounds peak memory)
+        :param seed: Random seed
+        :return: IVFIndex
+        """
+        n = len(embeddings)
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(n))
+        n_lists = max(1, min(n_lists, n))
+        rng = np.random.default_rng(seed)
+
+        # Train centroids on a sample
+        train_size = max(n_lists, min(n, n_lists * sample_size, max_train_size))
+        train = np.asarray(embeddings[np.sort(rng.choice(n, train_size, replace=False))], dtype=np.float32)
+        centroids = train[rng.choice(train_size, n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            sums = np.zeros_like(centroids)
+            assign = cls._assign(train, centroids, block_size, sums)
+            counts = np.bincount(assign, minlength=n_lists)
+            # Re-seed empty clusters with random training points
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = train[rng.choice(train_size, int(empty.sum()))]
+            centroids = l2_normalize(sums)
+
+        # Assign every row to its closest centroid
+        assign = cls._assign(embeddings, centroids, block_size)
+
+        list_ids = np.argsort(assign, kind='stable').astype(np.int64)
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        list_offsets[1:] = np.cumsum(np.bincount(assign, minlength=n_lists))
+        return cls(centroids, list_offsets, list_ids, n_probe=min(n_probe, n_lists))
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray, block_size: int,
+                sums: np.ndarray = None) -> np.ndarray:
+        """
+        Assigns rows to their closest centroid block by block, so the score
+        matrix of a block stays under 16M floats however many clusters there are.
+
+        :param sums: If given, each row is also added to the sum of its cluster
+        :return: int32 cluster of each row
+        """
+        rows = max(1, min(block_size, (1 << 24) // len(centroids)))
+        assign = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), rows):
+            block = np.asarray(vectors[start:start + rows], dtype=np.float32)
+            block_assign = np.argmax(block @ centroids.T, axis=1)
+            assign[start:start + len(block)] = block_assign
+            if sums is not None:
+                # Rows sorted by cluster: one reduceat adds up each cluster's rows
+                order = np.argsort(block_assign, kind='stable')
+                sorted_assign = block_assign[order]
+                starts = np.flatnonzero(np.r_[True, sorted_assign[1:] != sorted_assign[:-1]])
+                sums[sorted_assign[starts]] += np.add.reduceat(block[order], starts, axis=0)
+        return assign
+
+    def search(self, embeddings, queries: np.ndarray, k: int = 1,
+               n_probe: int = None):
+        """
+        Finds the approximate top-k rows for each query.
+
+        :param embeddings: EmbeddingMatrix (or float array) the index was built on
+        :param queries: Normalized query embeddings of shape (m, dim)
+        :param k: Number of results per query
+        :param n_probe: Number of clusters to scan (default is the index setting)
+        :return: (ids, scores) arrays of shape (m, k), best first; missing
+            results are filled with id -1 and score -inf
+        """
+        if not isinstance(embeddings, EmbeddingMatrix):
+            embeddings = EmbeddingMatrix(embeddings)
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+
+        centroid_scores = queries @ self.centroids.T
+        if n_probe < self.n_lists:
+            probes = np.argpartition(-centroid_scores, n_probe - 1, axis=1)[:, :n_probe]
+        else:
+            probes = np.broadcast_to(np.arange(self.n_lists), centroid_scores.shape)
+
+        for i, query in enumerate(queries):
+            candidates = np.concatenate([
+                self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probes[i]
+            ])
+            if len(candidates) == 0:
+                continue
+            candidate_scores = embeddings.score_rows(candidates, query)
+            top = min(k, len(candidates))
+            best = np.argpartition(-candidate_scores, top - 1)[:top]
+            best = best[np.argsort(-candidate_scores[best])]
+            ids[i, :top] = candidates[best]
+            scores[i, :top] = candidate_scores[best]
+        return ids, scores
+
+    def recall_at_1(self, embeddings: np.ndarray, sample_size: int = 1000,
+                    n_probe: int = None, block_size: int = 65536, seed: int = 0) -> float:
+        """
+        Measures recall@1 against exact search.
+
+        Uses a sample of the indexed rows as queries with the row itself
+        excluded, so the query's own exact copy does not count as a hit.
+
+        :param embeddings: Embeddings the index was built on
+        :param sample_size: Number of rows used as queries
+        :param n_probe: Number of clusters to scan (default is the index setting)
+        :param block_size: Rows scored per block by the exact search
+        :param seed: Random seed
+        :return: Share of queries whose approximate top-1 matches the exact top-1
+        """
+        n = len(embeddings)
+        if n < 2:
+            return 1.0
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(n, min(sample_size, n), replace=False))
+        queries = np.asarray(embeddings[sample], dtype=np.float32)
+
+        # Exact top-1 over blocks of rows, so memory stays bounded for large corpora
+        exact_best = np.zeros(len(sample), dtype=np.int64)
+        exact_scores = np.full(len(sample), -np.inf, dtype=np.float32)
+        for start in range(0, n, block_size):
+            block = np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+            scores = queries @ block.T
+            own = (sample >= start) & (sample < start + len(block))
+            scores[own, sample[own] - start] = -np.inf
+            block_best = np.argmax(scores, axis=1)
+            block_scores = scores[np.arange(len(sample)), block_best]
+            better = block_scores > exact_scores
+            exact_best[better] = block_best[better] + start
+            exact_scores[better] = block_scores[better]
+
+        ids, _ = self.search(embeddings, queries, k=2, n_probe=n_probe)
+        approx_best = np.where(ids[:, 0] == sample, ids[:, 1], ids[:, 0])
+        return float(np.mean(approx_best == exact_best))
+
+    def save(self, path):
+        """Saves the index to a .npz file."""
+        np.savez(path, centroids=self.centroids, list_offsets=self.list_offsets,
+                 list_ids=self.list_ids, n_probe=np.int64(self.n_probe))
+
+    @classmethod
+    def load(cls, path) -> 'IVFIndex':
+        """Loads the index from a .npz file."""
+        with np.load(path) as data:
+            return cls(data['centroids'], data['list_offsets'], data['list_ids'],
+                       n_probe=int(data['n_probe']))
+
+
+_TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def lexical_tokens(text: str) -> list:
+    """Splits text into lowercase word tokens (product codes like 'e1042' stay whole)."""
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """
+    BM25 inverted index over the training questions, stored as CSR arrays:
+    the postings of term ``t`` are ``doc_ids[indptr[t]:indptr[t + 1]]`` with
+    precomputed BM25 weights, so a query score is a sum of weight slices.
+    """
+
+    def __init__(self, terms: list, indptr: np.ndarray, doc_ids: np.ndarray,
+                 weights: np.ndarray, n_docs: int):
+        """
+        :param terms: Vocabulary; term ids are positions in this list
+        :param indptr: Posting list offsets of shape (n_terms + 1,)
+        :param doc_ids: Row ids of all posting lists
+        :param weights: BM25 weight of each posting
+        :param n_docs: Number of indexed rows
+        """
+        self.terms = terms
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.n_docs = n_docs
+
+    @classmethod
+    def build(cls, texts: list, k1: float = 1.2, b: float = 0.75) -> 'BM25Index':
+        """
+        Builds the index.
+
+        :param texts: Indexed texts (one row each)
+        :param k1: Term frequency saturation
+        :param b: Length normalization
+        """
+        vocabulary = {}
+        term_ids, doc_ids, tfs = [], [], []
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for doc, text in enumerate(texts):
+            tokens = lexical_tokens(text)
+            lengths[doc] = len(tokens)
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                term_ids.append(vocabulary.setdefault(token, len(vocabulary)))
+                doc_ids.append(doc)
+                tfs.append(count)
+
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind='stable')
+        term_ids = term_ids[order]
+        doc_ids = np.asarray(doc_ids, dtype=np.int32)[order]
+        tfs = np.asarray(tfs, dtype=np.float32)[order]
+
+        n_docs = len(texts)
+        df = np.bincount(term_ids, minlength=len(vocabulary)).astype(np.float32)
+        indptr = np.concatenate([[0], np.cumsum(df, dtype=np.int64)])
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+        avg_length = float(lengths.mean()) if n_docs and lengths.mean() > 0 else 1.0
+        norm = k1 * (1 - b + b * lengths[doc_ids] / avg_length)
+        weights = (idf[term_ids] * tfs * (k1 + 1) / (tfs + norm)).astype(np.float32)
+        return cls(list(vocabulary), indptr, doc_ids, weights, n_docs)
+
+    def search(self, text: str, k: int):
+        """
+        Finds the best rows for a query by BM25.
+
+        :param text: Query text
+        :param k: Number of results
+        :return: (ids, scores), best first; empty when no query term is indexed
+        """
+        slices = [
+            slice(self.indptr[t], self.indptr[t + 1])
+            for t in {self.vocabulary[token] for token in lexical_tokens(text) if token in self.vocabulary}
+        ]
+        if not slices:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        postings = np.concatenate([self.doc_ids[s] for s in slices])
+        weights = np.concatenate([self.weights[s] for s in slices])
+        docs, inverse = np.unique(postings, return_inverse=True)
+        scores = np.bincount(inverse, weights=weights).astype(np.float32)
+        ids, best = top_k(scores[None], k)
+        return docs[ids[0]].astype(np.int64), best[0]
+
+    def to_arrays(self) -> dict:
+        """Returns the index as flat arrays (terms as one newline-joined UTF-8 buffer)."""
+        return {
+            'terms': np.frombuffer('\n'.join(self.terms).encode('utf-8'), dtype=np.uint8),
+            'indptr': self.indptr,
+            'doc_ids': self.doc_ids,
+            'weights': self.weights,
+            'n_docs': np.int64(self.n_docs)
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: dict) -> 'BM25Index':
+        terms = bytes(np.asarray(arrays['terms'])).decode('utf-8')
+        return cls(terms.split('\n') if terms else [], arrays['indptr'], arrays['doc_ids'],
+                   arrays['weights'], int(arrays['n_docs']))
+
+    def save(self, path):
+        """Saves the index to a .npz file."""
+        np.savez(path, **self.to_arrays())
+
+    @classmethod
+    def load(cls, path) -> 'BM25Index':
+        """Loads the index from a .npz file."""
+        with np.load(path) as data:
+            return cls.from_arrays({name: data[name] for name in data.files})
+
+
+PACK_FILE = 'pipeline.pack'
+PACK_MAGIC = b'RCPACK01'
+PACK_ALIGN = 64
+
+
+def _align(offset: int) -> int:
+    return (offset + PACK_ALIGN - 1) // PACK_ALIGN * PACK_ALIGN
+
+
+def write_pack(path, header: dict, arrays: dict, block_size: int = 65536):
+    """
+    Writes a packed pipeline artifact: a JSON header followed by 64-byte aligned
+    raw arrays, so the arrays can be memory-mapped straight from the file.
+
+    :param path: Output file
+    :param header: JSON-serializable data (metadata, answers, ...)
+    :param arrays: Arrays by name (may be memory-mapped)
+    :param block_size: Rows written per block
+    """
+    specs = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = _align(offset)
+        specs[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += array.nbytes
+    header_bytes = json.dumps({**header, 'arrays': specs}, ensure_ascii=False).encode('utf-8')
+    data_start = _align(len(PACK_MAGIC) + 8 + len(header_bytes))
+
+    with open(path, 'wb') as f:
+        f.write(PACK_MAGIC)
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.write(b'\0' * (data_start + specs[name]['offset'] - f.tell()))
+            if array.ndim == 0:
+                f.write(array.tobytes())
+                continue
+            for start in range(0, len(array), block_size):
+                f.write(np.ascontiguousarray(array[start:start + block_size]).tobytes())
+
+
+def read_pack(path, mmap_mode: str = None):
+    """
+    Reads a packed pipeline artifact.
+
+    :param path: Packed file
+    :param mmap_mode: Memory-map the arrays (e.g. 'r') instead of reading them
+    :return: (header, arrays)
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+            raise ValueError(f"Not a packed pipeline: {path}")
+        header_size = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_size).decode('utf-8'))
+        data_start = _align(len(PACK_MAGIC) + 8 + header_size)
+
+        arrays = {}
+        for name, spec in header.pop('arrays').items():
+            dtype = np.dtype(spec['dtype'])
+            shape = tuple(spec['shape'])
+            count = int(np.prod(shape))
+            if mmap_mode and count:
+                arrays[name] = np.memmap(path, dtype=dtype, mode=mmap_mode,
+                                         offset=data_start + spec['offset'], shape=shape)
+            else:
+                f.seek(data_start + spec['offset'])
+                arrays[name] = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+    return header, arrays
+
+
+class Corpus:
+    """
+    Searchable data of a built pipeline: metadata, stored embeddings,
+    answers, training questions and the optional ANN and lexical indexes.
+    """
+
+    def __init__(self, meta: dict, matrix: EmbeddingMatrix, answers: list, answer_ids: np.ndarray,
+                 questions: list = None, ann_index: IVFIndex = None,
+                 lexical_index: BM25Index = None):
+        self.meta = meta
+        self.matrix = matrix
+        self.answers = answers
+        self.answer_ids = answer_ids
+        self.questions = questions
+        self.ann_index = ann_index
+        self.lexical_index = lexical_index
+
+    @classmethod
+    def load(cls, base_path: Path, meta: dict, mmap_mode: str = None, use_ann: bool = True,
+             load_questions: bool = True, use_lexical: bool = True) -> 'Corpus':
+        """
+        Loads the data of a built pipeline from separate files or from the packed artifact.
+
+        :param base_path: Pipeline folder
+        :param meta: Pipeline metadata
+        :param mmap_mode: Memory-map the arrays (e.g. 'r')
+        :param use_ann: Load the ANN index if the pipeline has one
+        :param load_questions: Load the training questions
+        :param use_lexical: Load the BM25 index if the pipeline has one
+        """
+        ann_meta = meta.get('ann_index')
+        lexical_meta = meta.get('lexical_index') if use_lexical else None
+
+        if meta.get('packed'):
+            header, arrays = read_pack(base_path / meta['packed'], mmap_mode)
+            model_info = meta['model_info']
+            matrix = EmbeddingMatrix(arrays['question_embeddings'],
+                                     model_info.get('storage_dtype', 'float32'),
+                                     arrays.get('embedding_scales'),
+                                     dim=model_info.get('embedding_dim'))
+            ann_index = None
+            if use_ann and ann_meta and 'ann_centroids' in arrays:
+                ann_index = IVFIndex(arrays['ann_centroids'], arrays['ann_list_offsets'],
+                                     arrays['ann_list_ids'], n_probe=ann_meta['n_probe'])
+            lexical_index = None
+            if lexical_meta and 'lexical_indptr' in arrays:
+                lexical_index = BM25Index.from_arrays({
+                    name: arrays['lexical_' + name]
+                    for name in ('terms', 'indptr', 'doc_ids', 'weights', 'n_docs')
+                })
+            return cls(meta, matrix, header['answers'], arrays['answer_ids'],
+                       header.get('questions') if load_questions else None, ann_index, lexical_index)
+
+        answers, answer_ids = load_answers(base_path, meta, mmap_mode)
+        matrix = EmbeddingMatrix.load(base_path, meta, mmap_mode)
+
+        ann_index = None
+        if use_ann and ann_meta and (base_path / ann_meta['file']).exists():
+            ann_index = IVFIndex.load(base_path / ann_meta['file'])
+
+        lexical_index = None
+        if lexical_meta and (base_path / lexical_meta['file']).exists():
+            lexical_index = BM25Index.load(base_path / lexical_meta['file'])
+
+        questions = None
+        questions_path = base_path / 'questions.json'
+        if load_questions and questions_path.exists():
+            with open(questions_path, 'r', encoding='utf-8') as f:
+                questions = json.load(f)
+
+        return cls(meta, matrix, answers, answer_ids, questions, ann_index, lexical_index)
+
+
+class SearchBackend:
+    """
+    Embedding search behind a common interface: ``search(queries, k)``
+    returns the best rows of the corpus for normalized query embeddings.
+
+    Backends with their own index files build them with ``build`` when the
+    pipeline is built; the backend name and parameters are stored in meta.json.
+    """
+
+    name = None
+    files = ()
+    # Optional dependency as (module, pip package)
+    requires = None
+
+    @classmethod
+    def check_available(cls):
+        """Raises ImportError if the optional dependency of the backend is not installed."""
+        if cls.requires is not None:
+            module, package = cls.requires
+            try:
+                importlib.import_module(module)
+            except ImportError as e:
+                raise ImportError(f"The {cls.name} search backend requires {package}: "
+                                  f"pip install {package} ({str(e)})")
+
+    def __init__(self, corpus: Corpus, base_path: Path, **params):
+        """
+        :param corpus: Loaded corpus
+        :param base_path: Pipeline folder (for index files)
+        :param params: Backend parameters
+        """
+        self.matrix = corpus.matrix
+        self.params = params
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, base_path, **params) -> dict:
+        """
+        Writes the backend's index files.
+
+        :param embeddings: Normalized float32 embeddings
+        :param base_path: Pipeline folder
+        :return: Parameters to store in meta.json
+        """
+        return params
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the backend on top of the stored embeddings."""
+        return 0
+
+    def search(self, queries: np.ndarray, k: int = 1):
+        """
+        :param queries: Normalized query embeddings of shape (m, dim)
+        :param k: Number of results per query
+        :return: (ids, scores) arrays of shape (m, k), best first; missing
+            results are filled with id -1 and score -inf
+        """
+        raise NotImplementedError
+
+
+class BlockedSearch(SearchBackend):
+    """Exact search over blocks of rows; memory stays bounded, so memory-mapped corpora may exceed RAM."""
+
+    name = 'blocked'
+
+    def __init__(self, corpus: Corpus, base_path: Path, block_size: int = 65536, **params):
+        super().__init__(corpus, base_path, block_size=block_size, **params)
+        self.matrix.block_size = block_size
+
+    def search(self, queries: np.ndarray, k: int = 1):
+        return self.matrix.search(queries, k=k)
+
+
+class NumpySearch(SearchBackend):
+    """Exact search with one matrix multiplication; quantized embeddings are decoded into RAM once."""
+
+    name = 'numpy'
+
+    def __init__(self, corpus: Corpus, base_path: Path, **params):
+        super().__init__(corpus, base_path, **params)
+        self.vectors = self.matrix.decode()
+
+    @property
+    def nbytes(self) -> int:
+        return 0 if self.vectors is self.matrix.data else int(self.vectors.nbytes)
+
+    def search(self, queries: np.ndarray, k: int = 1):
+        return top_k(queries @ self.vectors.T, k)
+
+
+class TorchSearch(SearchBackend):
+    """Exact search with torch (e.g. on a GPU with device='cuda')."""
+
+    name = 'torch'
+    requires = ('torch', 'torch')
+
+    def __init__(self, corpus: Corpus, base_path: Path, device: str = 'cpu', **params):
+        import torch
+        super().__init__(corpus, base_path, device=device, **params)
+        self.torch = torch
+        self.device = device
+        vectors = np.array(self.matrix.decode(), dtype=np.float32)
+        self.vectors = torch.from_numpy(vectors).to(device)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.vectors.element_size() * self.vectors.nelement()) if self.device == 'cpu' else 0
+
+    def search(self, queries: np.ndarray, k: int = 1):
+        with self.torch.no_grad():
+            scores = self.torch.from_numpy(np.ascontiguousarray(queries, dtype=np.float32)).to(self.device) @ self.vectors.T
+            scores, ids = self.torch.topk(scores, min(k, scores.shape[1]), dim=1)
+        return ids.cpu().numpy(), scores.cpu().numpy()
+
+
+class IVFSearch(SearchBackend):
+    """Approximate search with the IVF index (built with ``ann_index=True``)."""
+
+    name = 'ivf'
+
+    def __init__(self, corpus: Corpus, base_path: Path, n_probe: int = None, **params):
+        if corpus.ann_index is None:
+            raise ValueError("The pipeline was built without an ANN index")
+        super().__init__(corpus, base_path, n_probe=n_probe, **params)
+        self.index = corpus.ann_index
+        self.n_probe = n_probe
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.index.centroids.nbytes + self.index.list_offsets.nbytes + self.index.list_ids.nbytes)
+
+    def search(self, queries: np.ndarray, k: int = 1):
+        return self.index.search(self.matrix, queries, k=k, n_probe=self.n_probe)
+
+
+class FaissSearch(SearchBackend):
+    """faiss index (requires faiss-cpu or faiss-gpu); 'index' is a faiss factory string."""
+
+    name = 'faiss'
+    files = ('faiss.index',)
+    requires = ('faiss', 'faiss-cpu')
+
+    def __init__(self, corpus: Corpus, base_path: Path, index: str = 'HNSW32',
+                 ef_search: int = 64, nprobe: int = 16, **params):
+        import faiss
+        super().__init__(corpus, base_path, index=index, ef_search=ef_search, nprobe=nprobe, **params)
+        self.index = faiss.read_index(str(Path(base_path) / self.files[0]))
+        if hasattr(self.index, 'hnsw'):
+            self.index.hnsw.efSearch = ef_search
+        if hasattr(self.index, 'nprobe'):
+            self.index.nprobe = nprobe
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, base_path, index: str = 'HNSW32', block_size: int = 65536,
+              **params) -> dict:
+        import faiss
+        dim = embeddings.shape[1]
+        faiss_index = faiss.index_factory(dim, index, faiss.METRIC_INNER_PRODUCT)
+        if not faiss_index.is_trained:
+            rng = np.random.default_rng(0)
+            sample = np.sort(rng.choice(len(embeddings), min(len(embeddings), 100000), replace=False))
+            faiss_index.train(np.ascontiguousarray(embeddings[sample], dtype=np.float32))
+        for start in range(0, len(embeddings), block_size):
+            faiss_index.add(np.ascontiguousarray(embeddings[start:start + block_size], dtype=np.float32))
+        faiss.write_index(faiss_index, str(Path(base_path) / cls.files[0]))
+        return {'index': index, **params}
+
+    def search(self, queries: np.ndarray, k: int = 1):
+        scores, ids = self.index.search(np.ascontiguousarray(queries, dtype=np.float32), k)
+        scores[ids < 0] = -np.inf
+        return ids.astype(np.int64), scores
+
+
+class HnswlibSearch(SearchBackend):
+    """hnswlib HNSW graph (requires hnswlib)."""
+
+    name = 'hnswlib'
+    files = ('hnsw.bin',)
+    requires = ('hnswlib', 'hnswlib')
+
+    def __init__(self, corpus: Corpus, base_path: Path, ef: int = 64, **params):
+        import hnswlib
+        super().__init__(corpus, base_path, ef=ef, **params)
+        self.index = hnswlib.Index(space='ip', dim=self.matrix.dim)
+        self.index.load_index(str(Path(base_path) / self.files[0]), max_elements=len(self.matrix))
+        self.ef = ef
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, base_path, M: int = 32, ef_construction: int = 200,
+              block_size: int = 65536, **params) -> dict:
+        import hnswlib
+        index = hnswlib.Index(space='ip', dim=embeddings.shape[1])
+        index.init_index(max_elements=max(len(embeddings), 1), M=M, ef_construction=ef_construction)
+        for start in range(0, len(embeddings), block_size):
+            block = np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+            index.add_items(block, np.arange(start, start + len(block)))
+        index.save_index(str(Path(base_path) / cls.files[0]))
+        return {'M': M, 'ef_construction': ef_construction, **params}
+
+    def search(self, queries: np.ndarray, k: int = 1):
+        k = min(k, len(self.matrix))
+        self.index.set_ef(max(self.ef, k))
+        ids, distances = self.index.knn_query(np.asarray(queries, dtype=np.float32), k=k)
+        # The 'ip' space returns 1 - inner product
+        return ids.astype(np.int64), (1 - distances).astype(np.float32)
+
+
+SEARCH_BACKENDS = {backend.name: backend for backend in (
+    BlockedSearch, NumpySearch, TorchSearch, IVFSearch, FaissSearch, HnswlibSearch
+)}
+
+
+def default_search_backend(meta: dict) -> dict:
+    """Returns the search backend recorded in meta.json ({'name', 'params'})."""
+    if meta.get('search_backend'):
+        return meta['search_backend']
+    # Pipelines built before backends were recorded
+    return {'name': 'ivf' if meta.get('ann_index') else 'blocked', 'params': {}}
+
+
+def create_search_backend(corpus: Corpus, base_path: Path, name: str = None,
+                          params: dict = None) -> SearchBackend:
+    """
+    Creates the search backend of a loaded corpus.
+
+    :param corpus: Loaded corpus
+    :param base_path: Pipeline folder
+    :param name: Backend name (default is the one recorded at build time)
+    :param params: Parameters merged over those recorded at build time
+        ('n_probe' only applies to 'ivf')
+    """
+    built = default_search_backend(corpus.meta)
+    name = name or built['name']
+    params = dict(params or {})
+    n_probe = params.pop('n_probe', None)
+    if name == 'ivf':
+        if corpus.ann_index is None and name == built['name']:
+            # The index was not loaded (use_ann=False): exact search
+            name = 'blocked'
+        elif n_probe is not None:
+            params['n_probe'] = n_probe
+    merged = dict(built.get('params') or {}) if name == built['name'] else {}
+    merged.update(params)
+    return SEARCH_BACKENDS[name](corpus, base_path, **merged)
+
+
+BUILDS_DIR = 'builds'
+CURRENT_FILE = 'current'
+
+
+def current_build_dir(base_path) -> Path:
+    """
+    Returns the folder of the build a pipeline folder serves. Every build is
+    written to its own ``builds/<build_version>`` folder and published by
+    replacing the ``current`` file that names it, so a reader sees either the
+    previous build or the new one as a whole.
+
+    :param base_path: Pipeline folder (pipelines built before builds were
+        versioned keep their build in the folder itself)
+    """
+    base_path = Path(base_path)
+    try:
+        with open(base_path / CURRENT_FILE, 'r', encoding='utf-8') as f:
+            return base_path / BUILDS_DIR / f.read().strip()
+    except FileNotFoundError:
+        return base_path
+
+
+def default_base_path() -> Path:
+    """Returns the pipeline folder this file was published to (the folder of this file if it is not in a build)."""
+    folder = Path(__file__).parent
+    if folder.parent.name == BUILDS_DIR and (folder.parent.parent / CURRENT_FILE).exists():
+        return folder.parent.parent
+    return folder
+
+
+def build_version(meta: dict) -> str:
+    """Returns the version of a build (pipelines built before versions were recorded use the build time)."""
+    return meta.get('build_version') or meta.get('training_params', {}).get('created_at')
+
+
+def encoder_key(meta: dict) -> str:
+    """Returns a key that is equal for builds whose encoders are interchangeable."""
+    model_info = meta.get('model_info', {})
+    onnx = model_info.get('onnx') or {}
+    return json.dumps({
+        'name': model_info.get('name'),
+        'embedding_dim': model_info.get('embedding_dim'),
+        'max_seq_length': model_info.get('max_seq_length'),
+        'onnx': onnx.get('file_name')
+    }, sort_keys=True)
+
+
+class PipelineState:
+    """
+    Everything a query reads from one build folder (``path``): the corpus, its
+    search backend, the exact-match lookup, the query cache and the encoder.
+    ``Pipeline.reload`` replaces the whole state at once, so a query never mixes two builds.
+    The encoder is loaded and used under ``model_lock``.
+    """
+
+    def __init__(self, path: Path, meta: dict, corpus: Corpus, searcher: SearchBackend, fusion: str,
+                 exact_lookup: dict, cache: QueryCache, model=None, model_lock=None):
+        self.path = path
+        self.meta = meta
+        self.version = build_version(meta)
+        self.matrix = corpus.matrix
+        self.embeddings = corpus.matrix.data
+        self.answers = corpus.answers
+        self.answer_ids = corpus.answer_ids
+        self.ann_index = corpus.ann_index
+        self.lexical_index = corpus.lexical_index
+        self.searcher = searcher
+        self.fusion = fusion
+        self.exact_lookup = exact_lookup
+        self.cache = cache
+        self.model = model
+        self.model_lock = model_lock or threading.Lock()
+
+
+def _state_property(name: str, doc: str) -> property:
+    return property(lambda self: getattr(self._state, name), doc=doc)
+
 
 class Pipeline:
-    def __init__(self):
+    def __init__(self, use_ann: bool = True, n_probe: int = None, mmap_mode: str = None,
+                 cache_size: int = 1024, cache_ttl: float = None, exact_match: bool = True,
+                 backend: str = 'auto', base_path: str = None, model=None,
+                 lazy_model: bool = False, metrics=True, fusion: str = None,
+                 lexical_weight: float = 0.3, fusion_depth: int = 50,
+                 lexical_candidates: int = None, search_backend: str = None,
+                 search_params: dict = None, watch_interval: float = None, model_lock=None):
         """
         Standalone pipeline class that works with files in its directory.
+
+        :param use_ann: Use the approximate nearest-neighbour index if the pipeline has one
+        :param n_probe: Number of index clusters scanned per query (default is the build setting)
+        :param mmap_mode: Memory-map the embeddings instead of reading them into RAM
+            (e.g. 'r'). Processes mapping the same file share one copy through the
+            OS page cache. Has no effect for pipelines built without normalized embeddings.
+        :param cache_size: Number of recent questions whose embedding and match are cached (0 disables)
+        :param cache_ttl: Seconds a cached entry stays valid (None - no expiry)
+        :param exact_match: Answer questions identical to a training question
+            (after normalization) without running the model
+        :param backend: Encoder backend: 'auto' (ONNX if it was exported and onnxruntime
+            is installed, otherwise torch), 'onnx' or 'torch'
+        :param base_path: Pipeline folder (default is the one this file was built into);
+            the build its ``current`` file names is served
+        :param model: Already loaded encoder to use instead of loading model_files
+            (e.g. shared between pipelines built on the same base model)
+        :param lazy_model: Load the encoder (and import torch) only when the first
+            question that needs it arrives; exact-match and cached questions never do
+        :param metrics: Collect hot-path metrics (True), use the given ``Metrics``
+            instance (e.g. with sinks), or disable them (False)
+        :param fusion: How dense and BM25 results are combined for pipelines built with
+            a lexical index: None (dense only, the default), 'rrf' (reciprocal rank fusion;
+            answers are ranked by the fused score, the score stays the cosine similarity
+            of the chosen answer), 'weighted' (the score is a weighted sum of the cosine
+            similarity and the BM25 score scaled to [0, 1]); 'auto' - 'rrf' when the
+            pipeline has a lexical index
+        :param lexical_weight: Weight of the BM25 score for 'weighted' fusion
+        :param fusion_depth: Number of dense and lexical results fused per query
+        :param lexical_candidates: Only score the embeddings of the best N BM25 rows
+            (lexical pre-filter, requires ``fusion``); queries without indexed terms use
+            the full dense search
+        :param search_backend: Embedding search backend (see ``SEARCH_BACKENDS``):
+            'blocked', 'numpy', 'torch', 'ivf', 'faiss' or 'hnswlib'
+            (default is the backend the pipeline was built with)
+        :param search_params: Backend parameters (e.g. {'device': 'cuda'} for 'torch',
+            {'ef': 128} for 'hnswlib'), merged with those stored at build time
+        :param watch_interval: Check meta.json every this many seconds and reload
+            the pipeline when it was rebuilt (see ``watch``); None disables
+        :param model_lock: Lock held while the encoder is loaded or encodes; pipelines
+            sharing ``model`` must share it too (default is a lock of this pipeline)
         """
-        self.base_path = Path(__file__).parent
-        self._load_components()
-
-    def _load_components(self):
-        """Loads all components from the current directory."""
-        # Checking for required files
-        required_files = [
-            'model_files',
-            'question_embeddings.npy',
-            'answers.json',
-            'meta.json'
-        ]
+        self.base_path = Path(base_path) if base_path else default_base_path()
+        self.use_ann = use_ann
+        self.n_probe = n_probe
+        self.mmap_mode = mmap_mode
+        self.exact_match = exact_match
+        self.backend = backend
+        if fusion not in ('auto', 'rrf', 'weighted', None):
+            raise ValueError(f"Invalid fusion: {fusion}")
+        if lexical_candidates and fusion is None:
+            raise ValueError("lexical_candidates requires fusion ('rrf', 'weighted' or 'auto')")
+        self.fusion_option = fusion
+        self.lexical_weight = lexical_weight
+        self.fusion_depth = fusion_depth
+        self.lexical_candidates = lexical_candidates
+        if search_backend is not None and search_backend not in SEARCH_BACKENDS:
+            raise ValueError(f"Invalid search backend: {search_backend}")
+        self.search_backend = search_backend
+        self.search_params = search_params or {}
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.exact_hits = 0
+        self.encode_stats = {
+            'sequences': 0,
+            'tokens': 0,
+            'padded_tokens': 0,
+            'seconds': 0.0
+        }
+        self.lazy_model = lazy_model
+        self._reload_lock = threading.Lock()
+        self._watcher = None
+        self._stop_watching = threading.Event()
+        self.reloads = 0
+        self.encoder_backend = 'shared' if model is not None else None
+        self.diagnostics = {}
+        if metrics is True:
+            metrics = Metrics()
+        self.metrics = metrics or None
+        self._created_at = time.perf_counter()
+        self._load_components(model, model_lock)
+        if watch_interval:
+            self.watch(watch_interval)
+
+    # The serving build; every query reads one snapshot of it (see PipelineState)
+    meta = _state_property('meta', "Metadata of the serving build.")
+    version = _state_property('version', "Version of the serving build.")
+    matrix = _state_property('matrix', "Stored question embeddings.")
+    embeddings = _state_property('embeddings', "Raw stored embedding array.")
+    answers = _state_property('answers', "Table of unique answers.")
+    answer_ids = _state_property('answer_ids', "Answer index of each stored question.")
+    ann_index = _state_property('ann_index', "IVF index (None if not loaded).")
+    lexical_index = _state_property('lexical_index', "BM25 index (None if not loaded).")
+    searcher = _state_property('searcher', "Embedding search backend.")
+    fusion = _state_property('fusion', "Dense/lexical fusion mode (None - dense only).")
+    exact_lookup = _state_property('exact_lookup', "Normalized training question -> row.")
+    cache = _state_property('cache', "Query cache of the serving build.")
+
+    @property
+    def model(self):
+        """The encoder (loaded on first use when ``lazy_model`` is set)."""
+        return self._state_model(self._state)
+
+    def _state_model(self, state: PipelineState):
+        """Returns the encoder of a build, loading it on first use."""
+        if state.model is None:
+            with state.model_lock:
+                if state.model is None:
+                    start = time.perf_counter()
+                    state.model = self._load_model(state.meta, state.path)
+                    self.diagnostics['model_load_seconds'] = time.perf_counter() - start
+                    self.diagnostics['encoder_backend'] = self.encoder_backend
+        return state.model
+
+    @staticmethod
+    def _read_meta(path: Path) -> dict:
+        """Reads meta.json of a build folder and checks that the files of the build exist."""
+        if not (path / 'meta.json').exists():
+            raise FileNotFoundError("Required file missing: meta.json")
+
+        with open(path / 'meta.json', 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+
+        if meta.get('packed'):
+            required_files = ['model_files', meta['packed']]
+        else:
+            required_files = ['model_files', 'question_embeddings.npy', 'answers.json']
         
         for file in required_files:
-            if not (self.base_path / file).exists():
+            if not (path / file).exists():
                 raise FileNotFoundError(f"Required file missing: {file}")
+        return meta
 
-        # Load the model
-        self.model = SentenceTransformer(str(self.base_path / 'model_files'))
-        
-        # Load embeddings
-        self.embeddings = np.load(self.base_path / 'question_embeddings.npy')
-        
-        # Load answers
-        with open(self.base_path / 'answers.json', 'r', encoding='utf-8') as f:
-            self.answers = json.load(f)
-        
-        # Load metadata
-        with open(self.base_path / 'meta.json', 'r', encoding='utf-8') as f:
-            self.meta = json.load(f)
+    def _load_state(self, path: Path, meta: dict, model=None, model_lock=None) -> PipelineState:
+        """Loads embeddings, answers, training questions and indexes of a build folder."""
+        corpus = Corpus.load(path, meta, self.mmap_mode,
+                             use_ann=self.use_ann, load_questions=self.exact_match,
+                             use_lexical=self.fusion_option is not None)
+        if len(corpus.matrix) != len(corpus.answer_ids):
+            raise ValueError("The pipeline files belong to different builds")
+
+        searcher = self._create_searcher(corpus, path)
+
+        if self.fusion_option == 'auto':
+            fusion = 'rrf' if corpus.lexical_index is not None else None
+        elif self.fusion_option is not None and corpus.lexical_index is None:
+            raise ValueError("The pipeline was built without a lexical index")
+        else:
+            fusion = self.fusion_option
+
+        # Exact-match lookup over the training questions
+        exact_lookup = {}
+        for idx, question in enumerate(corpus.questions or []):
+            exact_lookup.setdefault(normalize_question(question), idx)
+
+        return PipelineState(path, meta, corpus, searcher, fusion, exact_lookup,
+                             QueryCache(self.cache_size, self.cache_ttl), model, model_lock)
+
+    def _load_components(self, model=None, model_lock=None):
+        """Loads all components of the current build."""
+        start = time.perf_counter()
+        rss_before = current_rss()
+        path = current_build_dir(self.base_path)
+        meta = self._read_meta(path)
+
+        # Load the model (unless it is loaded on first use)
+        model_start = time.perf_counter()
+        if model is None and not self.lazy_model:
+            model = self._load_model(meta, path)
+            self.diagnostics['model_load_seconds'] = time.perf_counter() - model_start
+        model_loaded = time.perf_counter()
+
+        self._state = self._load_state(path, meta, model, model_lock)
+
+        finished = time.perf_counter()
+        self.diagnostics.update({
+            'startup_seconds': finished - start,
+            'corpus_load_seconds': finished - model_loaded,
+            'rss_before_load_bytes': rss_before,
+            'rss_after_load_bytes': current_rss(),
+            'encoder_backend': self.encoder_backend,
+            'mmap_mode': self.mmap_mode if isinstance(self.embeddings, np.memmap) else None,
+            'packed': bool(meta.get('packed')),
+            'storage_dtype': self.matrix.storage_dtype,
+            'search_backend': self.searcher.name,
+            'embeddings_bytes': self.matrix.nbytes,
+            'build_version': self.version,
+            'first_answer_seconds': None
+        })
+        self.diagnostics.setdefault('model_load_seconds', None)
 
-    def query(self, question: str, threshold: float = 0.7) -> dict:
+    def reload(self, force: bool = False, encoders: dict = None, model_locks: dict = None) -> bool:
         """
-        Main method to process a query.
+        Loads the build the pipeline folder currently points to and swaps it in.
+
+        The new build is loaded while queries are still served from the current
+        one, then replaces it in a single step: queries never wait, and a query
+        that started before the swap finishes on the build it started with. The
+        encoder is reused when ``model_info`` did not change. The query cache
+        of the new build starts empty.
+
+        :param force: Reload even if the current build is the serving one
+        :param encoders: Loaded encoders that may be used instead of loading one,
+            by ``encoder_key`` (e.g. shared by a registry)
+        :param model_locks: Locks of the shared encoders, by ``encoder_key``
+        :return: True if a new build was swapped in
+        :raises FileNotFoundError: if the build is incomplete (the serving build keeps serving)
         """
-        # Encode the question
-        question_embedding = self.model.encode([question])
-        
-        # Find the closest match
-        sim_scores = cosine_similarity(question_embedding, self.embeddings)[0]
-        best_idx = np.argmax(sim_scores)
-        best_score = float(sim_scores[best_idx])
-        
+        with self._reload_lock:
+            path = current_build_dir(self.base_path)
+            meta = self._read_meta(path)
+            version = build_version(meta)
+            current = self._state
+            if version == current.version and not force:
+                return False
+
+            start = time.perf_counter()
+            key = encoder_key(meta)
+            if key == encoder_key(current.meta):
+                model, model_lock = current.model, current.model_lock
+            else:
+                model, model_lock = (encoders or {}).get(key), (model_locks or {}).get(key)
+            reused_encoder = model is not None
+            if model is None and not self.lazy_model:
+                model = self._load_model(meta, path)
+            # A published build folder is never changed, so the loaded state is complete
+            state = self._load_state(path, meta, model, model_lock)
+
+            self._state = state
+            self.reloads += 1
+            self.diagnostics.update({
+                'build_version': version,
+                'last_reload_seconds': time.perf_counter() - start,
+                'reused_encoder': reused_encoder,
+                'storage_dtype': self.matrix.storage_dtype,
+                'search_backend': self.searcher.name,
+                'embeddings_bytes': self.matrix.nbytes,
+                'packed': bool(meta.get('packed'))
+            })
+            print(f"Pipeline reloaded: version {current.version} -> {version}")
+            return True
+
+    def watch(self, interval: float = 2.0):
+        """
+        Reloads the pipeline in a background thread whenever a new build is
+        published (the ``current`` file names another build folder).
+
+        :param interval: Seconds between checks
+        """
+        if self._watcher is not None:
+            return
+        self._stop_watching.clear()
+        self._watcher = threading.Thread(target=self._watch, args=(interval,), daemon=True,
+                                         name='pipeline-watch')
+        self._watcher.start()
+
+    def stop_watching(self):
+        """Stops the background reload thread."""
+        if self._watcher is not None:
+            self._stop_watching.set()
+            self._watcher.join()
+            self._watcher = None
+
+    def _watch(self, interval: float):
+        last_seen = self._state.path
+        while not self._stop_watching.wait(interval):
+            try:
+                seen = current_build_dir(self.base_path)
+                if seen != last_seen:
+                    self.reload()
+                    last_seen = seen
+            except Exception as e:
+                # Keep serving the current build and try again at the next check
+                print(f"Pipeline reload failed: {str(e)}")
+
+    def _create_searcher(self, corpus: Corpus, path: Path) -> SearchBackend:
+        """Creates the embedding search backend of a build folder."""
+        params = dict(self.search_params)
+        if self.n_probe is not None:
+            params.setdefault('n_probe', self.n_probe)
+        return create_search_backend(corpus, path, self.search_backend, params)
+
+    def _load_model(self, meta: dict, path: Path):
+        """Loads the encoder of a build folder, preferring the exported ONNX model when allowed."""
+        start = time.perf_counter()
+        from sentence_transformers import SentenceTransformer
+        self.diagnostics['model_import_seconds'] = time.perf_counter() - start
+
+        model_path = str(path / 'model_files')
+        onnx_meta = meta['model_info'].get('onnx')
+
+        if self.backend in ('auto', 'onnx') and onnx_meta:
+            try:
+                model = SentenceTransformer(model_path, backend='onnx',
+                                            model_kwargs={'file_name': onnx_meta['file_name']})
+                self.encoder_backend = 'onnx'
+                return model
+            except Exception as e:
+                if self.backend == 'onnx':
+                    raise
+                print(f"ONNX encoder unavailable, falling back to torch: {str(e)}")
+        elif self.backend == 'onnx':
+            raise ValueError("The pipeline was built without an ONNX export")
+
+        self.encoder_backend = 'torch'
+        return SentenceTransformer(model_path)
+
+    def get_diagnostics(self) -> dict:
+        """
+        Returns startup and memory diagnostics.
+
+        :return: {
+            'startup_seconds': float,
+            'model_load_seconds': float,
+            'corpus_load_seconds': float,
+            'rss_before_load_bytes': int|None,
+            'rss_after_load_bytes': int|None,
+            'rss_bytes': int|None,
+            'model_import_seconds': float|None,
+            'first_answer_seconds': float|None (from Pipeline() to the first answer),
+            'encoder_backend': str,
+            'mmap_mode': str|None,
+            'packed': bool,
+            'storage_dtype': str,
+            'search_backend': str,
+            'embeddings_bytes': int,
+            'build_version': str,
+            'reloads': int,
+            'last_reload_seconds': float (after a reload),
+            'reused_encoder': bool (after a reload),
+            'encoding': {
+                'sequences': int,
+                'tokens': int,
+                'padded_tokens': int,
+                'seconds': float,
+                'padding_efficiency': float,
+                'tokens_per_second': float
+            }
+        }
+        """
+        stats = self.encode_stats
+        encoding = {
+            **stats,
+            'padding_efficiency': stats['tokens'] / stats['padded_tokens'] if stats['padded_tokens'] else 1.0,
+            'tokens_per_second': stats['tokens'] / stats['seconds'] if stats['seconds'] else 0.0
+        }
+        return {**self.diagnostics, 'rss_bytes': current_rss(), 'reloads': self.reloads,
+                'encoding': encoding}
+
+    def corpus_bytes(self) -> int:
+        """
+        Returns the approximate memory used by the corpus (embeddings, index,
+        answers and exact-match lookup), excluding the encoder.
+        """
+        state = self._state
+        total = state.matrix.nbytes + state.answer_ids.nbytes + state.searcher.nbytes
+        total += sum(sys.getsizeof(answer) for answer in state.answers)
+        total += sum(sys.getsizeof(key) + 8 for key in state.exact_lookup)
+        return int(total)
+
+    def cache_info(self) -> dict:
+        """
+        Returns query cache counters (the cache starts empty after a reload).
+
+        :return: {
+            'hits': int,
+            'misses': int,
+            'exact_hits': int,
+            'evictions': int,
+            'size': int,
+            'max_size': int,
+            'hit_rate': float
+        }
+        """
+        cache = self.cache
+        total = cache.hits + cache.misses + self.exact_hits
         return {
-            'answer': self.answers[best_idx] if best_score > threshold else None,
+            'hits': cache.hits,
+            'misses': cache.misses,
+            'exact_hits': self.exact_hits,
+            'evictions': cache.evictions,
+            'size': len(cache),
+            'max_size': cache.max_size,
+            'hit_rate': (cache.hits + self.exact_hits) / total if total > 0 else 0
+        }
+
+    def clear_cache(self):
+        """Clears the query cache."""
+        self.cache.clear()
+
+    def get_metrics(self, format: str = 'json', labels: dict = None):
+        """
+        Returns the hot-path metrics (see ``Metrics.snapshot``).
+
+        :param format: 'json' (dict) or 'prometheus' (text exposition format)
+        :param labels: Labels for the Prometheus samples
+        :return: dict, str, or None when metrics are disabled
+        """
+        if self.metrics is None:
+            return None
+        snapshot = self.metrics.snapshot()
+        if format == 'prometheus':
+            return prometheus_text(snapshot, labels=labels)
+        return snapshot
+
+    def _search(self, question_embeddings: np.ndarray, k: int = 1, state: PipelineState = None):
+        """
+        Finds the best stored questions for each query embedding.
+
+        :param question_embeddings: Normalized query embeddings of shape (m, dim)
+        :param k: Number of rows per query
+        :param state: Build to search (default is the serving one)
+        :return: (ids, scores) arrays of shape (m, k), best first
+        """
+        state = state or self._state
+        start = time.perf_counter()
+        result = state.searcher.search(question_embeddings, k=k)
+        self._observe('search', start)
+        return result
+
+    def _retrieve(self, texts: list, question_embeddings: np.ndarray, k: int = 1,
+                  state: PipelineState = None, ranking: bool = False):
+        """
+        Finds the best stored questions for each query, fusing dense and BM25
+        results when the pipeline has a lexical index (see ``fusion``).
+
+        :param texts: Query texts
+        :param question_embeddings: Their normalized embeddings of shape (m, dim)
+        :param k: Number of rows per query
+        :param state: Build to search (default is the serving one)
+        :param ranking: Also return the scores the rows are ranked by (the fused
+            score with 'rrf', otherwise the scores themselves)
+        :return: (ids, scores) arrays of shape (m, k), best first; missing
+            results are filled with id -1 and score -inf. With ``ranking``,
+            (ids, scores, ranking scores)
+        """
+        state = state or self._state
+        if state.fusion is None:
+            ids, scores = self._search(question_embeddings, k=k, state=state)
+            return (ids, scores, scores) if ranking else (ids, scores)
+
+        depth = max(k, self.fusion_depth)
+        start = time.perf_counter()
+        lexical = [state.lexical_index.search(text, max(depth, self.lexical_candidates or 0))
+                   for text in texts]
+        self._observe('lexical', start)
+
+        # Dense results: the full search, or only the lexical candidates (pre-filter)
+        if self.lexical_candidates:
+            # Both kinds of dense search are recorded as one 'search' observation
+            start = time.perf_counter()
+            dense = [None] * len(texts)
+            full = [i for i, (ids, _) in enumerate(lexical) if not len(ids)]
+            if full:
+                for i, ids, scores in zip(full, *state.searcher.search(question_embeddings[full], k=depth)):
+                    dense[i] = (ids, scores)
+            for i, (ids, _) in enumerate(lexical):
+                if len(ids):
+                    rows = ids[:self.lexical_candidates]
+                    order, scores = top_k(state.matrix.score_rows(rows, question_embeddings[i][None]), depth)
+                    dense[i] = (rows[order[0]], scores[0])
+            self._observe('search', start)
+        else:
+            dense = list(zip(*self._search(question_embeddings, k=depth, state=state)))
+
+        result_ids = np.full((len(texts), k), -1, dtype=np.int64)
+        result_scores = np.full((len(texts), k), -np.inf, dtype=np.float32)
+        result_ranking = np.full((len(texts), k), -np.inf, dtype=np.float32)
+        for i, ((dense_ids, dense_scores), (lexical_ids, lexical_scores)) in enumerate(zip(dense, lexical)):
+            valid = dense_ids >= 0
+            dense_ids, dense_scores = dense_ids[valid], dense_scores[valid]
+            lexical_ids, lexical_scores = lexical_ids[:depth], lexical_scores[:depth]
+            candidates = np.unique(np.concatenate([dense_ids, lexical_ids]))
+            if not len(candidates):
+                continue
+
+            # Cosine similarity of every candidate (lexical-only ones are scored here)
+            cosine = state.matrix.score_rows(candidates, question_embeddings[i][None])[0]
+            positions = {int(row): j for j, row in enumerate(candidates)}
+            if state.fusion == 'rrf':
+                fused = np.zeros(len(candidates), dtype=np.float32)
+                for ranked in (dense_ids, lexical_ids):
+                    for rank, row in enumerate(ranked):
+                        fused[positions[int(row)]] += 1.0 / (60 + rank + 1)
+                scores = cosine
+            else:
+                lexical_norm = np.zeros(len(candidates), dtype=np.float32)
+                if len(lexical_ids):
+                    lexical_norm[[positions[int(row)] for row in lexical_ids]] = \
+                        lexical_scores / lexical_scores[0]
+                fused = scores = (1 - self.lexical_weight) * cosine + self.lexical_weight * lexical_norm
+
+            order = np.argsort(-fused, kind='stable')[:k]
+            result_ids[i, :len(order)] = candidates[order]
+            result_scores[i, :len(order)] = scores[order]
+            result_ranking[i, :len(order)] = fused[order]
+        if ranking:
+            return result_ids, result_scores, result_ranking
+        return result_ids, result_scores
+
+    def _observe(self, stage: str, start: float):
+        """Records the time since ``start`` for a stage (if metrics are enabled)."""
+        if self.metrics is not None:
+            self.metrics.observe(stage, time.perf_counter() - start)
+
+    def _top_answers(self, question_embeddings: np.ndarray, top_k: int, texts: list = None,
+                     state: PipelineState = None) -> list:
+        """
+        Finds the best rows with distinct answers for each query.
+
+        Rows are fetched with a partial sort and deduplicated by answer id;
+        if too few distinct answers are found, more rows are fetched.
+
+        :param question_embeddings: Normalized query embeddings of shape (m, dim)
+        :param top_k: Number of distinct answers per query
+        :param texts: Query texts (needed for lexical fusion)
+        :param state: Build to search (default is the serving one)
+        :return: For each query a list of (row, score, ranking score), best first,
+            with up to max(top_k, 2) distinct answers (the second one is used for
+            the margin). The ranking score is the score the answers are ordered by:
+            the fused score with 'rrf' fusion, otherwise the score itself.
+        """
+        state = state or self._state
+        wanted = max(top_k, 2)
+        n = len(state.matrix)
+        k_rows = min(n, max(4 * wanted, 16))
+        results = [None] * len(question_embeddings)
+        todo = list(range(len(question_embeddings)))
+
+        while todo:
+            if texts is not None and state.fusion is not None:
+                ids, scores, ranking = self._retrieve([texts[i] for i in todo], question_embeddings[todo],
+                                                      k=k_rows, state=state, ranking=True)
+            else:
+                ids, scores = self._search(question_embeddings[todo], k=k_rows, state=state)
+                ranking = scores
+            retry = []
+            for j, i in enumerate(todo):
+                groups = {}
+                for row, score, rank_score in zip(ids[j], scores[j], ranking[j]):
+                    if row < 0:
+                        continue
+                    answer_id = int(state.answer_ids[row])
+                    if answer_id not in groups:
+                        groups[answer_id] = (int(row), float(score), float(rank_score))
+                        if len(groups) == wanted:
+                            break
+                if len(groups) < wanted and k_rows < n:
+                    retry.append(i)
+                else:
+                    results[i] = list(groups.values())
+            todo = retry
+            k_rows = min(n, k_rows * 4)
+
+        return results
+
+    def _encode(self, texts: list, batch_size: int, state: PipelineState = None) -> np.ndarray:
+        """
+        Encodes queries; several queries are bucketed by token length
+        so padding stays small (their totals are kept in ``encode_stats``).
+
+        :param state: Build whose encoder is used (default is the serving one)
+        :return: Normalized float32 embeddings
+        """
+        state = state or self._state
+        model = self._state_model(state)
+        start = time.perf_counter()
+        if len(texts) == 1:
+            # A single text needs no length pass; tokenization is part of the encode stage
+            with state.model_lock:
+                embeddings = model.encode(
+                    texts, normalize_embeddings=True, convert_to_numpy=True
+                ).astype(np.float32)
+            self._observe('encode', start)
+        else:
+            with state.model_lock:
+                embeddings, stats = encode_length_bucketed(model, texts, batch_size)
+            self.encode_stats['sequences'] += stats['sequences']
+            self.encode_stats['tokens'] += stats['tokens']
+            self.encode_stats['padded_tokens'] += stats['padded_tokens']
+            self.encode_stats['seconds'] += time.perf_counter() - start
+            if self.metrics is not None:
+                self.metrics.observe('tokenize', stats['tokenize_seconds'])
+                self.metrics.observe('encode', stats['encode_seconds'])
+        if self.metrics is not None:
+            self.metrics.increment('encoded', len(texts))
+        return embeddings
+
+    def _match_batch(self, questions: list, batch_size: int = 64, state: PipelineState = None):
+        """
+        Finds the best stored question for each query, using the exact-match
+        lookup and the cache first and encoding only the remaining questions.
+
+        :return: (best_idx, best_scores) lists
+        """
+        state = state or self._state
+        start = time.perf_counter()
+        keys = [normalize_question(q) for q in questions]
+        best_idx = [0] * len(questions)
+        best_scores = [0.0] * len(questions)
+
+        # Questions that have to go through the model, grouped by normalized text
+        pending = {}
+        exact_hits = cache_hits = 0
+        for i, key in enumerate(keys):
+            if key in state.exact_lookup:
+                best_idx[i], best_scores[i] = state.exact_lookup[key], 1.0
+                exact_hits += 1
+                continue
+            cached = state.cache.get(key) if key not in pending else None
+            if cached is not None:
+                best_idx[i], best_scores[i] = cached['best_idx'], cached['score']
+                cache_hits += 1
+            else:
+                pending.setdefault(key, []).append(i)
+
+        self.exact_hits += exact_hits
+        if self.metrics is not None:
+            self.metrics.increment('exact_hits', exact_hits)
+            self.metrics.increment('cache_hits', cache_hits)
+        self._observe('lookup', start)
+
+        if pending:
+            # Encode the remaining questions
+            texts = [questions[positions[0]] for positions in pending.values()]
+            question_embeddings = self._encode(texts, batch_size, state)
+
+            # Find the closest match for every question at once
+            found_idx, found_scores = self._retrieve(texts, question_embeddings, state=state)
+            found_idx, found_scores = found_idx[:, 0], found_scores[:, 0]
+            for j, (key, positions) in enumerate(pending.items()):
+                idx, score = int(found_idx[j]), float(found_scores[j])
+                state.cache.put(key, {
+                    'embedding': question_embeddings[j],
+                    'best_idx': idx,
+                    'score': score
+                })
+                for i in positions:
+                    best_idx[i], best_scores[i] = idx, score
+
+        return best_idx, best_scores
+
+    def _match_top_k(self, questions: list, top_k: int, batch_size: int = 64,
+                     state: PipelineState = None) -> list:
+        """
+        Finds the best distinct answers for each query, reusing cached query
+        embeddings and encoding only the remaining questions.
+
+        :return: For each query a list of (row, score, ranking score), best first
+            (see ``_top_answers``)
+        """
+        state = state or self._state
+        start = time.perf_counter()
+        keys = [normalize_question(q) for q in questions]
+        question_embeddings = [None] * len(questions)
+
+        pending = {}
+        cache_hits = 0
+        for i, key in enumerate(keys):
+            cached = state.cache.get(key) if key not in pending else None
+            if cached is not None:
+                question_embeddings[i] = cached['embedding']
+                cache_hits += 1
+            else:
+                pending.setdefault(key, []).append(i)
+
+        if self.metrics is not None:
+            self.metrics.increment('cache_hits', cache_hits)
+        self._observe('lookup', start)
+
+        if pending:
+            texts = [questions[positions[0]] for positions in pending.values()]
+            for vector, positions in zip(self._encode(texts, batch_size, state), pending.values()):
+                for i in positions:
+                    question_embeddings[i] = vector
+
+        matches = self._top_answers(np.stack(question_embeddings), top_k, texts=questions, state=state)
+
+        for key, positions in pending.items():
+            best = matches[positions[0]]
+            if best:
+                state.cache.put(key, {
+                    'embedding': question_embeddings[positions[0]],
+                    'best_idx': best[0][0],
+                    'score': best[0][1]
+                })
+        return matches
+
+    def query(self, question: str, threshold: float = 0.7, top_k: int = None) -> dict:
+        """
+        Main method to process a query.
+
+        :param question: Question text
+        :param threshold: Similarity threshold
+        :param top_k: Also return the k best distinct answers ('top_k') and the
+            score margin between the best and the second-best answer ('margin');
+            with 'rrf' fusion the answers are ranked and the margin measured by
+            the fused score
+        """
+        return self.query_batch([question], threshold, batch_size=1, top_k=top_k)[0]
+
+    def query_batch(self, questions: list, threshold=0.7, batch_size: int = 64,
+                    top_k: int = None) -> list:
+        """
+        Processes many queries at once.
+
+        All questions that are not cached are encoded in batches of ``batch_size``
+        and scored against the stored embeddings with a single matrix multiplication.
+
+        :param questions: List of question texts
+        :param threshold: Similarity threshold, or a list with one threshold per question
+        :param batch_size: Batch size for question encoding
+        :param top_k: Also return the k best distinct answers and the margin (see ``query``)
+        :return: List of results in the same format as ``query``
+        """
+        if not questions:
+            return []
+
+        if isinstance(threshold, (list, tuple)):
+            thresholds = threshold
+        else:
+            thresholds = [threshold] * len(questions)
+
+        start = time.perf_counter()
+        # One snapshot of the serving build for the whole batch (a reload may swap it meanwhile)
+        results = self._query_batch(questions, thresholds, batch_size, top_k, self._state)
+        if self.diagnostics['first_answer_seconds'] is None:
+            self.diagnostics['first_answer_seconds'] = time.perf_counter() - self._created_at
+        if self.metrics is not None:
+            self._observe('query', start)
+            self.metrics.record_results([r['score'] for r in results],
+                                        sum(r['is_match'] for r in results))
+        return results
+
+    def _query_batch(self, questions: list, thresholds: list, batch_size: int, top_k: int,
+                     state: PipelineState) -> list:
+        if top_k:
+            matches = self._match_top_k(list(questions), top_k, batch_size=batch_size, state=state)
+            start = time.perf_counter()
+            results = [
+                self._make_result(state, *(best[0][:2] if best else (0, float('-inf'))), t, best, top_k)
+                for best, t in zip(matches, thresholds)
+            ]
+        else:
+            best_idx, best_scores = self._match_batch(list(questions), batch_size=batch_size, state=state)
+            start = time.perf_counter()
+            results = [
+                self._make_result(state, idx, score, t)
+                for idx, score, t in zip(best_idx, best_scores, thresholds)
+            ]
+        self._observe('answer', start)
+        return results
+
+    def _make_result(self, state: PipelineState, best_idx: int, best_score: float, threshold: float,
+                     top_answers: list = None, top_k: int = None) -> dict:
+        """Builds the result dictionary for the best match."""
+        result = {
+            'answer': state.answers[state.answer_ids[best_idx]] if best_score > threshold else None,
             'score': best_score,
             'is_match': best_score > threshold,
-            'strategy': self.meta['training_params']['answer_strategy']
+            'strategy': state.meta['training_params']['answer_strategy'],
+            'version': state.version
         }
+        if top_answers is not None:
+            result['top_k'] = [
+                {'answer': state.answers[state.answer_ids[row]], 'score': score}
+                for row, score, _ in top_answers[:top_k]
+            ]
+            # Measured on the score the answers are ranked by, so it is never negative
+            result['margin'] = top_answers[0][2] - top_answers[1][2] if len(top_answers) > 1 else None
+        return result
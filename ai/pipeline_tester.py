@@ -1,57 +1,180 @@
 import numpy as np
+import csv
 import json
+import time
+import weakref
+from collections import deque
 from datetime import datetime
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 from pathlib import Path
+from ai.pipeline import Pipeline, Corpus, create_search_backend, Metrics, Histogram, SCORE_BUCKETS, prometheus_text, \
+    current_build_dir
+
+
+class QueryLogSink:
+    """
+    Append-only JSONL or CSV log of queries, written to disk in batches.
+    Records still buffered are written when the sink is garbage collected
+    or the interpreter exits.
+    """
+
+    FIELDS = ('timestamp', 'question', 'answer', 'score', 'is_match')
+
+    def __init__(self, path, format=None, batch_size=100):
+        """
+        :param path: Log file (appended to if it exists)
+        :param format: 'jsonl' or 'csv' (default is taken from the file extension)
+        :param batch_size: Number of records buffered before they are written
+        """
+        self.path = Path(path)
+        self.format = format or ('csv' if self.path.suffix.lower() == '.csv' else 'jsonl')
+        if self.format not in ('jsonl', 'csv'):
+            raise ValueError(f"Invalid log format: {self.format}")
+        self.batch_size = batch_size
+        self._buffer = []
+        # Holds the buffer, not the sink, so the sink can still be collected
+        self._finalizer = weakref.finalize(self, self._write_records, self.path, self.format, self._buffer)
+
+    def write(self, record):
+        """Buffer a record and write the buffer when it is full"""
+        self._buffer.append(record)
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered records"""
+        self._write_records(self.path, self.format, self._buffer)
+
+    @classmethod
+    def _write_records(cls, path, format, records):
+        """Appends the records to the log file and empties the list"""
+        if not records:
+            return
+        if format == 'csv':
+            new_file = not path.exists() or path.stat().st_size == 0
+            with open(path, 'a', encoding='utf-8', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=cls.FIELDS, extrasaction='ignore')
+                if new_file:
+                    writer.writeheader()
+                writer.writerows(records)
+        else:
+            with open(path, 'a', encoding='utf-8') as f:
+                f.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        records.clear()
+
+    def close(self):
+        self.flush()
+
 
 class PipelineTester:
-    def __init__(self, model_name, models_path="build"):
+    def __init__(self, model_name, models_path="build", mmap_mode=None, metrics=True,
+                 log_capacity=1000, log_sink=None, search_backend=None, search_params=None,
+                 fusion=None):
         """
         :param model_name: Name of the trained model (e.g. 'faq_model')
         :param models_path: Path to the folder with trained models (default is 'build')
+        :param mmap_mode: Memory-map the embeddings instead of reading them into RAM (e.g. 'r')
+        :param metrics: Collect hot-path metrics (True), use the given ``Metrics`` instance, or disable them (False)
+        :param log_capacity: Number of recent queries kept in memory (older ones are dropped)
+        :param log_sink: Path of a JSONL/CSV file (or a QueryLogSink) every query is appended to
+        :param search_backend: Embedding search backend (default is the one the pipeline was built with)
+        :param search_params: Search backend parameters
+        :param fusion: Dense and BM25 fusion of pipelines built with a lexical index,
+            as in ``Pipeline`` ('rrf', 'weighted', 'auto'; None - dense only, the
+            ``Pipeline`` default); ignored for pipelines built without one
         """
         self.models_path = Path(models_path)
+        self.mmap_mode = mmap_mode
         self.model_path = self.models_path / model_name
+        self.build_path = None
         self.model = None
+        self.matrix = None
         self.embeddings = None
         self.answers = None
+        self.answer_ids = None
         self.meta = None
-        self.stats = {
+        self.search_backend = search_backend
+        self.search_params = search_params
+        self.searcher = None
+        self.fusion = fusion
+        self.pipeline = None
+        self.metrics = Metrics() if metrics is True else (metrics or None)
+        self.log_capacity = log_capacity
+        if log_sink is not None and not isinstance(log_sink, QueryLogSink):
+            log_sink = QueryLogSink(log_sink)
+        self.log_sink = log_sink
+        self.stats = self._new_stats(0.7)
+        self._load_model()
+
+    def _new_stats(self, threshold):
+        return {
             'total_queries': 0,
             'matches': 0,
-            'threshold': 0.7,
-            'queries': []
+            'threshold': threshold,
+            'score_sum': 0.0,
+            'score_histogram': Histogram(SCORE_BUCKETS, lower=-1.0),
+            'queries': deque(maxlen=self.log_capacity)
         }
-        self._load_model()
 
     def _load_model(self):
         """Load the model and data from the folder of the trained model"""
         if not self.model_path.exists():
             raise FileNotFoundError(f"Model directory not found: {self.model_path}")
 
-        # Load the model from saved files
-        model_files_path = self.model_path / 'model_files'
+        # Load the model from saved files of the current build
+        self.build_path = current_build_dir(self.model_path)
+        model_files_path = self.build_path / 'model_files'
         if not model_files_path.exists():
             raise FileNotFoundError(f"Model files not found in {model_files_path}")
         
         self.model = SentenceTransformer(str(model_files_path))
         
         # Load the other components
-        self.embeddings = np.load(self.model_path / 'question_embeddings.npy')
-        
-        with open(self.model_path / 'answers.json', 'r', encoding='utf-8') as f:
-            self.answers = json.load(f)
-            
-        with open(self.model_path / 'meta.json', 'r', encoding='utf-8') as f:
+        with open(self.build_path / 'meta.json', 'r', encoding='utf-8') as f:
             self.meta = json.load(f)
 
+        if self.fusion is not None and self.meta.get('lexical_index'):
+            # Searched through Pipeline, so the answers match the served ones
+            # (its query cache and exact-match lookup are disabled)
+            self.pipeline = Pipeline(base_path=str(self.build_path), model=self.model, mmap_mode=self.mmap_mode,
+                                     cache_size=0, exact_match=False, metrics=False, fusion=self.fusion,
+                                     search_backend=self.search_backend, search_params=self.search_params)
+            self.answers = self.pipeline.answers
+            self.answer_ids = self.pipeline.answer_ids
+            self.matrix = self.pipeline.matrix
+            self.searcher = self.pipeline.searcher
+        else:
+            corpus = Corpus.load(self.build_path, self.meta, self.mmap_mode,
+                                 load_questions=False, use_lexical=False)
+            self.answers = corpus.answers
+            self.answer_ids = corpus.answer_ids
+            self.matrix = corpus.matrix
+            self.searcher = create_search_backend(corpus, self.build_path, self.search_backend,
+                                                  self.search_params)
+        self.embeddings = self.matrix.data
+
+    @property
+    def retrieval(self):
+        """How the best match is found: 'dense' or the fusion method"""
+        return (self.pipeline.fusion if self.pipeline is not None else None) or 'dense'
+
+    def retrieve(self, questions, question_embeddings):
+        """
+        Finds the best stored question for each query, as the served pipeline does
+        :param questions: Query texts (used by lexical fusion)
+        :param question_embeddings: Their normalized float32 embeddings of shape (m, dim)
+        :return: (ids, scores) arrays of shape (m, 1); id -1 and score -inf if nothing was found
+        """
+        if self.pipeline is not None:
+            return self.pipeline._retrieve(list(questions), question_embeddings, k=1)
+        return self.searcher.search(question_embeddings, k=1)
+
     def get_trained_models(self):
         """Returns a list of trained models (similar to Education.get_trained_models)"""
         models = []
         for model_dir in self.models_path.iterdir():
             if model_dir.is_dir():
-                meta_path = model_dir / 'meta.json'
+                meta_path = current_build_dir(model_dir) / 'meta.json'
                 if meta_path.exists():
                     with open(meta_path, 'r', encoding='utf-8') as f:
                         try:
@@ -85,18 +208,23 @@ class PipelineTester:
         self.stats['total_queries'] += 1
 
         # Encode the question
-        question_embedding = self.model.encode([question])
+        start = time.perf_counter()
+        question_embedding = self.model.encode(
+            [question], normalize_embeddings=True, convert_to_numpy=True
+        )[0]
+        encoded = time.perf_counter()
         
         # Find the closest match
-        sim_scores = cosine_similarity(question_embedding, self.embeddings)[0]
-        best_idx = np.argmax(sim_scores)
-        best_score = float(sim_scores[best_idx])
+        ids, scores = self.retrieve([question], question_embedding[None].astype(np.float32))
+        searched = time.perf_counter()
+        best_idx = int(ids[0, 0])
+        best_score = float(scores[0, 0])
         is_match = best_score > threshold
         
         # Record the statistics
         result = {
             'question': question,
-            'answer': self.answers[best_idx] if is_match else None,
+            'answer': self.answers[self.answer_ids[best_idx]] if is_match else None,
             'score': best_score,
             'is_match': is_match,
             'timestamp': datetime.now().isoformat()
@@ -104,8 +232,23 @@ class PipelineTester:
         
         if is_match:
             self.stats['matches'] += 1
+        # A query nothing was found for has no score (-inf)
+        if np.isfinite(best_score):
+            self.stats['score_sum'] += best_score
+            self.stats['score_histogram'].observe(best_score)
+
+        if self.metrics is not None:
+            finished = time.perf_counter()
+            self.metrics.observe('encode', encoded - start)
+            self.metrics.observe('search', searched - encoded)
+            self.metrics.observe('answer', finished - searched)
+            self.metrics.observe('query', finished - start)
+            self.metrics.increment('encoded')
+            self.metrics.record_results([best_score], int(is_match))
             
         self.stats['queries'].append(result)
+        if self.log_sink is not None:
+            self.log_sink.write(result)
         return result
 
     def get_stats(self, reset=False):
@@ -117,14 +260,26 @@ class PipelineTester:
             'matches': int,
             'match_rate': float,
             'threshold': float,
+            'mean_score': float|None (over the queries that found a match candidate),
+            'score_p50': float|None,
+            'score_p95': float|None,
+            'score_distribution': {'0.65..0.70': int, ...} (non-empty buckets only),
+            'logged_queries': int (kept in memory),
             'last_query': dict|None
         }
         """
+        total = self.stats['total_queries']
+        histogram = self.stats['score_histogram']
         stats = {
-            'total_queries': self.stats['total_queries'],
+            'total_queries': total,
             'matches': self.stats['matches'],
-            'match_rate': self.stats['matches'] / self.stats['total_queries'] if self.stats['total_queries'] > 0 else 0,
+            'match_rate': self.stats['matches'] / total if total > 0 else 0,
             'threshold': self.stats['threshold'],
+            'mean_score': self.stats['score_sum'] / histogram.count if histogram.count > 0 else None,
+            'score_p50': histogram.quantile(0.5),
+            'score_p95': histogram.quantile(0.95),
+            'score_distribution': self._score_distribution(),
+            'logged_queries': len(self.stats['queries']),
             'last_query': self.stats['queries'][-1] if self.stats['queries'] else None
         }
         
@@ -133,14 +288,55 @@ class PipelineTester:
             
         return stats
 
-    def reset_stats(self):
-        """Reset statistics"""
-        self.stats = {
-            'total_queries': 0,
-            'matches': 0,
-            'threshold': self.stats['threshold'],
-            'queries': []
+    def _score_distribution(self):
+        """Counts of best scores per 0.05 bucket"""
+        histogram = self.stats['score_histogram']
+        bounds = (histogram.lower,) + histogram.bounds
+        distribution = {
+            f'{bounds[i]:.2f}..{bounds[i + 1]:.2f}': count
+            for i, count in enumerate(histogram.counts[:-1]) if count
         }
+        if histogram.counts[-1]:
+            distribution[f'>{bounds[-1]:.2f}'] = histogram.counts[-1]
+        return distribution
+
+    def get_recent_queries(self, n=None):
+        """
+        Get the most recent queries (at most log_capacity are kept)
+        :param n: Number of queries (None for all kept)
+        :return: list of query results, oldest first
+        """
+        queries = list(self.stats['queries'])
+        return queries[-n:] if n else queries
+
+    def get_metrics(self, format='json', labels=None):
+        """
+        Get the hot-path metrics (see Metrics.snapshot)
+        :param format: 'json' (dict) or 'prometheus' (text exposition format)
+        :param labels: Labels for the Prometheus samples
+        :return: dict, str, or None when metrics are disabled
+        """
+        if self.metrics is None:
+            return None
+        snapshot = self.metrics.snapshot()
+        if format == 'prometheus':
+            return prometheus_text(snapshot, labels=labels)
+        return snapshot
+
+    def reset_stats(self):
+        """Reset statistics (logged queries are flushed to the sink first)"""
+        self.flush_log()
+        self.stats = self._new_stats(self.stats['threshold'])
+
+    def flush_log(self):
+        """Write the buffered log records to the sink"""
+        if self.log_sink is not None:
+            self.log_sink.flush()
+
+    def close(self):
+        """Flush and close the query log sink"""
+        if self.log_sink is not None:
+            self.log_sink.close()
 
     def set_threshold(self, threshold):
         """Set the similarity threshold"""
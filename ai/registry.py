@@ -0,0 +1,236 @@
+import contextlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+from ai.pipeline import Pipeline, encoder_key, current_build_dir
+from ai.tools import get_built_pipelines
+
+
+class PipelineRegistry:
+    """
+    Serves many built pipelines from one process.
+
+    Pipelines are loaded on first use. Pipelines whose ``meta.json`` describes
+    the same encoder (``model_info``) share one encoder instance and the lock
+    it encodes under. With ``lazy_model`` an encoder is shared once one of its
+    pipelines has loaded it. When the
+    corpora of loaded pipelines exceed the memory budget, the least recently
+    used ones are unloaded. Pipelines reloaded with a new build (see
+    ``reload``, or ``watch_interval`` in the pipeline parameters) are accounted
+    with their new corpus and encoder.
+    """
+
+    def __init__(self, target_dir: str = "build", memory_budget_bytes: Optional[int] = None,
+                 **pipeline_params):
+        """
+        :param target_dir: Directory with built pipelines
+        :param memory_budget_bytes: Maximum corpus memory of loaded pipelines (None - unlimited).
+            Encoders are not counted.
+        :param pipeline_params: Parameters passed to every Pipeline (e.g. mmap_mode='r')
+        """
+        self.target_dir = Path(target_dir)
+        self.memory_budget_bytes = memory_budget_bytes
+        self.pipeline_params = pipeline_params
+        self._pipelines: "OrderedDict[str, Pipeline]" = OrderedDict()
+        self._resident: Dict[str, int] = {}
+        # Version and encoder key of each loaded pipeline when it was last accounted
+        self._versions: Dict[str, str] = {}
+        self._encoder_keys: Dict[str, str] = {}
+        self._encoders: Dict[str, dict] = {}
+        # The registry lock only guards the bookkeeping; loads hold a lock of
+        # their pipeline (and of a new encoder), so other pipelines stay available
+        self._lock = threading.RLock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self._encoder_locks: Dict[str, threading.Lock] = {}
+        self.loads = 0
+        self.evictions = 0
+
+    @staticmethod
+    def encoder_key(meta: dict) -> str:
+        """Returns the key under which pipelines share an encoder."""
+        return encoder_key(meta)
+
+    def available(self) -> list:
+        """Returns the built pipelines that can be loaded."""
+        return get_built_pipelines(str(self.target_dir))
+
+    def get(self, name: str) -> Pipeline:
+        """
+        Returns a loaded pipeline, loading it on first use.
+
+        :param name: Pipeline name (folder in the target directory)
+        """
+        pipeline = self._loaded(name)
+        if pipeline is not None:
+            return pipeline
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        with load_lock:
+            # Loaded by another thread while this one waited
+            pipeline = self._loaded(name)
+            if pipeline is not None:
+                return pipeline
+            return self._load(name)
+
+    def reload(self, name: str, force: bool = False) -> bool:
+        """
+        Loads a new build of a loaded pipeline (see ``Pipeline.reload``). A new
+        encoder is shared with the other pipelines that use it.
+
+        :param name: Pipeline name
+        :param force: Reload even if the build did not change
+        :return: True if a new build was swapped in
+        """
+        with self._lock:
+            pipeline = self._pipelines.get(name)
+            if pipeline is None:
+                return False
+            encoders = {key: encoder['model'] for key, encoder in self._encoders.items()
+                        if encoder['model'] is not None}
+            model_locks = {key: encoder['lock'] for key, encoder in self._encoders.items()}
+        reloaded = pipeline.reload(force=force, encoders=encoders, model_locks=model_locks)
+        self._loaded(name)
+        return reloaded
+
+    def query(self, name: str, question: str, threshold: float = 0.7) -> dict:
+        """Queries a pipeline by name."""
+        return self.get(name).query(question, threshold)
+
+    def query_batch(self, name: str, questions: list, threshold=0.7, batch_size: int = 64) -> list:
+        """Queries a pipeline by name with many questions."""
+        return self.get(name).query_batch(questions, threshold, batch_size)
+
+    def unload(self, name: str):
+        """Unloads a pipeline and releases its encoder if no other pipeline uses it."""
+        with self._lock:
+            pipeline = self._pipelines.pop(name, None)
+            if pipeline is None:
+                return
+            self._resident.pop(name, None)
+            self._versions.pop(name, None)
+            self._release_encoder(name, self._encoder_keys.pop(name, None))
+
+    def stats(self) -> dict:
+        """
+        Returns the registry state.
+
+        :return: {
+            'loaded': [{'name': str, 'resident_bytes': int, 'encoder': str}, ...] (least recently used first),
+            'resident_bytes': int,
+            'memory_budget_bytes': int|None,
+            'encoders': int,
+            'loads': int,
+            'evictions': int
+        }
+        """
+        with self._lock:
+            return {
+                'loaded': [
+                    {
+                        'name': name,
+                        'resident_bytes': self._resident.get(name, 0),
+                        'encoder': pipeline.meta['model_info'].get('name')
+                    }
+                    for name, pipeline in self._pipelines.items()
+                ],
+                'resident_bytes': sum(self._resident.values()),
+                'memory_budget_bytes': self.memory_budget_bytes,
+                'encoders': len(self._encoders),
+                'loads': self.loads,
+                'evictions': self.evictions
+            }
+
+    def _loaded(self, name: str) -> Optional[Pipeline]:
+        """Returns a loaded pipeline and brings its accounting up to date with its build."""
+        with self._lock:
+            pipeline = self._pipelines.get(name)
+            if pipeline is None:
+                return None
+            self._pipelines.move_to_end(name)
+            encoder = self._encoders.get(self._encoder_keys.get(name))
+            reloaded = (pipeline.version != self._versions.get(name)
+                        or encoder is not None and encoder['model'] is None and pipeline._state.model is not None)
+        if reloaded:
+            self._account(name, pipeline)
+        return pipeline
+
+    def _load(self, name: str) -> Pipeline:
+        """Loads a pipeline without holding the registry lock (the caller holds its load lock)."""
+        base_path = self.target_dir / name
+        meta_path = current_build_dir(base_path) / 'meta.json'
+        if not meta_path.exists():
+            raise FileNotFoundError(f"Pipeline {name} not found")
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+
+        key = self.encoder_key(meta)
+        with self._lock:
+            encoder = self._encoders.get(key)
+            encoder_lock = self._encoder_locks.setdefault(key, threading.Lock())
+        # Pipelines of a new encoder load one at a time, so the encoder is loaded once
+        with contextlib.nullcontext() if encoder else encoder_lock:
+            if encoder is None:
+                with self._lock:
+                    encoder = self._encoders.get(key)
+            start = time.perf_counter()
+            pipeline = Pipeline(base_path=str(base_path),
+                                model=encoder['model'] if encoder else None,
+                                model_lock=encoder['lock'] if encoder else None,
+                                **self.pipeline_params)
+            print(f"Pipeline {name} loaded in {time.perf_counter() - start:.2f}s")
+            with self._lock:
+                self._pipelines[name] = pipeline
+                self.loads += 1
+            self._account(name, pipeline)
+        return pipeline
+
+    def _account(self, name: str, pipeline: Pipeline):
+        """
+        Records the corpus size and encoder of the build a pipeline serves and
+        unloads other pipelines if the budget is exceeded. The sizes are taken
+        outside the registry lock; an encoder that is loaded on first use is
+        not loaded here.
+        """
+        state = pipeline._state
+        resident = pipeline.corpus_bytes()
+        key = self.encoder_key(state.meta)
+        with self._lock:
+            if self._pipelines.get(name) is not pipeline:
+                return
+            self._versions[name] = state.version
+            self._resident[name] = resident
+            encoder = self._encoders.get(key)
+            if encoder is None:
+                encoder = self._encoders[key] = {'model': state.model, 'lock': state.model_lock, 'users': set()}
+            elif encoder['model'] is None and encoder['lock'] is state.model_lock:
+                # Loaded on first use under the shared lock, so the other pipelines can use it
+                encoder['model'] = state.model
+            old_key = self._encoder_keys.get(name)
+            if key != old_key:
+                encoder['users'].add(name)
+                self._encoder_keys[name] = key
+                self._release_encoder(name, old_key)
+            self._evict(keep=name)
+
+    def _release_encoder(self, name: str, key: Optional[str]):
+        """Removes a pipeline from the users of an encoder and drops the encoder when unused."""
+        encoder = self._encoders.get(key)
+        if encoder is not None:
+            encoder['users'].discard(name)
+            if not encoder['users']:
+                del self._encoders[key]
+
+    def _evict(self, keep: str):
+        """Unloads least recently used pipelines until the budget is met."""
+        if self.memory_budget_bytes is None:
+            return
+        while sum(self._resident.values()) > self.memory_budget_bytes:
+            victim = next((n for n in self._pipelines if n != keep), None)
+            if victim is None:
+                break
+            self.unload(victim)
+            self.evictions += 1
@@ -0,0 +1,296 @@
+# server.py
+import argparse
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from .pipeline import Pipeline
+except ImportError:
+    from pipeline import Pipeline
+
+
+class QueueFullError(Exception):
+    """Raised when the request queue is full."""
+
+
+class MicroBatcher:
+    """
+    Collects concurrent queries for a short time and sends them through
+    one ``Pipeline.query_batch`` call.
+    """
+
+    def __init__(self, pipeline: Pipeline, max_batch_size: int = 64,
+                 max_wait_ms: float = 5.0, max_queue_size: int = 1024):
+        """
+        :param pipeline: Loaded pipeline
+        :param max_batch_size: Maximum number of questions encoded together
+        :param max_wait_ms: Maximum time to wait for more questions after the first one
+        :param max_queue_size: Maximum number of waiting questions; further
+            requests are rejected (backpressure)
+        """
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue_size = max_queue_size
+        self.stats = {
+            'requests': 0,
+            'rejected': 0,
+            'batches': 0
+        }
+        self._queue = None
+        self._worker = None
+        # One thread, so batches do not compete for the CPU with each other
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def start(self):
+        """Starts the batching loop."""
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._worker = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stops the batching loop."""
+        if self._worker:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=False)
+
+    async def submit(self, question: str, threshold: float) -> dict:
+        """
+        Queues a question and waits for its result.
+
+        :raises QueueFullError: if the queue is full
+        """
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((question, threshold, future))
+        except asyncio.QueueFull:
+            self.stats['rejected'] += 1
+            raise QueueFullError("Request queue is full")
+        self.stats['requests'] += 1
+        return await future
+
+    async def _collect(self) -> list:
+        """Waits for the first question, then collects more until the batch is full or time is up."""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            questions = [item[0] for item in batch]
+            thresholds = [item[1] for item in batch]
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self.pipeline.query_batch,
+                    questions, thresholds, len(batch)
+                )
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.stats['batches'] += 1
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+class Server:
+    """
+    Minimal asyncio HTTP/1.1 server for a built pipeline.
+
+    Endpoints:
+        POST /query  {"question": str, "threshold": float (optional)}
+        POST /reload  (loads a new build of the pipeline folder, if there is one)
+        GET  /health
+        GET  /metrics  (Prometheus text format; /metrics?format=json for JSON)
+    """
+
+    def __init__(self, pipeline: Pipeline, host: str = '127.0.0.1', port: int = 8000,
+                 threshold: float = 0.7, max_body_size: int = 65536, **batcher_params):
+        """
+        :param pipeline: Loaded pipeline
+        :param host: Host to bind
+        :param port: Port to bind
+        :param threshold: Default similarity threshold
+        :param max_body_size: Maximum request body size in bytes
+        :param batcher_params: MicroBatcher parameters
+        """
+        self.pipeline = pipeline
+        self.host = host
+        self.port = port
+        self.threshold = threshold
+        self.max_body_size = max_body_size
+        self.batcher = MicroBatcher(pipeline, **batcher_params)
+
+    async def serve_forever(self):
+        """Starts the server and serves until cancelled."""
+        await self.batcher.start()
+        server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        print(f"Serving on http://{self.host}:{self.port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.batcher.stop()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, payload, extra_headers = await self._route(method, path, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                self._write_response(writer, status, payload, extra_headers, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        """Reads one request, returns (method, path, headers, body) or None when the client is gone."""
+        line = await reader.readline()
+        if not line:
+            return None
+        method, path, _ = line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > self.max_body_size:
+            raise ValueError("Request body too large")
+        body = await reader.readexactly(length) if length else b''
+        return method.upper(), path, headers, body
+
+    async def _route(self, method: str, path: str, body: bytes):
+        """Returns (status, payload, extra_headers)."""
+        path, _, query_string = path.partition('?')
+        if path == '/health' and method == 'GET':
+            return 200, {'status': 'ok', 'version': self.pipeline.version, **self.batcher.stats}, {}
+
+        if path == '/reload' and method == 'POST':
+            # Loaded outside the batching thread, so queries are served meanwhile
+            try:
+                reloaded = await asyncio.get_running_loop().run_in_executor(None, self.pipeline.reload)
+            except Exception as e:
+                return 500, {'error': str(e), 'version': self.pipeline.version}, {}
+            return 200, {'reloaded': reloaded, 'version': self.pipeline.version}, {}
+
+        if path == '/metrics' and method == 'GET':
+            if self.pipeline.metrics is None:
+                return 404, {'error': 'Metrics are disabled'}, {}
+            if 'format=json' in query_string.split('&'):
+                return 200, self.pipeline.get_metrics(), {}
+            return 200, self.pipeline.get_metrics('prometheus'), {}
+
+        if path == '/query' and method == 'POST':
+            try:
+                data = json.loads(body or b'{}')
+                question = data['question']
+                threshold = float(data.get('threshold', self.threshold))
+                if not isinstance(question, str):
+                    raise TypeError("'question' must be a string")
+            except (ValueError, KeyError, TypeError) as e:
+                return 400, {'error': f"Invalid request: {e}"}, {}
+            try:
+                result = await self.batcher.submit(question, threshold)
+            except QueueFullError as e:
+                return 503, {'error': str(e)}, {'Retry-After': '1'}
+            except Exception as e:
+                return 500, {'error': str(e)}, {}
+            return 200, result, {}
+
+        return 404, {'error': 'Not found'}, {}
+
+    @staticmethod
+    def _write_response(writer, status: int, payload: dict, extra_headers: dict, keep_alive: bool):
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                   500: 'Internal Server Error', 503: 'Service Unavailable'}
+        if isinstance(payload, str):
+            body = payload.encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            content_type = 'application/json; charset=utf-8'
+        headers = {
+            'Content-Type': content_type,
+            'Content-Length': str(len(body)),
+            'Connection': 'keep-alive' if keep_alive else 'close',
+            **extra_headers
+        }
+        head = f"HTTP/1.1 {status} {reasons.get(status, '')}\r\n"
+        head += ''.join(f"{name}: {value}\r\n" for name, value in headers.items())
+        writer.write(head.encode('latin-1') + b'\r\n' + body)
+
+
+def main(argv=None):
+    """Command line entry point: ``python -m <pipeline> serve``."""
+    parser = argparse.ArgumentParser(prog='python -m <pipeline>')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help='Serve the pipeline over HTTP')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.add_argument('--threshold', type=float, default=0.7,
+                       help='Default similarity threshold')
+    serve.add_argument('--max-batch-size', type=int, default=64,
+                       help='Maximum number of questions encoded together')
+    serve.add_argument('--max-wait-ms', type=float, default=5.0,
+                       help='Maximum time to wait for a batch to fill')
+    serve.add_argument('--max-queue-size', type=int, default=1024,
+                       help='Waiting requests above this are rejected with 503')
+    serve.add_argument('--mmap', action='store_true',
+                       help='Memory-map the embeddings')
+    serve.add_argument('--search-backend', default=None,
+                       help='Embedding search backend (blocked, numpy, torch, ivf, faiss, hnswlib); '
+                            'default is the one the pipeline was built with')
+    serve.add_argument('--search-params', type=json.loads, default=None,
+                       help='Search backend parameters as JSON, e.g. \'{"device": "cuda"}\'')
+    serve.add_argument('--watch', type=float, default=None, metavar='SECONDS',
+                       help='Reload the pipeline when it is rebuilt, checking every SECONDS')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        pipeline = Pipeline(mmap_mode='r' if args.mmap else None, search_backend=args.search_backend,
+                            search_params=args.search_params, watch_interval=args.watch)
+        server = Server(
+            pipeline, host=args.host, port=args.port, threshold=args.threshold,
+            max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+            max_queue_size=args.max_queue_size
+        )
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
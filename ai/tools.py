@@ -2,6 +2,8 @@ import os, json
 import shutil
 from pathlib import Path
 
+from ai.pipeline import current_build_dir
+
 def get_built_pipelines(target_dir: str = "build"):
     """
     Returns a list of built pipelines.
@@ -13,8 +15,9 @@ def get_built_pipelines(target_dir: str = "build"):
     path = Path(target_dir)
 
     for item in path.iterdir():
-        if item.is_dir():
-            with open(item / "meta.json", "r", encoding="utf-8") as f:
+        meta_path = current_build_dir(item) / "meta.json"
+        if item.is_dir() and meta_path.exists():
+            with open(meta_path, "r", encoding="utf-8") as f:
                 meta = json.load(f)
                 data = {
                     "name": item.name,
@@ -25,12 +28,13 @@ def get_built_pipelines(target_dir: str = "build"):
     
     return pipelines
 
-def delete_built_pipeline(pipeline_name: str, target_dir: str = "build"):
+def delete_built_pipeline(pipeline_name: str, target_dir: str = "build", cache_dir: str = "cache"):
     """
-    Deletes a built pipeline.
+    Deletes a built pipeline and its embedding cache.
 
     :param pipeline_name: Name of the pipeline.
     :param target_dir: Directory with built pipelines.
+    :param cache_dir: Directory with embedding caches of incremental builds.
     """
     pipeline_dir = Path(target_dir) / pipeline_name
     if pipeline_dir.exists():
@@ -38,6 +42,10 @@ def delete_built_pipeline(pipeline_name: str, target_dir: str = "build"):
     else:
         raise FileNotFoundError(f"Pipeline {pipeline_name} not found")
 
+    cache_path = Path(cache_dir) / pipeline_name
+    if cache_path.exists():
+        shutil.rmtree(cache_path)
+
 def get_download_models(target_dir: str = "hub"):
     """
     Returns a list of downloaded models.
@@ -0,0 +1,99 @@
+"""
+Compares two benchmark result files and reports regressions.
+
+    python -m benchmarks.compare baseline.json results.json --tolerance 0.1
+
+Exits with status 1 when a metric got worse by more than the tolerance.
+"""
+import argparse
+import json
+import sys
+
+# Metric name suffixes: lower is better / higher is better (others are not compared)
+LOWER_IS_BETTER = ('seconds', '_ms', '_bytes')
+HIGHER_IS_BETTER = ('per_second', 'padding_efficiency')
+
+
+def flatten(data, prefix: str = '') -> dict:
+    """Flattens nested dictionaries into {'a.b.c': number}."""
+    metrics = {}
+    for key, value in data.items():
+        name = f'{prefix}.{key}' if prefix else key
+        if isinstance(value, dict):
+            metrics.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics[name] = value
+    return metrics
+
+
+def direction(name: str):
+    """Returns -1 if lower is better, 1 if higher is better, None if the metric is not compared."""
+    leaf = name.rsplit('.', 1)[-1]
+    if leaf.endswith(HIGHER_IS_BETTER):
+        return 1
+    if leaf.endswith(LOWER_IS_BETTER):
+        return -1
+    return None
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> list:
+    """
+    Compares the runs of the same corpus size.
+
+    :return: [{'metric', 'baseline', 'current', 'change', 'regression'}, ...]
+        where change is the relative change (positive means better)
+    """
+    baseline_runs = {run['items']: run for run in baseline['runs']}
+    rows = []
+    for run in current['runs']:
+        if run['items'] not in baseline_runs:
+            continue
+        old = flatten(baseline_runs[run['items']])
+        new = flatten(run)
+        for name in sorted(new.keys() & old.keys()):
+            sign = direction(name)
+            if sign is None or not old[name]:
+                continue
+            change = sign * (new[name] - old[name]) / abs(old[name])
+            rows.append({
+                'metric': f"{run['items']}:{name}",
+                'baseline': old[name],
+                'current': new[name],
+                'change': change,
+                'regression': change < -tolerance
+            })
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare benchmark results")
+    parser.add_argument('baseline', help="Result file of the reference run")
+    parser.add_argument('current', help="Result file of the new run")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="Allowed relative slowdown before a metric counts as a regression")
+    parser.add_argument('--all', action='store_true', help="Show every metric, not only regressions")
+    args = parser.parse_args(argv)
+
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.current, 'r', encoding='utf-8') as f:
+        current = json.load(f)
+
+    rows = compare(baseline, current, args.tolerance)
+    regressions = [row for row in rows if row['regression']]
+
+    print(f"Baseline: {baseline['environment'].get('commit')}")
+    print(f"Current:  {current['environment'].get('commit')}")
+    print()
+    for row in rows if args.all else regressions:
+        mark = 'REGRESSION' if row['regression'] else ''
+        print(f"{row['metric']:<60} {row['baseline']:>14.4f} {row['current']:>14.4f} "
+              f"{row['change']:>+8.1%} {mark}")
+
+    print()
+    print(f"{len(regressions)} of {len(rows)} metrics regressed by more than {args.tolerance:.0%}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
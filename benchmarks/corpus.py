@@ -0,0 +1,88 @@
+import json
+import random
+
+
+def make_vocabulary(size: int = 5000, seed: int = 0) -> list:
+    """Returns ``size`` distinct pseudo-words."""
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(letters) for _ in range(rng.randint(3, 10))))
+    return sorted(words)
+
+
+def make_faq(n_items: int, seed: int = 0, questions_per_item: tuple = (1, 4),
+             answers_per_item: tuple = (1, 3), question_words: tuple = (4, 14),
+             answer_words: tuple = (8, 40), shared_answers: float = 0.1) -> list:
+    """
+    Generates a synthetic FAQ in the training data format.
+
+    :param n_items: Number of FAQ items
+    :param seed: Random seed (the same seed gives the same corpus)
+    :param questions_per_item: (min, max) questions per item
+    :param answers_per_item: (min, max) answers per item
+    :param question_words: (min, max) words per question
+    :param answer_words: (min, max) words per answer
+    :param shared_answers: Share of answers reused from earlier items
+        (exercises the deduplicated answer table)
+    :return: [{'questions': [...], 'answers': [...]}, ...]
+    """
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(seed=seed)
+    sentence = lambda bounds: ' '.join(rng.choices(vocabulary, k=rng.randint(*bounds)))
+
+    items = []
+    answer_pool = []
+    for _ in range(n_items):
+        answers = []
+        for _ in range(rng.randint(*answers_per_item)):
+            if answer_pool and rng.random() < shared_answers:
+                answers.append(rng.choice(answer_pool))
+            else:
+                answers.append(sentence(answer_words) + '.')
+        answer_pool.extend(answers)
+        questions = [sentence(question_words) + '?' for _ in range(rng.randint(*questions_per_item))]
+        items.append({'questions': questions, 'answers': answers})
+    return items
+
+
+def make_queries(faq: list, n_queries: int, seed: int = 0) -> dict:
+    """
+    Builds query sets from a generated FAQ.
+
+    :return: {
+        'exact': stored questions as they are,
+        'paraphrased': stored questions with a word dropped and words shuffled
+            (they miss the exact-match lookup and go through the encoder),
+        'unknown': questions unrelated to the corpus
+    }
+    """
+    rng = random.Random(seed + 1)
+    questions = [q for item in faq for q in item['questions']]
+    sample = [rng.choice(questions) for _ in range(n_queries)]
+
+    def paraphrase(question):
+        words = question.rstrip('?').split()
+        if len(words) > 2:
+            words.pop(rng.randrange(len(words)))
+        rng.shuffle(words)
+        return ' '.join(words) + '?'
+
+    vocabulary = make_vocabulary(seed=seed + 1)
+    return {
+        'exact': sample,
+        'paraphrased': [paraphrase(q) for q in sample],
+        'unknown': [' '.join(rng.choices(vocabulary, k=rng.randint(4, 14))) + '?'
+                    for _ in range(n_queries)]
+    }
+
+
+def write_faq(faq: list, path: str):
+    """Writes the FAQ as a JSON array or, for a '.jsonl' path, as JSON Lines."""
+    with open(path, 'w', encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            for item in faq:
+                f.write(json.dumps(item, ensure_ascii=False) + '\n')
+        else:
+            json.dump(faq, f, ensure_ascii=False)
@@ -0,0 +1,278 @@
+"""
+Benchmarks of the build and query hot paths on synthetic FAQ corpora.
+
+    python -m benchmarks.run --sizes 1000 10000 --output results.json
+
+By default the offline StubEncoder is used, so the numbers show the cost of
+everything around the encoder (build pipeline, loading, search, lookups);
+pass --model with a (small) sentence-transformers model to include the real
+encoder. Encoding and search are also timed separately. Compare two result
+files with ``python -m benchmarks.compare``.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from ai.education import Education
+from ai.pipeline import Pipeline, current_rss
+from benchmarks.corpus import make_faq, make_queries, write_faq
+from benchmarks.stub_encoder import StubEncoder
+
+STRATEGIES = ('last', 'cycle', 'random', 'most_similar')
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+class StubEducation(Education):
+    """Education that trains with an injected encoder instead of a downloaded model."""
+
+    def __init__(self, encoder):
+        self._encoder = encoder
+        super().__init__(encoder.model_name)
+
+    def _init_model(self):
+        self.model_source = None
+        return self._encoder
+
+
+def latency_stats(samples: list) -> dict:
+    """Summarizes per-call durations (seconds) in milliseconds."""
+    ms = np.asarray(samples, dtype=np.float64) * 1000
+    return {
+        'calls': len(samples),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'p99_ms': float(np.percentile(ms, 99))
+    }
+
+
+def timed(fn, *args, **kwargs):
+    """Returns (result, seconds)."""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_build(edu: Education, data_file: str, name: str, strategy: str, params: dict) -> dict:
+    """Times ``train_on_file`` and splits the time into encoding and everything else."""
+    rss_before = current_rss()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result, seconds = timed(edu.train_on_file, data_file, name, answer_strategy=strategy,
+                                show_progress=False, incremental=False, **params)
+    encode_seconds = edu._encode_seconds
+    return {
+        'seconds': seconds,
+        'encode_seconds': encode_seconds,
+        'other_seconds': seconds - encode_seconds,
+        'questions_per_second': result['questions_processed'] / seconds,
+        'sentences_per_second': result['sentences_per_second'],
+        'padding_efficiency': result['padding_efficiency'],
+        'storage_bytes': result['storage_bytes'],
+        'rss_delta_bytes': (current_rss() - rss_before) if rss_before else None
+    }
+
+
+def bench_load(base_path: str, model, repeats: int, pipeline_params: dict) -> dict:
+    """Times Pipeline construction (the encoder is injected when it is a stub)."""
+    samples = []
+    diagnostics = None
+    for _ in range(repeats):
+        pipeline, seconds = timed(Pipeline, base_path=base_path, model=model, **pipeline_params)
+        samples.append(seconds)
+        diagnostics = pipeline.get_diagnostics()
+        del pipeline
+    return {
+        'seconds': float(np.median(samples)),
+        'corpus_load_seconds': diagnostics['corpus_load_seconds'],
+        'model_load_seconds': diagnostics['model_load_seconds'],
+        'rss_after_load_bytes': diagnostics['rss_after_load_bytes'],
+        'embeddings_bytes': diagnostics['embeddings_bytes']
+    }
+
+
+def bench_encode(pipeline: Pipeline, texts: list, batch_size: int) -> dict:
+    """Encoder-bound cost: query encoding alone, one by one and batched."""
+    single = [timed(pipeline._encode, [text], batch_size)[1] for text in texts]
+    _, batch_seconds = timed(pipeline._encode, texts, batch_size)
+    return {
+        'single': latency_stats(single),
+        'batch': {'seconds': batch_seconds, 'queries_per_second': len(texts) / batch_seconds}
+    }
+
+
+def bench_search(pipeline: Pipeline, embeddings: np.ndarray, k: int = 1) -> dict:
+    """Search-bound cost: scoring precomputed query embeddings against the corpus."""
+    single = [timed(pipeline._search, embeddings[i:i + 1], k)[1] for i in range(len(embeddings))]
+    _, batch_seconds = timed(pipeline._search, embeddings, k)
+    return {
+        'single': latency_stats(single),
+        'batch': {'seconds': batch_seconds, 'queries_per_second': len(embeddings) / batch_seconds}
+    }
+
+
+def bench_query(pipeline: Pipeline, queries: dict, batch_size: int, threshold: float) -> dict:
+    """End-to-end ``query`` and ``query_batch`` for each query set."""
+    results = {}
+    for name, texts in queries.items():
+        single = []
+        matches = 0
+        for text in texts:
+            result, seconds = timed(pipeline.query, text, threshold)
+            single.append(seconds)
+            matches += result['is_match']
+        _, batch_seconds = timed(pipeline.query_batch, texts, threshold, batch_size)
+        results[name] = {
+            'single': latency_stats(single),
+            'batch': {'seconds': batch_seconds, 'queries_per_second': len(texts) / batch_seconds},
+            'match_rate': matches / len(texts)
+        }
+    return results
+
+
+def run_size(n_items: int, args, encoder) -> dict:
+    """Runs every benchmark on one synthetic corpus."""
+    faq = make_faq(n_items, seed=args.seed)
+    queries = make_queries(faq, args.queries, seed=args.seed)
+    edu = StubEducation(encoder) if encoder else Education(args.model)
+    data_file = f'bench_{n_items}.{args.format}'
+    write_faq(faq, os.path.join(edu.data_dir, data_file))
+
+    build_params = {
+        'chunk_size': args.chunk_size,
+        'storage_dtype': args.storage_dtype,
+        'ann_index': args.ann,
+        'pack': args.pack
+    }
+
+    print(f"[{n_items} items] building...", file=sys.stderr)
+    build = {}
+    for strategy in args.strategies:
+        build[strategy] = bench_build(edu, data_file, f'bench_{n_items}_{strategy}', strategy, build_params)
+    base_path = os.path.join('build', f'bench_{n_items}_{args.strategies[0]}')
+
+    print(f"[{n_items} items] loading...", file=sys.stderr)
+    pipeline_params = {'mmap_mode': args.mmap, 'use_ann': args.ann}
+    load = bench_load(base_path, encoder, args.load_repeats, pipeline_params)
+
+    print(f"[{n_items} items] querying...", file=sys.stderr)
+    # No cache and no exact-match lookup, so every query is encoded and searched
+    pipeline = Pipeline(base_path=base_path, model=encoder, cache_size=0, exact_match=False,
+                        **pipeline_params)
+    encode = bench_encode(pipeline, queries['paraphrased'], args.batch_size)
+    embeddings = pipeline._encode(queries['paraphrased'], args.batch_size)
+    search = bench_search(pipeline, embeddings)
+    query = bench_query(pipeline, queries, args.batch_size, args.threshold)
+
+    # Default configuration: the exact-match lookup answers stored questions without encoding
+    pipeline = Pipeline(base_path=base_path, model=encoder, cache_size=0, **pipeline_params)
+    query['exact_lookup'] = bench_query(pipeline, {'exact': queries['exact']},
+                                        args.batch_size, args.threshold)['exact']
+
+    return {
+        'items': n_items,
+        'questions': pipeline.meta['questions_count'],
+        'unique_answers': pipeline.meta['unique_answers_count'],
+        'build': build,
+        'load': load,
+        'encode': encode,
+        'search': search,
+        'query': query,
+        'memory': {
+            'rss_bytes': current_rss(),
+            'corpus_bytes': pipeline.corpus_bytes()
+        }
+    }
+
+
+def environment(encoder_name: str) -> dict:
+    """Describes the machine and the code version of a run."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'created_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'encoder': encoder_name
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build and query benchmarks")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help="Number of FAQ items of each synthetic corpus")
+    parser.add_argument('--queries', type=int, default=200, help="Queries per query set")
+    parser.add_argument('--strategies', nargs='+', default=list(STRATEGIES), choices=STRATEGIES)
+    parser.add_argument('--model', default=None,
+                        help="sentence-transformers model name or path (default: offline stub encoder)")
+    parser.add_argument('--dim', type=int, default=384, help="Stub encoder dimension")
+    parser.add_argument('--format', choices=('json', 'jsonl'), default='json')
+    parser.add_argument('--chunk-size', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--storage-dtype', choices=('float32', 'float16', 'int8', 'binary'), default='float32')
+    parser.add_argument('--ann', action='store_true', help="Build and search with the IVF index")
+    parser.add_argument('--pack', action='store_true', help="Build packed pipelines")
+    parser.add_argument('--mmap', action='store_const', const='r', default=None,
+                        help="Memory-map the embeddings")
+    parser.add_argument('--threshold', type=float, default=0.7)
+    parser.add_argument('--load-repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="JSON file for the results (default: stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    encoder = None
+    if args.model is None:
+        encoder = StubEncoder(dim=args.dim)
+    else:
+        # Keep local model paths valid inside the temporary working directory
+        for candidate in (Path(args.model), REPO_DIR / 'hub' / args.model):
+            if candidate.exists():
+                args.model = str(candidate.resolve())
+                break
+
+    output = Path(args.output).resolve() if args.output else None
+    cwd = os.getcwd()
+    runs = []
+    with tempfile.TemporaryDirectory(prefix='replycore_bench_') as work_dir:
+        os.chdir(work_dir)
+        try:
+            for n_items in args.sizes:
+                runs.append(run_size(n_items, args, encoder))
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        'environment': environment(args.model or encoder.model_name),
+        'config': vars(args),
+        'runs': runs
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        output.write_text(text, encoding='utf-8')
+        print(f"Results saved to {output}", file=sys.stderr)
+    else:
+        sys.stdout.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
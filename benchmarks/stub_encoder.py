@@ -0,0 +1,75 @@
+import json
+import os
+import re
+import zlib
+import numpy as np
+
+
+class StubTokenizer:
+    """Whitespace tokenizer with the call signature of a Hugging Face tokenizer."""
+
+    def __call__(self, texts, add_special_tokens=True, truncation=True, max_length=None, **kwargs):
+        input_ids = []
+        for text in texts:
+            ids = [zlib.crc32(word.encode('utf-8')) for word in re.findall(r'\w+', text.lower())]
+            if add_special_tokens:
+                ids = [0] + ids + [0]
+            if truncation and max_length:
+                ids = ids[:max_length]
+            input_ids.append(ids)
+        return {'input_ids': input_ids}
+
+
+class StubEncoder:
+    """
+    Offline stand-in for SentenceTransformer: hashes words and character
+    trigrams into a fixed-size vector. Similar texts get similar vectors,
+    which is enough to exercise matching, while encoding costs almost
+    nothing, so the timings of everything around the encoder stand out.
+    """
+
+    model_name = 'stub-encoder'
+
+    def __init__(self, dim: int = 384, max_seq_length: int = 128):
+        """
+        :param dim: Embedding dimension
+        :param max_seq_length: Maximum number of tokens per text
+        """
+        self.dim = dim
+        self.max_seq_length = max_seq_length
+        self.tokenizer = StubTokenizer()
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def _features(self, text: str) -> list:
+        words = re.findall(r'\w+', text.lower())[:self.max_seq_length]
+        features = list(words)
+        for word in words:
+            padded = f' {word} '
+            features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+        return features
+
+    def encode(self, sentences, batch_size: int = 32, show_progress_bar: bool = False,
+               convert_to_numpy: bool = True, convert_to_tensor: bool = False,
+               normalize_embeddings: bool = False, **kwargs):
+        """Encodes texts the way ``SentenceTransformer.encode`` does (numpy output only)."""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                h = zlib.crc32(feature.encode('utf-8'))
+                embeddings[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+
+        if normalize_embeddings:
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings /= np.maximum(norms, 1e-12)
+        return embeddings[0] if single else embeddings
+
+    def save(self, path: str):
+        """Writes a small config, so a built pipeline has its model_files folder."""
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'stub_encoder.json'), 'w', encoding='utf-8') as f:
+            json.dump({'dim': self.dim, 'max_seq_length': self.max_seq_length}, f)
@@ -0,0 +1,73 @@
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ai.pipeline import BM25Index, lexical_tokens
+from benchmarks.corpus import make_faq, make_queries
+
+
+def bm25_scores(texts: list, query: str, k1: float = 1.2, b: float = 0.75) -> dict:
+    """Scores every text containing a query term, straight from the BM25 formula."""
+    docs = [lexical_tokens(text) for text in texts]
+    avg_length = sum(len(doc) for doc in docs) / len(docs)
+    scores = {}
+    for term in set(lexical_tokens(query)):
+        df = sum(term in doc for doc in docs)
+        if not df:
+            continue
+        idf = math.log1p((len(docs) - df + 0.5) / (df + 0.5))
+        for row, doc in enumerate(docs):
+            tf = doc.count(term)
+            if tf:
+                norm = k1 * (1 - b + b * len(doc) / avg_length)
+                scores[row] = scores.get(row, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+    return scores
+
+
+class BM25IndexTest(unittest.TestCase):
+    def setUp(self):
+        faq = make_faq(200, seed=11)
+        self.texts = [q for item in faq for q in item['questions']]
+        queries = make_queries(faq, 50, seed=11)
+        self.queries = queries['paraphrased'] + queries['unknown'][:10]
+        self.index = BM25Index.build(self.texts)
+
+    def test_scores_follow_the_formula(self):
+        for query in self.queries:
+            expected = bm25_scores(self.texts, query)
+            ids, scores = self.index.search(query, k=len(self.texts))
+            self.assertEqual(sorted(ids.tolist()), sorted(expected))
+            for row, score in zip(ids, scores):
+                self.assertAlmostEqual(float(score), expected[int(row)], places=4)
+            self.assertTrue(np.all(np.diff(scores) <= 0))
+
+    def test_top_k_is_the_best_rows(self):
+        for query in self.queries[:20]:
+            expected = sorted(bm25_scores(self.texts, query).values(), reverse=True)[:5]
+            _, scores = self.index.search(query, k=5)
+            np.testing.assert_allclose(scores, expected, rtol=1e-5)
+
+    def test_query_without_indexed_terms_finds_nothing(self):
+        ids, scores = self.index.search('zzzz qqqq', k=5)
+        self.assertEqual(len(ids), 0)
+        self.assertEqual(len(scores), 0)
+
+    def test_saved_index_gives_the_same_results(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'lexical_index.npz')
+            self.index.save(path)
+            loaded = BM25Index.load(path)
+        finally:
+            shutil.rmtree(folder)
+        for query in self.queries[:20]:
+            for expected, actual in zip(self.index.search(query, k=10), loaded.search(query, k=10)):
+                np.testing.assert_array_equal(expected, actual)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import importlib.util
+import io
+import json
+import unittest
+
+HAS_SENTENCE_TRANSFORMERS = importlib.util.find_spec('sentence_transformers') is not None
+
+VALID = [
+    '[]',
+    '  [ ]  ',
+    '[{"questions": ["a?"], "answers": ["b."]}]',
+    '[{"questions": ["a, b?"], "answers": ["[c]"]} , {"questions": ["d?"], "answers": ["e."]}]\n',
+    '[\n  12345,\n  -6.5e3,\n  "x, y",\n  [1, [2, 3]],\n  {"a": {"b": []}},\n  true,\n  null\n]',
+]
+
+MALFORMED = [
+    '',
+    '{"questions": []}',
+    '[',
+    '[1',
+    '[1,',
+    '[1 2]',
+    '[{"a": 1} {"b": 2}]',
+    '[1,,2]',
+    '[,1]',
+    '[1,]',
+    '[1]]',
+    '[1] [2]',
+    '[{"a": 1]',
+]
+
+
+@unittest.skipUnless(HAS_SENTENCE_TRANSFORMERS, 'sentence-transformers is not installed')
+class JsonArrayTest(unittest.TestCase):
+    def parse(self, text: str, block_size: int) -> list:
+        from ai.education import Education
+
+        return list(Education._iter_json_array(io.StringIO(text), block_size=block_size))
+
+    def test_elements_match_json_loads_for_any_block_size(self):
+        for text in VALID:
+            for block_size in (1, 2, 3, 7, 1 << 20):
+                with self.subTest(text=text, block_size=block_size):
+                    self.assertEqual(self.parse(text, block_size), json.loads(text))
+
+    def test_malformed_arrays_are_rejected(self):
+        for text in MALFORMED:
+            for block_size in (1, 3, 1 << 20):
+                with self.subTest(text=text, block_size=block_size):
+                    with self.assertRaises(ValueError):
+                        self.parse(text, block_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+import numpy as np
+
+from ai.pipeline import EmbeddingMatrix, l2_normalize
+
+
+class EmbeddingMatrixTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        self.embeddings = l2_normalize(rng.standard_normal((2000, 64)))
+        # Queries are noisy copies of known rows
+        self.rows = rng.choice(len(self.embeddings), 200, replace=False)
+        self.queries = l2_normalize(self.embeddings[self.rows] + 0.1 * rng.standard_normal((200, 64)))
+        self.exact = self.queries @ self.embeddings.T
+
+    def matrix(self, storage_dtype: str, **params) -> EmbeddingMatrix:
+        data, scales = EmbeddingMatrix.quantize(self.embeddings, storage_dtype)
+        return EmbeddingMatrix(data, storage_dtype, scales, dim=64, **params)
+
+    def test_scores_approximate_float32(self):
+        rows = np.arange(len(self.embeddings))
+        for storage_dtype, tolerance in (('float32', 1e-6), ('float16', 2e-3), ('int8', 2e-2)):
+            with self.subTest(storage_dtype=storage_dtype):
+                scores = self.matrix(storage_dtype).score_rows(rows, self.queries)
+                self.assertLess(np.abs(scores - self.exact).max(), tolerance)
+
+    def test_search_finds_the_source_rows(self):
+        for storage_dtype in ('float32', 'float16', 'int8', 'binary'):
+            with self.subTest(storage_dtype=storage_dtype):
+                ids, _ = self.matrix(storage_dtype).search(self.queries, k=1)
+                self.assertGreaterEqual(np.mean(ids[:, 0] == self.rows), 0.98)
+
+    def test_search_scores_are_the_row_scores_best_first(self):
+        for storage_dtype in ('float16', 'int8', 'binary'):
+            with self.subTest(storage_dtype=storage_dtype):
+                # Small blocks merge the best rows of several blocks
+                matrix = self.matrix(storage_dtype, block_size=300)
+                ids, scores = matrix.search(self.queries[:20], k=5)
+                self.assertTrue(np.all(np.diff(scores, axis=1) <= 0))
+                for query, row_ids, row_scores in zip(self.queries[:20], ids, scores):
+                    np.testing.assert_allclose(matrix.score_rows(row_ids, query), row_scores, rtol=1e-5, atol=1e-6)
+                if storage_dtype != 'binary':
+                    expected_ids, _ = self.matrix(storage_dtype).search(self.queries[:20], k=5)
+                    np.testing.assert_array_equal(ids, expected_ids)
+
+    def test_quantized_storage_is_smaller(self):
+        sizes = {dtype: self.matrix(dtype).nbytes for dtype in ('float32', 'float16', 'int8', 'binary')}
+        self.assertEqual(sizes['float16'] * 2, sizes['float32'])
+        self.assertLess(sizes['int8'], sizes['float16'])
+        self.assertLess(sizes['binary'], sizes['int8'])
+
+    def test_zero_rows_have_finite_scores(self):
+        embeddings = self.embeddings.copy()
+        embeddings[0] = 0.0
+        for storage_dtype in ('int8', 'binary'):
+            with self.subTest(storage_dtype=storage_dtype):
+                data, scales = EmbeddingMatrix.quantize(embeddings, storage_dtype)
+                matrix = EmbeddingMatrix(data, storage_dtype, scales, dim=64)
+                self.assertTrue(np.all(np.isfinite(matrix.decode())))
+
+
+if __name__ == '__main__':
+    unittest.main()
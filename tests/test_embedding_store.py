@@ -0,0 +1,96 @@
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ai.embedding_store import EmbeddingStore
+
+
+def key_ending_with_nul() -> tuple:
+    """Returns a text whose SHA-256 digest ends with a NUL byte, and the digest."""
+    i = 0
+    while True:
+        key = EmbeddingStore.text_key(f'question {i}')
+        if key.endswith(b'\x00'):
+            return f'question {i}', key
+        i += 1
+
+
+class EmbeddingStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store_dir = os.path.join(self.dir, 'store')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip_keeps_every_key(self):
+        _, nul_key = key_ending_with_nul()
+        keys = [EmbeddingStore.text_key(f'text {i}') for i in range(50)] + [nul_key]
+        vectors = np.random.default_rng(0).normal(size=(len(keys), 8)).astype(np.float32)
+        EmbeddingStore(self.store_dir, 'model').write((keys, vectors))
+
+        store = EmbeddingStore(self.store_dir, 'model')
+        self.assertEqual(len(store), len(keys))
+        self.assertTrue(all(key in store for key in keys))
+        np.testing.assert_array_equal(store.get_many(keys), vectors)
+
+    def test_other_model_starts_empty(self):
+        key = EmbeddingStore.text_key('text')
+        EmbeddingStore(self.store_dir, 'model').write(([key], np.ones((1, 4), dtype=np.float32)))
+        self.assertEqual(len(EmbeddingStore(self.store_dir, 'other')), 0)
+
+    def test_inconsistent_store_is_rejected(self):
+        keys = [EmbeddingStore.text_key(f'text {i}') for i in range(4)]
+        EmbeddingStore(self.store_dir, 'model').write((keys, np.ones((4, 4), dtype=np.float32)))
+        # Keys of another write next to these vectors (an interrupted write)
+        np.save(os.path.join(self.store_dir, 'keys.npy'), np.zeros((3, 32), dtype=np.uint8))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(len(EmbeddingStore(self.store_dir, 'model')), 0)
+
+    def test_missing_metadata_is_rejected(self):
+        keys = [EmbeddingStore.text_key('text')]
+        EmbeddingStore(self.store_dir, 'model').write((keys, np.ones((1, 4), dtype=np.float32)))
+        os.remove(os.path.join(self.store_dir, 'store_meta.json'))
+        self.assertEqual(len(EmbeddingStore(self.store_dir, 'model')), 0)
+
+
+@unittest.skipUnless(importlib.util.find_spec('sentence_transformers'), 'sentence-transformers is not installed')
+class RebuildTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_rebuild_of_unchanged_data_encodes_nothing(self):
+        from benchmarks.corpus import make_faq
+        from benchmarks.run import StubEducation
+        from benchmarks.stub_encoder import StubEncoder
+
+        faq = make_faq(100, seed=3)
+        text, _ = key_ending_with_nul()
+        faq[0]['questions'].append(text)
+        edu = StubEducation(StubEncoder(dim=16))
+        with open(os.path.join(edu.data_dir, 'faq.json'), 'w', encoding='utf-8') as f:
+            json.dump(faq, f)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            first = edu.train_on_file('faq.json', 'faq', show_progress=False)
+            second = edu.train_on_file('faq.json', 'faq', show_progress=False)
+        self.assertGreater(first['encoded_texts'], 0)
+        self.assertEqual(second['encoded_texts'], 0)
+        self.assertEqual(second['reused_embeddings'], first['encoded_texts'])
+
+
+if __name__ == '__main__':
+    unittest.main()
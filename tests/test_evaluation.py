@@ -0,0 +1,85 @@
+import importlib.util
+import unittest
+
+import numpy as np
+
+HAS_SENTENCE_TRANSFORMERS = importlib.util.find_spec('sentence_transformers') is not None
+
+
+def brute_force_row(scores: np.ndarray, correct: np.ndarray, in_scope: np.ndarray, threshold: float) -> dict:
+    """Quality of one threshold, computed query by query."""
+    answered = scores > threshold
+    hits = int((answered & correct).sum())
+    precision = hits / answered.sum() if answered.any() else None
+    recall = hits / in_scope.sum()
+    f1 = 2 * precision * recall / (precision + recall) if precision and recall else 0.0
+    return {
+        'precision': precision,
+        'recall': recall,
+        'coverage': answered.mean(),
+        'false_accept_rate': (answered & ~in_scope).sum() / (~in_scope).sum(),
+        'f1': f1
+    }
+
+
+@unittest.skipUnless(HAS_SENTENCE_TRANSFORMERS, 'sentence-transformers is not installed')
+class ThresholdTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        n = 500
+        self.in_scope = rng.random(n) < 0.7
+        self.correct = self.in_scope & (rng.random(n) < 0.8)
+        # Scores on the threshold grid (ties with the thresholds), correct answers score higher
+        scores = np.clip(rng.normal(0.5, 0.15, n) + 0.2 * self.correct, 0.0, 1.0)
+        self.scores = np.round(scores, 2)
+        # Queries nothing was found for
+        self.scores[:5] = -np.inf
+
+    def test_sweep_matches_brute_force(self):
+        from ai.evaluation import DEFAULT_THRESHOLDS, sweep_thresholds, curve_row
+
+        curve = sweep_thresholds(self.scores, self.correct, self.in_scope)
+        self.assertEqual(curve['threshold'], [float(t) for t in DEFAULT_THRESHOLDS])
+        for i, threshold in enumerate(DEFAULT_THRESHOLDS):
+            row = curve_row(curve, i)
+            expected = brute_force_row(self.scores, self.correct, self.in_scope, threshold)
+            for name, value in expected.items():
+                with self.subTest(threshold=threshold, metric=name):
+                    if value is None:
+                        self.assertIsNone(row[name])
+                    else:
+                        self.assertAlmostEqual(row[name], value, places=5)
+
+    def test_recommendation_reaches_the_precision(self):
+        from ai.evaluation import sweep_thresholds, recommend_threshold
+
+        curve = sweep_thresholds(self.scores, self.correct, self.in_scope)
+        row = recommend_threshold(curve, min_precision=0.9)
+        self.assertEqual(row['criterion'], 'precision>=0.9')
+        self.assertGreaterEqual(row['precision'], 0.9)
+        # Every lower threshold misses the precision
+        for threshold, precision in zip(curve['threshold'], curve['precision']):
+            if threshold < row['threshold']:
+                self.assertTrue(precision is None or precision < 0.9)
+
+    def test_recommendation_falls_back_to_the_best_f1(self):
+        from ai.evaluation import sweep_thresholds, recommend_threshold
+
+        curve = sweep_thresholds(self.scores, self.correct, self.in_scope)
+        best = recommend_threshold(curve)
+        self.assertEqual(best['criterion'], 'f1')
+        self.assertEqual(best['f1'], max(curve['f1']))
+        self.assertEqual(recommend_threshold(curve, min_precision=1.1)['threshold'], best['threshold'])
+
+    def test_equal_f1_takes_the_highest_threshold(self):
+        from ai.evaluation import sweep_thresholds, recommend_threshold
+
+        # Every threshold below 0.5 answers exactly the two correct queries
+        scores = np.array([0.9, 0.8, 0.1])
+        curve = sweep_thresholds(scores, np.array([True, True, False]), np.array([True, True, False]),
+                                 thresholds=[0.2, 0.3, 0.5, 0.85])
+        self.assertEqual(recommend_threshold(curve)['threshold'], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from ai.pipeline import Pipeline
+from benchmarks.corpus import make_faq, make_queries
+from benchmarks.stub_encoder import StubEncoder
+
+HAS_SENTENCE_TRANSFORMERS = importlib.util.find_spec('sentence_transformers') is not None
+
+
+class BuiltPipelineTest(unittest.TestCase):
+    """Builds pipelines with the offline StubEncoder in a temporary folder."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.encoder = StubEncoder(dim=64)
+        self.faq = make_faq(300, seed=5)
+        self.queries = make_queries(self.faq, 100, seed=5)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def build(self, name: str = 'faq', **params) -> dict:
+        from benchmarks.run import StubEducation
+
+        edu = StubEducation(self.encoder)
+        with open(os.path.join(edu.data_dir, 'faq.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.faq, f)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return edu.train_on_file('faq.json', name, show_progress=False, incremental=False, **params)
+
+    def load(self, name: str = 'faq', **params) -> Pipeline:
+        return Pipeline(base_path=os.path.join('build', name), model=self.encoder, metrics=False, **params)
+
+
+@unittest.skipUnless(HAS_SENTENCE_TRANSFORMERS, 'sentence-transformers is not installed')
+class TopKTest(BuiltPipelineTest):
+    def check_top_k(self, pipeline: Pipeline, ranked_by_score: bool):
+        questions = self.queries['paraphrased'] + self.queries['unknown']
+        for result in pipeline.query_batch(questions, threshold=0.0, top_k=3):
+            answers = [entry['answer'] for entry in result['top_k']]
+            self.assertEqual(len(answers), len(set(answers)))
+            self.assertEqual(result['answer'], answers[0])
+            self.assertGreaterEqual(result['margin'], 0.0)
+            if ranked_by_score:
+                scores = [entry['score'] for entry in result['top_k']]
+                self.assertEqual(scores, sorted(scores, reverse=True))
+                self.assertAlmostEqual(result['margin'], scores[0] - scores[1], places=5)
+
+    def test_dense_top_k_is_ranked_by_score(self):
+        self.build(storage_dtype='float16')
+        self.check_top_k(self.load(), ranked_by_score=True)
+
+    def test_fused_top_k_margin_follows_the_ranking(self):
+        self.build(lexical_index=True, storage_dtype='float16')
+        self.check_top_k(self.load(fusion='rrf'), ranked_by_score=False)
+        self.check_top_k(self.load(fusion='weighted'), ranked_by_score=True)
+
+    def test_top_k_agrees_with_the_best_match(self):
+        self.build()
+        pipeline = self.load(cache_size=0)
+        for question in self.queries['exact'][:20] + self.queries['paraphrased'][:20]:
+            best = pipeline.query(question, threshold=0.0)
+            one = pipeline.query(question, threshold=0.0, top_k=1)
+            three = pipeline.query(question, threshold=0.0, top_k=3)
+            self.assertEqual(len(one['top_k']), 1)
+            self.assertEqual(len(three['top_k']), 3)
+            self.assertEqual(one['top_k'][0], three['top_k'][0])
+            self.assertEqual(best['answer'], three['answer'])
+            self.assertAlmostEqual(best['score'], three['score'], places=5)
+            # The margin is to the second-best answer whatever the size of top_k
+            self.assertAlmostEqual(one['margin'], three['margin'], places=5)
+            self.assertAlmostEqual(three['margin'], three['top_k'][0]['score'] - three['top_k'][1]['score'],
+                                   places=5)
+
+    def test_lexical_build_is_dense_by_default(self):
+        self.build(lexical_index=True)
+        self.assertIsNone(self.load().fusion)
+        self.assertEqual(self.load(fusion='auto').fusion, 'rrf')
+        with self.assertRaises(ValueError):
+            self.load(lexical_candidates=20)
+
+
+@unittest.skipUnless(HAS_SENTENCE_TRANSFORMERS, 'sentence-transformers is not installed')
+class FusionTest(BuiltPipelineTest):
+    def setUp(self):
+        super().setUp()
+        self.build(lexical_index=True)
+        self.questions = self.queries['paraphrased'][:30] + self.queries['unknown'][:10]
+
+    def fused_scores(self, pipeline: Pipeline, question: str, embedding: np.ndarray) -> dict:
+        """Fuses the dense and BM25 results of one question as ``Pipeline.fusion`` describes."""
+        depth = pipeline.fusion_depth
+        dense_ids, _ = pipeline.searcher.search(embedding[None], k=depth)
+        dense_ids = [int(row) for row in dense_ids[0] if row >= 0]
+        lexical_ids, lexical_scores = pipeline.lexical_index.search(question, depth)
+        rows = sorted(set(dense_ids) | set(lexical_ids.tolist()))
+        cosine = dict(zip(rows, pipeline.matrix.score_rows(np.array(rows), embedding)))
+        if pipeline.fusion == 'rrf':
+            fused = dict.fromkeys(rows, 0.0)
+            for ranked in (dense_ids, lexical_ids.tolist()):
+                for rank, row in enumerate(ranked):
+                    fused[row] += 1.0 / (60 + rank + 1)
+            return fused
+        lexical = dict(zip(lexical_ids.tolist(), lexical_scores / lexical_scores[0])) if len(lexical_ids) else {}
+        weight = pipeline.lexical_weight
+        return {row: (1 - weight) * cosine[row] + weight * lexical.get(row, 0.0) for row in rows}
+
+    def test_fused_ranking_matches_the_reference(self):
+        for fusion in ('rrf', 'weighted'):
+            pipeline = self.load(fusion=fusion)
+            embeddings = pipeline._encode(self.questions, 64)
+            ids, scores, ranking = pipeline._retrieve(self.questions, embeddings, k=3, ranking=True)
+            for i, question in enumerate(self.questions):
+                with self.subTest(fusion=fusion, question=question):
+                    fused = self.fused_scores(pipeline, question, embeddings[i])
+                    expected = sorted(fused.values(), reverse=True)[:3]
+                    np.testing.assert_allclose(ranking[i], expected, rtol=1e-5)
+                    np.testing.assert_allclose([fused[int(row)] for row in ids[i]], ranking[i], rtol=1e-5)
+                    # The score stays the cosine similarity with 'rrf'
+                    if fusion == 'rrf':
+                        np.testing.assert_allclose(scores[i], pipeline.matrix.score_rows(ids[i], embeddings[i]),
+                                                   rtol=1e-5, atol=1e-6)
+
+    def test_lexical_pre_filter_scores_only_the_bm25_rows(self):
+        pipeline = self.load(fusion='rrf', lexical_candidates=20)
+        embeddings = pipeline._encode(self.questions, 64)
+        ids, _ = pipeline._retrieve(self.questions, embeddings, k=3)
+        for question, rows in zip(self.questions, ids):
+            candidates, _ = pipeline.lexical_index.search(question, pipeline.fusion_depth)
+            if len(candidates):
+                self.assertTrue(set(rows[rows >= 0].tolist()) <= set(candidates.tolist()))
+
+
+@unittest.skipUnless(HAS_SENTENCE_TRANSFORMERS, 'sentence-transformers is not installed')
+class PublishTest(BuiltPipelineTest):
+    def test_rebuild_is_published_as_a_whole(self):
+        first = self.build()
+        pipeline = self.load()
+        self.assertEqual(sorted(os.listdir(os.path.join('build', 'faq'))), ['__init__.py', 'builds', 'current'])
+
+        self.faq.append({'questions': ['how often is the cat fed?'], 'answers': ['Twice a day.']})
+        second = self.build()
+        # The serving build is unchanged until the pipeline reloads
+        self.assertEqual(pipeline.version, first['build_version'])
+        self.assertTrue(pipeline.reload())
+        self.assertFalse(pipeline.reload())
+        result = pipeline.query('how often is the cat fed?')
+        self.assertEqual(result['version'], second['build_version'])
+        self.assertEqual(result['answer'], 'Twice a day.')
+
+        # The previous build is kept, older ones are removed
+        third = self.build()
+        builds = sorted(os.listdir(os.path.join('build', 'faq', 'builds')))
+        self.assertEqual(builds, sorted([second['build_version'], third['build_version']]))
+        self.assertEqual(self.load().version, third['build_version'])
+
+    def test_package_imports_the_current_build(self):
+        self.build()
+        second = self.build()
+        sys.path.insert(0, 'build')
+        try:
+            module = importlib.import_module('faq.pipeline')
+            self.assertEqual(Path(module.__file__).parent, Path(second['build_dir']).resolve())
+            self.assertEqual(module.Pipeline(model=self.encoder, metrics=False).version, second['build_version'])
+        finally:
+            sys.path.remove('build')
+            for name in [name for name in sys.modules if name == 'faq' or name.startswith('faq.')]:
+                del sys.modules[name]
+
+
+@unittest.skipUnless(HAS_SENTENCE_TRANSFORMERS, 'sentence-transformers is not installed')
+@unittest.skipIf(importlib.util.find_spec('hnswlib'), 'hnswlib is installed')
+class MissingBackendTest(BuiltPipelineTest):
+    def test_missing_backend_fails_before_encoding(self):
+        from benchmarks.run import StubEducation
+
+        edu = StubEducation(self.encoder)
+        with open(os.path.join(edu.data_dir, 'faq.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.faq, f)
+        with self.assertRaises(ImportError):
+            edu.train_on_file('faq.json', 'faq', show_progress=False, search_backend='hnswlib')
+        self.assertEqual(edu._encoded_count, 0)
+        self.assertFalse(os.path.exists(os.path.join('build', 'faq')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -75,4 +75,12 @@ strategies = {
     "2": "random",
     "3": "last",
     "4": "most_similar"
-}
\ No newline at end of file
+}
+search_backends = {
+    "1": "blocked",
+    "2": "numpy",
+    "3": "torch",
+    "4": "ivf",
+    "5": "faiss",
+    "6": "hnswlib"
+}
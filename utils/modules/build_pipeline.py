@@ -1,5 +1,6 @@
 from ai.education import Education
-from utils.const import strategies, models
+from ai.pipeline import SEARCH_BACKENDS
+from utils.const import strategies, models, search_backends
 
 def Build(get_downloaded_models):
     print("\n[0] - Exit\n")
@@ -35,6 +36,22 @@ def Build(get_downloaded_models):
         print("None")
     print()
     model_name = int(input("Select a model: "))
+
+    print()
+    print("[1] - Exact search (default)")
+    print("[2] - Exact search, one matrix multiplication (NumPy)")
+    print("[3] - Exact search with torch")
+    print("[4] - Approximate search, IVF index (large corpora)")
+    print("[5] - faiss index (requires faiss)")
+    print("[6] - HNSW index (requires hnswlib)")
+    print()
+    while True:
+        search_backend = search_backends.get(input("Select a search backend: "), "blocked")
+        try:
+            SEARCH_BACKENDS[search_backend].check_available()
+            break
+        except ImportError as e:
+            print(str(e))
     
     # Training
 
@@ -45,7 +62,8 @@ def Build(get_downloaded_models):
         # print(hub_models)
         model_name = hub_models[model_name - len(models) - 1]
     edu = Education(model_name=model_name["name"])
-    result = edu.train_on_file(data_file, pipeline_name, answer_strategy=strategies.get(answer_strategy, "cycle"))
+    result = edu.train_on_file(data_file, pipeline_name, answer_strategy=strategies.get(answer_strategy, "cycle"),
+                               search_backend=search_backend)
     print("Pipeline saved at", result['model_dir'])
     print("\nPress Enter to continue...")
     input()
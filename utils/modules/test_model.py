@@ -1,4 +1,5 @@
 from ai.pipeline_tester import PipelineTester
+from ai.evaluation import evaluate, load_labelled_queries, print_report
 from ai.tools import get_built_pipelines
 import json
 
@@ -24,19 +25,38 @@ def Test():
         pass
 
     tester = PipelineTester(model_name)
+    if tester.meta.get('lexical_index'):
+        # The served Pipeline also searches densely unless fusion is enabled
+        print("\nThe pipeline has a lexical index; questions are answered with dense search only "
+              "(Pipeline default, BM25 fusion is not applied)")
 
     print("\n[stats] - Show statistics")
+    print("[eval] - Evaluate on a labelled query file")
     print("[0] - Exit\n")
-    while True:
-        question = input("\nEnter your question: ")
-        if question in ["0", ""]:
-            break
-        elif question == "stats":
-            print(json.dumps(tester.get_stats(), indent=4, ensure_ascii=False))
-            continue
-
-        result = tester.query(question)
-        print(f"Answer: {result['answer']} (similarity: {result['score']:.2f})")
-
+    try:
+        while True:
+            question = input("\nEnter your question: ")
+            if question in ["0", ""]:
+                break
+            elif question == "stats":
+                print(json.dumps(tester.get_stats(), indent=4, ensure_ascii=False))
+                continue
+            elif question == "eval":
+                path = input("Labelled query file (JSON, JSONL or CSV): ")
+                try:
+                    report = evaluate(tester, load_labelled_queries(path))
+                except (OSError, ValueError) as e:
+                    print(f"Evaluation failed: {str(e)}")
+                    continue
+                print_report(report)
+                if input(f"\nUse the recommended threshold {report['recommended']['threshold']:.2f}? (y/n): ") == "y":
+                    tester.set_threshold(report['recommended']['threshold'])
+                continue
+
+            result = tester.query(question)
+            print(f"Answer: {result['answer']} (similarity: {result['score']:.2f})")
+    finally:
+        # Writes the queries still buffered for the query log
+        tester.close()
 
     return
\ No newline at end of file